@@ -0,0 +1,134 @@
+import numpy as np
+
+
+# Interpolation methods accepted by `pairwise_interpolate_predictions`.
+# 'bilin' and 'bispline' both fit a bilinear surface (a + b*u + c*v + d*u*v)
+# through the neighbours, which is what `interp2d` and `bisplrep(kx=1, ky=1)`
+# compute when given a handful of scattered points. Like FITPACK's `bisplev`,
+# the surface is evaluated at query points clamped to the bounding box
+# of the neighbours (e.g. points reprojected just outside the pixel grid),
+# rather than extrapolated.
+BILINEAR_METHODS = ('bilin', 'bispline')
+INTERPOLATION_METHODS = BILINEAR_METHODS + ('barycentric', 'idw')
+
+
+def _least_squares_weights(design, design_query, rcond=1e-8):
+    """Compute weights of a batch of least-squares fits evaluated at query points.
+
+    :param design: [n, k, m] design matrices (basis functions evaluated in neighbours)
+    :param design_query: [n, m] basis functions evaluated in query points
+    :param rcond: relative cut-off for small singular values
+    :return: tuple of [n, k] weights (query basis times the pseudo-inverse
+        of the design matrix) and [n, ] mask of well-posed fits
+    """
+    k, m = design.shape[1:]
+    u, s, vt = np.linalg.svd(design, full_matrices=False)  # [n, k, r], [n, r], [n, r, m]
+    # Rank-deficient fits (e.g. neighbours in a T-shaped configuration)
+    # fall back to the minimum-norm solution, as FITPACK does,
+    # by dropping small singular values.
+    s_inv = np.zeros_like(s)
+    nonzero = s > rcond * s[:, [0]]
+    s_inv[nonzero] = 1. / s[nonzero]
+    # fewer neighbours than parameters leaves the fit underdetermined
+    valid = np.full(len(design), k >= m)
+    # design_query @ V @ diag(1 / s) @ U^T
+    weights = np.einsum('nm,nrm,nr,nkr->nk', design_query, vt, s_inv, u)
+    return weights, valid
+
+
+def _tensor_linear_basis(x, y):
+    return np.stack([(1 - x) * (1 - y), x * (1 - y), (1 - x) * y, x * y], axis=-1)
+
+
+def _bilinear_weights(uv_nns, uv_query):
+    # Use the same basis as FITPACK does: products of linear B-splines
+    # spanning the bounding box of the neighbours, so that minimum-norm
+    # solutions of rank-deficient fits agree with `bisplrep`.
+    uv_min, uv_max = uv_nns.min(axis=1), uv_nns.max(axis=1)  # [n, 2]
+    extent = uv_max - uv_min
+    # `bisplrep` rejects neighbours lying on a line parallel to an axis
+    # (e.g. nearest pixels of a point reprojected outside the pixel grid)
+    flat = np.any(extent == 0., axis=1)
+    extent[extent == 0.] = 1.
+    xy_nns = (uv_nns - uv_min[:, None, :]) / extent[:, None, :]
+    # `bisplev` clamps arguments to the knot box instead of extrapolating
+    xy_query = np.clip((uv_query - uv_min) / extent, 0., 1.)
+    weights, valid = _least_squares_weights(
+        _tensor_linear_basis(xy_nns[..., 0], xy_nns[..., 1]),
+        _tensor_linear_basis(xy_query[..., 0], xy_query[..., 1]))
+    return weights, valid & ~flat
+
+
+def _barycentric_weights(uv_nns, uv_query):
+    # an affine fit through three points is barycentric interpolation
+    # in the triangle they span; neighbours come sorted by distance,
+    # so use the three nearest ones
+    k = uv_nns.shape[1]
+    duv = uv_nns[:, :3] - uv_query[:, None, :]
+    # normalize offsets per point to keep the fit well-conditioned
+    scale = np.abs(duv).reshape(len(duv), -1).max(axis=1)
+    scale[scale == 0.] = 1.
+    duv = duv / scale[:, None, None]
+    design = np.concatenate([np.ones_like(duv[..., :1]), duv], axis=-1)
+    design_query = np.zeros((len(duv), 3))
+    design_query[:, 0] = 1.
+    weights, valid = _least_squares_weights(design, design_query)
+    weights = np.pad(weights, ((0, 0), (0, k - weights.shape[1])))
+    return weights, valid & (k >= 3)
+
+
+def _idw_weights(uv_nns, uv_query, power=2, eps=1e-12):
+    distances = np.linalg.norm(uv_nns - uv_query[:, None, :], axis=-1)  # [n, k]
+    coincident = distances < eps
+    with np.errstate(divide='ignore'):
+        weights = 1. / distances ** power
+    # points coinciding with a neighbour take its value directly
+    has_coincident = np.any(coincident, axis=1)
+    weights[has_coincident] = coincident[has_coincident]
+    weights /= weights.sum(axis=1, keepdims=True)
+    return weights, np.ones(len(uv_nns), dtype=bool)
+
+
+def interpolation_weights(uv_nns, uv_query, method='bilin'):
+    """Compute interpolation weights of neighbours for a batch of points.
+
+    Weights are always computed in double precision, as rank decisions
+    of least-squares fits are unreliable in single precision.
+
+    :param uv_nns: [n, k, 2] array of (u, v) coordinates of neighbours
+    :param uv_query: [n, 2] array of (u, v) coordinates of query points
+    :param method: one of `INTERPOLATION_METHODS`
+    :return: tuple of [n, k] weights and [n, ] boolean mask that is False
+        for points where interpolation is ill-posed (too few neighbours)
+    """
+    if method not in INTERPOLATION_METHODS:
+        raise ValueError('unknown interpolation method: {}'.format(method))
+    uv_nns = np.asarray(uv_nns, dtype=np.float64)
+    uv_query = np.asarray(uv_query, dtype=np.float64)
+
+    n, k = uv_nns.shape[:2]
+    if n == 0:
+        return np.zeros((0, k)), np.zeros(0, dtype=bool)
+
+    if method in BILINEAR_METHODS:
+        return _bilinear_weights(uv_nns, uv_query)
+    elif method == 'barycentric':
+        return _barycentric_weights(uv_nns, uv_query)
+    else:  # method == 'idw'
+        return _idw_weights(uv_nns, uv_query)
+
+
+def interpolate_batch(uv_nns, values_nns, uv_query, method='bilin'):
+    """Interpolate values from neighbours into query points, all points at once.
+
+    :param uv_nns: [n, k, 2] array of (u, v) coordinates of neighbours
+    :param values_nns: [n, k] array of values in neighbours
+    :param uv_query: [n, 2] array of (u, v) coordinates of query points
+    :param method: one of `INTERPOLATION_METHODS`
+    :return: tuple of [n, ] interpolated values (in the floating point type
+        of `values_nns`) and [n, ] boolean mask of successfully interpolated points
+    """
+    weights, valid = interpolation_weights(uv_nns, uv_query, method=method)
+    values = np.einsum('nk,nk->n', weights, values_nns)
+    values[~valid] = 0.
+    return values.astype(np.result_type(values_nns.dtype, np.float32), copy=False), valid
@@ -1,18 +1,456 @@
-from collections import defaultdict
-from typing import List, Mapping, Tuple
+import warnings
+from typing import Iterator, List, Mapping, Tuple
 
 import numpy as np
-from tqdm import tqdm
+
+from gcv_v20211_hw1.utils.instrumentation import get_tracer
+
+AGGREGATION_METHODS = ['min', 'truncated_min', 'truncated_mean', 'truncated_median', 'weighted_mean', 'huber']
+
+# aggregations needing all predictions of each point, which
+# `StreamingCombiner` approximates from reservoirs of predictions
+RESERVOIR_AGGREGATION_METHODS = ['truncated_min', 'truncated_mean', 'truncated_median', 'huber']
+
+# Huber estimates downweight predictions further than HUBER_THRESHOLD
+# robust standard deviations (1.4826 * median absolute deviation)
+# from the estimate, refining it for HUBER_ITERATIONS iterations.
+HUBER_THRESHOLD = 1.345
+HUBER_ITERATIONS = 10
+
+# version of `StreamingCombiner.state` layout: 1 kept running sums
+# of squares, 2 keeps running means and sums of squared deviations
+STATE_VERSION = 2
+
+
+class PredictionVariants:
+    def __init__(self, indptr, values, weights=None):
+        """Compressed (CSR-like) storage of all predictions per each of the points:
+        predictions for point `idx` are `values[indptr[idx]:indptr[idx + 1]]`.
+
+        :param indptr: [n_points + 1, ] array of offsets of each point's predictions
+        :param values: [n_predictions, ] array of predictions grouped by point
+        :param weights: [n_predictions, ] array of confidence weights
+            of predictions (in the same order as `values`), all 1 if None
+        """
+        self.indptr = indptr
+        self.values = values
+        self.weights = np.ones_like(values) if None is weights else weights
+
+    @classmethod
+    def from_lists(
+            cls,
+            n_points: int,
+            list_predictions: List[np.array],
+            list_indexes_in_whole: List[np.array],
+            sort_values=True,
+            list_weights: List[np.array] = None,
+    ):
+        """Group predictions by point index.
+
+        :param n_points: total number of points in a point cloud
+        :param list_predictions: list of numpy arrays corresponding to
+            predictions in each 3D point
+        :param list_indexes_in_whole: list of numpy arrays of indexes
+            of the predicted points into the whole point cloud
+        :param sort_values: if True, predictions of each point are sorted
+            in ascending order (not required by `aggregate_variants`)
+        :param list_weights: list of numpy arrays of confidence weights
+            of predictions, all 1 if None
+        """
+        predictions = np.concatenate(list_predictions) \
+            if len(list_predictions) > 0 else np.zeros(0)
+        indexes = np.concatenate(list_indexes_in_whole).astype(np.int64) \
+            if len(list_indexes_in_whole) > 0 else np.zeros(0, dtype=np.int64)
+
+        if sort_values:
+            order = np.lexsort((predictions, indexes))
+        else:
+            order = np.argsort(indexes, kind='stable')
+
+        counts = np.bincount(indexes, minlength=n_points)
+        indptr = np.concatenate([[0], np.cumsum(counts)])
+        weights = None
+        if None is not list_weights:
+            weights = np.concatenate(list_weights)[order] \
+                if len(list_weights) > 0 else np.zeros(0)
+        return cls(indptr, predictions[order], weights)
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    def __getitem__(self, idx):
+        return self.values[self.indptr[idx]:self.indptr[idx + 1]]
+
+    @property
+    def counts(self):
+        return np.diff(self.indptr)
+
+    @property
+    def point_indexes(self):
+        """Index of the point for each of the stored predictions."""
+        return np.repeat(np.arange(len(self)), self.counts)
+
+
+def _truncation_bounds(counts, fraction=0.2):
+    """Compute bounds [lo, hi) of values remaining after removing
+    the largest and smallest `fraction` of values."""
+    lo = (fraction * counts).astype(np.int64)
+    hi = ((1. - fraction) * counts).astype(np.int64)
+    # too few values to truncate: keep all of them
+    empty = lo >= hi
+    lo[empty], hi[empty] = 0, counts[empty]
+    return lo, hi
+
+
+def _groups_by_count(variants: PredictionVariants) -> Iterator[Tuple[int, np.array, np.array, np.array]]:
+    """Split points with predictions into groups with the same number of predictions.
+
+    :return: iterator over tuples (count, points, values, weights) of the number
+        of predictions, indexes of points and [n, count] arrays of their predictions
+        and weights of predictions
+    """
+    counts = variants.counts
+    order = np.argsort(counts, kind='stable')
+    sorted_counts = counts[order]
+    group_starts = np.flatnonzero(np.diff(sorted_counts, prepend=-1))
+    group_stops = np.append(group_starts[1:], len(order))
+    for count, start, stop in zip(sorted_counts[group_starts], group_starts, group_stops):
+        if count == 0:
+            continue
+        points = order[start:stop]
+        positions = variants.indptr[points][:, None] + np.arange(count)
+        yield int(count), points, variants.values[positions], variants.weights[positions]
+
+
+def _huber_location(values, weights) -> np.array:
+    """Weighted Huber M-estimates of location of rows of [n, c] `values`,
+    computed by iteratively reweighted least squares from their medians."""
+    values = values.astype(np.float64)
+    location = np.median(values, axis=1)
+    residuals = np.abs(values - location[:, None])
+    threshold = HUBER_THRESHOLD * 1.4826 * np.median(residuals, axis=1)
+    threshold = np.broadcast_to(threshold[:, None], values.shape)
+    for _ in range(HUBER_ITERATIONS):
+        # down-weight predictions beyond the threshold,
+        # so that their influence on the estimate is bounded
+        huber_weights = np.ones_like(values)
+        np.divide(threshold, residuals, out=huber_weights, where=residuals > threshold)
+        huber_weights *= weights
+        location = np.sum(huber_weights * values, axis=1) / np.sum(huber_weights, axis=1)
+        residuals = np.abs(values - location[:, None])
+    return location
+
+
+def aggregate_variants(
+        variants: PredictionVariants,
+        aggregation_method='min',
+) -> np.array:
+    """Compute a single prediction per point from all of its predictions,
+    using segmented reductions over all points at once.
+
+    Truncated statistics only need a few order statistics of predictions
+    of each point, so instead of sorting, predictions of points with the same
+    number of predictions are gathered into a 2d array and partitioned
+    (`np.partition`) around these, in O(number of predictions) overall.
+    Weighted mean and Huber estimates use confidence weights of predictions.
+
+    :param variants: predictions grouped by point (in any order)
+    :param aggregation_method: one of `AGGREGATION_METHODS`
+    :return: an array of predictions in the floating point type
+        of `variants` (np.inf for points without predictions)
+    """
+    if aggregation_method not in AGGREGATION_METHODS:
+        raise ValueError('unknown aggregation method: {}'.format(aggregation_method))
+
+    counts = variants.counts
+    fused_predictions = np.full(len(counts), np.inf, dtype=np.result_type(variants.values.dtype, np.float32))
+    has_values = counts > 0
+    if not np.any(has_values):
+        return fused_predictions
+
+    starts = variants.indptr[:-1]
+    if aggregation_method == 'min':
+        fused_predictions[has_values] = np.minimum.reduceat(
+            variants.values, starts[has_values])
+        return fused_predictions
+
+    if aggregation_method == 'weighted_mean':
+        point_indexes = variants.point_indexes
+        # bincount accumulates in double precision
+        sums = np.bincount(point_indexes, weights=np.multiply(variants.weights, variants.values, dtype=np.float64),
+                           minlength=len(counts))
+        sum_weights = np.bincount(point_indexes, weights=variants.weights, minlength=len(counts))
+        fused_predictions[has_values] = sums[has_values] / sum_weights[has_values]
+        return fused_predictions
+
+    # Truncated average/min, computed by removing the
+    # largest and smallest 20% of values, then computing the
+    # corresponding quantity.
+    for count, points, values, weights in _groups_by_count(variants):
+        (lo, ), (hi, ) = _truncation_bounds(np.array([count]))
+        if aggregation_method == 'huber':
+            fused = _huber_location(values, weights)
+
+        elif aggregation_method == 'truncated_min':
+            fused = np.partition(values, lo, axis=1)[:, lo]
+
+        elif aggregation_method == 'truncated_median':
+            middle_lo, middle_hi = lo + (hi - lo - 1) // 2, lo + (hi - lo) // 2
+            values = np.partition(values, [middle_lo, middle_hi], axis=1)
+            fused = 0.5 * (values[:, middle_lo] + values[:, middle_hi])
+
+        else:  # aggregation_method == 'truncated_mean'
+            # values between the partitioned positions are exactly those kept
+            values = np.partition(values, [lo, hi - 1], axis=1)
+            fused = np.sum(values[:, lo:hi], axis=1, dtype=np.float64) / (hi - lo)
+
+        fused_predictions[points] = fused
+
+    return fused_predictions
+
+
+def weighted_variance(variants: PredictionVariants) -> np.array:
+    """Weighted variance of predictions of each point (around their
+    weighted mean), an estimate of uncertainty of fused predictions.
+
+    :param variants: predictions grouped by point (in any order)
+    :return: an array of variances (np.inf for points without predictions)
+    """
+    counts = variants.counts
+    point_indexes = variants.point_indexes
+    sum_weights = np.bincount(point_indexes, weights=variants.weights, minlength=len(counts))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.bincount(point_indexes, weights=np.multiply(variants.weights, variants.values, dtype=np.float64),
+                           minlength=len(counts)) / sum_weights
+        # sum deviations from the mean rather than squares of predictions,
+        # avoiding cancellation
+        deviations = variants.values - mean[point_indexes]
+        variance = np.bincount(point_indexes, weights=variants.weights * np.square(deviations),
+                               minlength=len(counts)) / sum_weights
+    variance[counts == 0] = np.inf
+    return variance
+
+
+def _moments_from_sums(sum_weights, sums, sums_squares):
+    """Means and sums of squared deviations from them, given sums
+    of weights, (weighted) values and squares of values."""
+    sum_weights = np.asarray(sum_weights, dtype=np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(sum_weights > 0, np.asarray(sums) / sum_weights, 0.)
+    m2 = np.maximum(np.asarray(sums_squares) - sum_weights * mean ** 2, 0.)
+    return mean, m2
+
+
+class StreamingCombiner:
+    def __init__(self, n_points: int, reservoir_size: int = 32, seed: int = 0, dtype=np.float64):
+        """Running per-point aggregation of predictions, folding in
+        predictions of each pair of views as they arrive, so that memory
+        stays O(n_points) regardless of the number of views.
+
+        Truncated statistics and Huber estimates (`RESERVOIR_AGGREGATION_METHODS`)
+        are computed from a per-point reservoir of at most `reservoir_size` predictions
+        (uniformly sampled if more predictions arrive) and their weights; they are exact
+        for points with at most `reservoir_size` predictions. Reservoirs take
+        2 * reservoir_size predictions per point, so pass `reservoir_size=0`
+        if only 'min' and 'weighted_mean' aggregations are needed. Mean and variance (plain
+        and weighted) are always exact, computed from running means and sums
+        of squared deviations from them (Welford's and West's updates), which
+        unlike running sums of squares do not lose precision to cancellation.
+
+        :param n_points: total number of points in a point cloud
+        :param reservoir_size: number of predictions kept per point (0 to keep none)
+        :param seed: seed for reservoir sampling
+        :param dtype: floating point type of kept predictions
+            (sums are always accumulated in double precision)
+        """
+        self.n_points = n_points
+        self.reservoir_size = reservoir_size
+        self.min = np.full(n_points, np.inf, dtype=dtype)
+        self.count = np.zeros(n_points, dtype=np.int64)
+        self.running_mean = np.zeros(n_points)
+        self.m2 = np.zeros(n_points)
+        self.sum_weights = np.zeros(n_points)
+        self.running_weighted_mean = np.zeros(n_points)
+        self.weighted_m2 = np.zeros(n_points)
+        self.reservoir = np.zeros((n_points, reservoir_size), dtype=dtype)
+        self.reservoir_weights = np.zeros((n_points, reservoir_size), dtype=dtype)
+        self._rng = np.random.RandomState(seed)
+
+    def update(self, predictions: np.array, indexes: np.array, weights: np.array = None):
+        """Fold in predictions for a set of points.
+
+        :param predictions: [n, ] array of predictions
+        :param indexes: [n, ] array of unique indexes of predicted points
+            into the whole point cloud (as produced for a pair of views)
+        :param weights: [n, ] array of confidence weights of predictions, all 1 if None
+        """
+        if None is weights:
+            weights = np.ones_like(predictions)
+        self.min[indexes] = np.minimum(self.min[indexes], predictions)
+        count = self.count[indexes] + 1
+        self.count[indexes] = count
+
+        # merge a single prediction per point into running means and sums
+        # of squared deviations (Chan et al. pairwise update with a batch
+        # of one, i.e. Welford's update, and West's for weighted ones)
+        values = predictions.astype(np.float64)
+        delta = values - self.running_mean[indexes]
+        mean = self.running_mean[indexes] + delta / count
+        self.running_mean[indexes] = mean
+        self.m2[indexes] += delta * (values - mean)
+
+        weights = weights.astype(np.float64)
+        sum_weights = self.sum_weights[indexes] + weights
+        delta = values - self.running_weighted_mean[indexes]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            weighted_mean = self.running_weighted_mean[indexes] + np.where(
+                sum_weights > 0, weights / sum_weights, 0.) * delta
+        self.sum_weights[indexes] = sum_weights
+        self.running_weighted_mean[indexes] = weighted_mean
+        self.weighted_m2[indexes] += weights * delta * (values - weighted_mean)
+
+        if self.reservoir_size == 0:
+            return
+
+        # reservoir sampling: fill free slots first, then replace
+        # a random slot with probability reservoir_size / count
+        slots = count - 1
+        full = slots >= self.reservoir_size
+        slots[full] = self._rng.randint(0, count[full])
+        kept = slots < self.reservoir_size
+        self.reservoir[indexes[kept], slots[kept]] = predictions[kept]
+        self.reservoir_weights[indexes[kept], slots[kept]] = weights[kept]
+
+    def resize(self, n_points: int):
+        """Grow accumulators to `n_points` points, e.g. when points
+        of a new view are appended to the point cloud."""
+        n_new = n_points - self.n_points
+        if n_new < 0:
+            raise ValueError('cannot shrink combiner from {} to {} points'.format(self.n_points, n_points))
+        self.min = np.concatenate([self.min, np.full(n_new, np.inf, dtype=self.min.dtype)])
+        self.count = np.concatenate([self.count, np.zeros(n_new, dtype=self.count.dtype)])
+        self.running_mean = np.concatenate([self.running_mean, np.zeros(n_new)])
+        self.m2 = np.concatenate([self.m2, np.zeros(n_new)])
+        self.sum_weights = np.concatenate([self.sum_weights, np.zeros(n_new)])
+        self.running_weighted_mean = np.concatenate([self.running_weighted_mean, np.zeros(n_new)])
+        self.weighted_m2 = np.concatenate([self.weighted_m2, np.zeros(n_new)])
+        self.reservoir = np.concatenate(
+            [self.reservoir, np.zeros((n_new, self.reservoir_size), dtype=self.reservoir.dtype)])
+        self.reservoir_weights = np.concatenate(
+            [self.reservoir_weights, np.zeros((n_new, self.reservoir_size), dtype=self.reservoir_weights.dtype)])
+        self.n_points = n_points
+
+    def state(self) -> Mapping[str, np.array]:
+        """Accumulators and random state as a mapping of arrays
+        (e.g. to be saved with `np.savez`), see `from_state`."""
+        _, keys, position, has_gauss, cached_gaussian = self._rng.get_state()
+        return {
+            'version': np.array(STATE_VERSION),
+            'min': self.min,
+            'count': self.count,
+            'mean': self.running_mean,
+            'm2': self.m2,
+            'sum_weights': self.sum_weights,
+            'weighted_mean': self.running_weighted_mean,
+            'weighted_m2': self.weighted_m2,
+            'reservoir': self.reservoir,
+            'reservoir_weights': self.reservoir_weights,
+            'rng_keys': keys,
+            'rng_state': np.array([position, has_gauss, cached_gaussian]),
+        }
+
+    @classmethod
+    def from_state(cls, state: Mapping[str, np.array]):
+        """Restore a combiner from its `state`, continuing exactly where it stopped
+        (states of version 1 are converted, keeping precision lost in their sums of squares)."""
+        version = int(state['version']) if 'version' in state else 1
+        if version > STATE_VERSION:
+            raise ValueError('unsupported combiner state version: {}'.format(version))
+        reservoir = np.asarray(state['reservoir'])
+        combiner = cls(0, reservoir_size=reservoir.shape[1], dtype=reservoir.dtype)
+        combiner.n_points = len(reservoir)
+        combiner.min = np.array(state['min'])
+        combiner.count = np.array(state['count'])
+        combiner.reservoir = np.array(reservoir)
+        if version == STATE_VERSION:
+            combiner.running_mean = np.array(state['mean'])
+            combiner.m2 = np.array(state['m2'])
+            combiner.sum_weights = np.array(state['sum_weights'])
+            combiner.running_weighted_mean = np.array(state['weighted_mean'])
+            combiner.weighted_m2 = np.array(state['weighted_m2'])
+            combiner.reservoir_weights = np.array(state['reservoir_weights'])
+        else:
+            combiner.running_mean, combiner.m2 = _moments_from_sums(
+                combiner.count, state['sum'], state['sum_squares'])
+            if 'sum_weights' in state:
+                combiner.sum_weights = np.array(state['sum_weights'])
+                combiner.running_weighted_mean, combiner.weighted_m2 = _moments_from_sums(
+                    combiner.sum_weights, state['weighted_sum'], state['weighted_sum_squares'])
+                combiner.reservoir_weights = np.array(state['reservoir_weights'])
+            else:
+                # saved before predictions were weighted, i.e. all weights are 1
+                combiner.sum_weights = combiner.count.astype(np.float64)
+                combiner.running_weighted_mean = combiner.running_mean.copy()
+                combiner.weighted_m2 = combiner.m2.copy()
+                combiner.reservoir_weights = np.ones_like(combiner.reservoir)
+        position, has_gauss, cached_gaussian = state['rng_state']
+        combiner._rng.set_state(
+            ('MT19937', np.asarray(state['rng_keys']), int(position), int(has_gauss), float(cached_gaussian)))
+        return combiner
+
+    def mean(self) -> np.array:
+        return np.where(self.count > 0, self.running_mean, np.nan)
+
+    def variance(self) -> np.array:
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.m2 / self.count
+
+    def weighted_mean(self) -> np.array:
+        return np.where(self.sum_weights > 0, self.running_weighted_mean, np.nan)
+
+    def weighted_variance(self) -> np.array:
+        """Weighted variance of predictions of each point
+        (np.inf for points without predictions), see `weighted_variance`."""
+        with np.errstate(invalid='ignore', divide='ignore'):
+            variance = self.weighted_m2 / self.sum_weights
+        variance[self.count == 0] = np.inf
+        return variance
+
+    def variants(self) -> PredictionVariants:
+        """Predictions kept in reservoirs and their weights, grouped by point."""
+        n_kept = np.minimum(self.count, self.reservoir_size)
+        kept = np.arange(self.reservoir_size)[None, :] < n_kept[:, None]
+        indptr = np.concatenate([[0], np.cumsum(n_kept)])
+        return PredictionVariants(indptr, self.reservoir[kept], self.reservoir_weights[kept])
+
+    def finalize(self, aggregation_method='min') -> np.array:
+        """Compute a single prediction per point.
+
+        :param aggregation_method: one of `AGGREGATION_METHODS`
+        :return: an array of predictions (np.inf for points without predictions)
+        """
+        if aggregation_method in RESERVOIR_AGGREGATION_METHODS and self.reservoir_size == 0:
+            raise ValueError('{} aggregation requires reservoir_size > 0'.format(aggregation_method))
+        with get_tracer().span('combine.finalize', aggregation_method=aggregation_method):
+            if aggregation_method == 'min':
+                return self.min.copy()
+            if aggregation_method == 'weighted_mean':
+                fused_predictions = np.full(self.n_points, np.inf, dtype=self.min.dtype)
+                has_values = self.count > 0
+                fused_predictions[has_values] = self.weighted_mean()[has_values]
+                return fused_predictions
+            return aggregate_variants(self.variants(), aggregation_method=aggregation_method)
 
 
 def combine_predictions(
         n_points: int,
         list_predictions: List[np.array],
         list_indexes_in_whole: List[np.array],
-        list_points: List[np.array],
+        list_points: List[np.array] = None,
         aggregation_method='min',
         postprocessing=None,
-) -> Tuple[np.array, Mapping]:
+        list_weights: List[np.array] = None,
+) -> Tuple[np.array, PredictionVariants]:
 
     """Given a point cloud with more than one distance-to-feature
     prediction per each of the 3D points, compute a single
@@ -21,43 +459,39 @@ def combine_predictions(
     :param n_points: total number of points in a point cloud
     :param list_predictions: list of numpy arrays corresponding to
         predictions in each 3D point
-    :param list_indexes_in_whole:
-    :param list_points:
-    :return: a list of predictions
+    :param list_indexes_in_whole: list of numpy arrays of indexes
+        of the predicted points into the whole point cloud
+    :param list_points: deprecated and ignored (points are not needed
+        to combine predictions); kept so that positional arguments
+        of existing calls keep their meaning
+    :param list_weights: list of numpy arrays of confidence weights
+        of predictions (used by weighted aggregations), all 1 if None
+    :return: a list of predictions and all predictions grouped by point
     """
 
-    fused_predictions = np.ones(n_points) * np.inf
+    if None is not list_points:
+        warnings.warn('list_points is deprecated and ignored by combine_predictions',
+                      DeprecationWarning, stacklevel=2)
+
+    tracer = get_tracer()
 
     # step 1: gather predictions
-    
-    predictions_variants = defaultdict(list)
-    iterable = zip(list_predictions, list_indexes_in_whole, list_points)
-    for distances, indexes_gt, points_gt in tqdm(iterable):
-        for i, idx in enumerate(indexes_gt):
-            predictions_variants[idx].append(distances[i])
+    with tracer.span('combine.gather', n_points=n_points) as span:
+        predictions_variants = PredictionVariants.from_lists(
+            n_points,
+            list_predictions,
+            list_indexes_in_whole,
+            sort_values=False,
+            list_weights=list_weights)
+        span.update(n_predictions=len(predictions_variants.values))
 
     # step 2: consolidate predictions
-    for idx, values in predictions_variants.items():
-        if aggregation_method == 'min':
-            fused_predictions[idx] = np.min(values)
-        elif aggregation_method == 'truncated_min':
-            # Truncated average/min, computed by removing the
-            # largest and smallest 20% of values, then computing the
-            # corresponding quantity.
-            values = np.sort(values)
-            values = values[int(0.2*len(values)):int(0.8*len(values))]
-            fused_predictions[idx] = np.min(values)
-        elif aggregation_method == 'truncated_median':
-            values = np.sort(values)
-            values = values[int(0.2*len(values)):int(0.8*len(values))]
-            fused_predictions[idx] = np.median(values)
-        elif aggregation_method == 'truncated_mean':
-            values = np.sort(values)
-            values = values[int(0.2*len(values)):int(0.8*len(values))]
-            fused_predictions[idx] = np.mean(values)
-
-        # if postprocessing is not None:
-        #     if postprocessing == 'L2':
-                
+    with tracer.span('combine.aggregate', aggregation_method=aggregation_method):
+        fused_predictions = aggregate_variants(
+            predictions_variants,
+            aggregation_method=aggregation_method)
+
+    # if postprocessing is not None:
+    #     if postprocessing == 'L2':
 
     return fused_predictions, predictions_variants
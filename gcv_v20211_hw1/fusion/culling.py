@@ -0,0 +1,126 @@
+import itertools
+
+import numpy as np
+
+
+class ViewBounds:
+    def __init__(self, camera_min, camera_max, n_points):
+        """Axis-aligned bounding box of points of a view in its camera frame.
+
+        :param camera_min: 3d minimum corner of points in camera frame
+            (i.e. (u, v) in image plane and depth)
+        :param camera_max: 3d maximum corner of points in camera frame
+        :param n_points: number of points of the view
+        """
+        self.camera_min = camera_min
+        self.camera_max = camera_max
+        self.n_points = n_points
+
+    @classmethod
+    def from_image(cls, image, imaging, pixel_indexes=None):
+        """Compute bounds of foreground pixels of a depth image
+        (without constructing points of the view in world frame).
+
+        :param pixel_indexes: precomputed linear indexes of foreground pixels
+            (see `PointIndex`), found in the image if None
+        """
+        points_in_camera = imaging.image_to_points(image, pixel_indexes=pixel_indexes)
+        if len(points_in_camera) == 0:
+            return cls(np.full(3, np.inf), np.full(3, -np.inf), 0)
+        return cls(points_in_camera.min(axis=0), points_in_camera.max(axis=0), len(points_in_camera))
+
+    @classmethod
+    def from_view(cls, view):
+        """Compute bounds of a view tuple (as returned by `get_view`)."""
+        image_i, _, _, _, imaging_i = view
+        return cls.from_image(image_i, imaging_i)
+
+    @property
+    def corners(self):
+        """[8, 3] array of corners of the bounding box in camera frame."""
+        return np.array(list(itertools.product(*zip(self.camera_min, self.camera_max))))
+
+
+class CullingReport:
+    def __init__(self):
+        """Counts of view pairs and points skipped by `PairCuller`."""
+        self.n_pairs = 0
+        self.n_pairs_culled = 0
+        self.n_points = 0
+        self.n_points_culled = 0
+
+    def as_dict(self):
+        return {
+            'n_pairs': self.n_pairs,
+            'n_pairs_culled': self.n_pairs_culled,
+            'n_points': self.n_points,
+            'n_points_culled': self.n_points_culled,
+        }
+
+    def __str__(self):
+        return 'culled {} of {} view pairs and {} of {} points'.format(
+            self.n_pairs_culled, self.n_pairs, self.n_points_culled, self.n_points)
+
+
+class PairCuller:
+    def __init__(self, view_cache, n_views, margin, report=None):
+        """Cheap precheck of overlap between pairs of views, run before
+        reprojection and neighbour search, from camera poses and bounding
+        boxes of points of views only (no points are reprojected).
+
+        A point of view j can only be interpolated from view i if it lies
+        within `margin` of the pixels of view i it is interpolated from,
+        so a pair is skipped if, in the camera frame of view i, the bounding box
+        of points of view j (an oriented box, placed using relative pose
+        of cameras computed from their frame axes and origins) does not overlap
+        the bounding box of points of view i expanded by `margin`,
+        or vice versa in the camera frame of view j.
+        Background pixels are disregarded, as they lie in the image plane
+        of view i, far from points of the captured object.
+
+        :param view_cache: `ViewCache` of views (only its depth images,
+            poses and imaging parameters are used)
+        :param n_views: number of views
+        :param margin: distance threshold used for interpolation
+        :param report: `CullingReport` to count skipped pairs and points in
+        """
+        self.view_cache = view_cache
+        self.margin = margin
+        self.report = report if None is not report else CullingReport()
+        self.bounds = []
+        self.extend(n_views)
+
+    def extend(self, n_views):
+        """Compute bounds of views added since the culler was created
+        or last extended, so that it can be kept while views are added."""
+        point_index = self.view_cache.point_index
+        for i in range(len(self.bounds), n_views):
+            intrinsics_i = self.view_cache.intrinsics_dict[i]
+            imaging_i = self.view_cache.imaging(intrinsics_i['resolution_image'], intrinsics_i['resolution_3d'])
+            pixel_indexes_i = point_index.pixel_indexes[i] \
+                if None is not point_index and i < point_index.n_views else None
+            self.bounds.append(ViewBounds.from_image(self.view_cache.images[i], imaging_i, pixel_indexes_i))
+
+    def _box_overlaps(self, i, j):
+        """Check if bounding box of view j, transformed to camera frame
+        of view i, overlaps bounding box of view i expanded by `margin`."""
+        pose_i, pose_j = self.view_cache.poses[i], self.view_cache.poses[j]
+        # camera frame of view j -> camera frame of view i
+        rotation = pose_i.frame_axes.dot(pose_j.frame_axes.T)
+        translation = pose_i.frame_axes.dot(pose_j.frame_origin - pose_i.frame_origin)
+        corners_j_in_i = self.bounds[j].corners.dot(rotation.T) + translation
+        return np.all(corners_j_in_i.max(axis=0) >= self.bounds[i].camera_min - self.margin) and \
+            np.all(corners_j_in_i.min(axis=0) <= self.bounds[i].camera_max + self.margin)
+
+    def overlaps(self, i, j):
+        """Check if any points of view j can possibly be interpolated from view i,
+        counting the pair (and points of view j) as culled in the report otherwise."""
+        n_points_j = self.bounds[j].n_points
+        overlaps = n_points_j > 0 and self.bounds[i].n_points > 0 and \
+            self._box_overlaps(i, j) and self._box_overlaps(j, i)
+
+        self.report.n_pairs += 1
+        self.report.n_pairs_culled += int(not overlaps)
+        self.report.n_points += n_points_j
+        self.report.n_points_culled += 0 if overlaps else n_points_j
+        return overlaps
@@ -0,0 +1,336 @@
+import numpy as np
+
+from gcv_v20211_hw1.fusion.batch_interpolation import BILINEAR_METHODS, INTERPOLATION_METHODS
+from gcv_v20211_hw1.utils.camera_utils.sparse_image import SparseImage
+
+# numba is optional: without it, `fused_interpolate` is unavailable
+# and the 'numba' engine falls back to the 'batch' one
+try:
+    import numba
+except ImportError:
+    numba = None
+
+if None is not numba:
+    _njit = numba.njit(cache=True, nogil=True)
+    _njit_parallel = numba.njit(cache=True, nogil=True, parallel=True)
+    _prange = numba.prange
+else:
+    def _njit(function):
+        return function
+    _njit_parallel = _njit
+    _prange = range
+
+_BILINEAR, _BARYCENTRIC, _IDW = 0, 1, 2
+_METHOD_CODES = dict([(method, _BILINEAR) for method in BILINEAR_METHODS] + [
+    ('barycentric', _BARYCENTRIC), ('idw', _IDW)])
+
+# one-sided Jacobi SVD converges in a handful of sweeps for small matrices
+_MAX_SWEEPS = 32
+_EPS = np.finfo(np.float64).eps
+
+
+@_njit
+def _least_squares_weights(design, query, rcond, u, v, weights):
+    """Weights `query @ pinv(design)` of a least-squares fit evaluated
+    at a query point, computed via one-sided Jacobi SVD of the [k, m]
+    design matrix (dropping small singular values as
+    `batch_interpolation._least_squares_weights` does).
+
+    `u` ([k, m]) and `v` ([m, m]) are scratch arrays; [k, ] `weights` are written in place.
+    """
+    k, m = design.shape
+    u[:, :] = design
+    v[:, :] = 0.
+    for a in range(m):
+        v[a, a] = 1.
+
+    for _ in range(_MAX_SWEEPS):
+        rotated = False
+        for p in range(m - 1):
+            for q in range(p + 1, m):
+                alpha, beta, gamma = 0., 0., 0.
+                for r in range(k):
+                    alpha += u[r, p] * u[r, p]
+                    beta += u[r, q] * u[r, q]
+                    gamma += u[r, p] * u[r, q]
+                if abs(gamma) <= _EPS * np.sqrt(alpha * beta):
+                    continue
+                rotated = True
+                zeta = (beta - alpha) / (2. * gamma)
+                t = (1. if zeta >= 0. else -1.) / (abs(zeta) + np.sqrt(1. + zeta * zeta))
+                c = 1. / np.sqrt(1. + t * t)
+                s = c * t
+                for r in range(k):
+                    u_p, u_q = u[r, p], u[r, q]
+                    u[r, p], u[r, q] = c * u_p - s * u_q, s * u_p + c * u_q
+                for r in range(m):
+                    v_p, v_q = v[r, p], v[r, q]
+                    v[r, p], v[r, q] = c * v_p - s * v_q, s * v_p + c * v_q
+        if not rotated:
+            break
+
+    # singular values are norms of the orthogonalized columns
+    s_max = 0.
+    for j in range(m):
+        s_squared = 0.
+        for r in range(k):
+            s_squared += u[r, j] * u[r, j]
+        s_max = max(s_max, np.sqrt(s_squared))
+    weights[:] = 0.
+    for j in range(m):
+        s_squared = 0.
+        for r in range(k):
+            s_squared += u[r, j] * u[r, j]
+        if np.sqrt(s_squared) > rcond * s_max:
+            # (query . v_j) / s_j times the j-th left singular vector (u_j / s_j)
+            coefficient = 0.
+            for a in range(m):
+                coefficient += query[a] * v[a, j]
+            coefficient /= s_squared
+            for r in range(k):
+                weights[r] += coefficient * u[r, j]
+
+
+@_njit
+def _tensor_linear_basis(x, y, out):
+    out[0] = (1. - x) * (1. - y)
+    out[1] = x * (1. - y)
+    out[2] = (1. - x) * y
+    out[3] = x * y
+
+
+@_njit
+def _interpolation_weights(uv_nns, uv_query, method, rcond, design, query, u, v, uv_min, extent, weights):
+    """Weights of neighbours for a single point, see `batch_interpolation.interpolation_weights`.
+
+    `design` ([k, 4]), `query` ([4, ]), `u` ([k, 4]), `v` ([4, 4]), `uv_min` and `extent` ([2, ])
+    are scratch arrays; [k, ] `weights` are written in place.
+
+    :return: False if interpolation is ill-posed
+    """
+    k = len(uv_nns)
+    if method == _BILINEAR:
+        flat = False
+        for a in range(2):
+            uv_min[a] = uv_nns[:, a].min()
+            extent[a] = uv_nns[:, a].max() - uv_min[a]
+            if extent[a] == 0.:
+                flat = True
+                extent[a] = 1.
+        for r in range(k):
+            _tensor_linear_basis((uv_nns[r, 0] - uv_min[0]) / extent[0],
+                                 (uv_nns[r, 1] - uv_min[1]) / extent[1], design[r])
+        # clamped to the bounding box of neighbours, as in `batch_interpolation._bilinear_weights`
+        _tensor_linear_basis(min(max((uv_query[0] - uv_min[0]) / extent[0], 0.), 1.),
+                             min(max((uv_query[1] - uv_min[1]) / extent[1], 0.), 1.), query)
+        _least_squares_weights(design[:k, :4], query[:4], rcond, u[:k, :4], v[:4, :4], weights)
+        return k >= 4 and not flat
+
+    elif method == _BARYCENTRIC:
+        if k < 3:
+            weights[:] = 0.
+            return False
+        scale = 0.
+        for r in range(3):
+            for a in range(2):
+                scale = max(scale, abs(uv_nns[r, a] - uv_query[a]))
+        if scale == 0.:
+            scale = 1.
+        for r in range(3):
+            design[r, 0] = 1.
+            design[r, 1] = (uv_nns[r, 0] - uv_query[0]) / scale
+            design[r, 2] = (uv_nns[r, 1] - uv_query[1]) / scale
+        query[0], query[1], query[2] = 1., 0., 0.
+        weights[:] = 0.
+        _least_squares_weights(design[:3, :3], query[:3], rcond, u[:3, :3], v[:3, :3], weights[:3])
+        return True
+
+    else:  # method == _IDW
+        n_coincident = 0
+        for r in range(k):
+            distance = np.sqrt((uv_nns[r, 0] - uv_query[0]) ** 2 + (uv_nns[r, 1] - uv_query[1]) ** 2)
+            if distance < 1e-12:
+                n_coincident += 1
+                weights[r] = -1.
+            else:
+                weights[r] = 1. / distance ** 2
+        # points coinciding with a neighbour take its value directly
+        if n_coincident > 0:
+            for r in range(k):
+                weights[r] = 1. if weights[r] < 0. else 0.
+        weights /= weights.sum()
+        return True
+
+
+@_njit
+def _pixel_position(pixel, pixel_indexes, sparse):
+    """Position of a pixel in arrays of pixel values (-1 for a background pixel of a sparse image)."""
+    if not sparse:
+        return pixel
+    position = np.searchsorted(pixel_indexes, pixel)
+    if position < len(pixel_indexes) and pixel_indexes[position] == pixel:
+        return position
+    return -1
+
+
+@_njit_parallel
+def _fused_kernel(points_j, world_to_camera, uv_i, n_rows, n_cols, resolution_3d,
+                  depth_i, distances_i, pixel_indexes_i, sparse, k, radius,
+                  threshold, occlusion_tolerance, method, rcond, n_blocks,
+                  predictions, interpolated, nn_distances):
+    n = len(points_j)
+    block_size = (n + n_blocks - 1) // n_blocks
+    for block in _prange(n_blocks):
+        # per-thread scratch arrays, reused for all points of the block
+        nn_squared_distances = np.empty(k)
+        nn_indexes = np.empty(k, dtype=np.int64)
+        uv_nns = np.empty((k, 2))
+        values_nns = np.empty(k)
+        reprojected = np.empty(3)
+        design = np.empty((k, 4))
+        query = np.empty(4)
+        u = np.empty((k, 4))
+        v = np.empty((4, 4))
+        uv_min = np.empty(2)
+        extent = np.empty(2)
+        weights = np.empty(k)
+
+        for point in range(block * block_size, min(n, (block + 1) * block_size)):
+            predictions[point] = 0.
+            interpolated[point] = False
+            nn_distances[point] = 0.
+
+            # reproject into camera frame of view i
+            for a in range(3):
+                reprojected[a] = world_to_camera[a, 3]
+                for b in range(3):
+                    reprojected[a] += world_to_camera[a, b] * points_j[point, b]
+
+            # k nearest pixels in a window around the nearest pixel
+            # (see `RaycastingImaging.query_grid`), kept sorted by distance
+            row = n_rows / 2 - reprojected[0] / resolution_3d
+            col = n_cols / 2 - reprojected[1] / resolution_3d
+
+            # depth test against the nearest pixel (see `pairwise_interpolate_predictions`)
+            nearest_row = min(max(int(np.rint(row)), 0), n_rows - 1)
+            nearest_col = min(max(int(np.rint(col)), 0), n_cols - 1)
+            position = _pixel_position(nearest_row * n_cols + nearest_col, pixel_indexes_i, sparse)
+            depth = depth_i[position] if position >= 0 else 0.
+            if not abs(reprojected[2] - depth) < occlusion_tolerance:
+                continue
+
+            # window widened by the distance of the point to the image
+            clipped_row = min(max(row, 0.), n_rows - 1.)
+            clipped_col = min(max(col, 0.), n_cols - 1.)
+            d = np.sqrt((row - clipped_row) ** 2 + (col - clipped_col) ** 2)
+            half_window = min(int(np.ceil(radius + d - 0.5)), max(n_rows, n_cols))
+            window = 2 * half_window + 1
+            center_row = min(max(int(np.rint(clipped_row)), half_window), n_rows - 1 - half_window)
+            center_col = min(max(int(np.rint(clipped_col)), half_window), n_cols - 1 - half_window)
+            n_found = 0
+            for offset in range(window * window):
+                window_row = center_row - half_window + offset // window
+                window_col = center_col - half_window + offset % window
+                if window_row < 0 or window_row >= n_rows or window_col < 0 or window_col >= n_cols:
+                    continue
+                squared_distance = (window_row - row) ** 2 + (window_col - col) ** 2
+                if n_found == k and squared_distance >= nn_squared_distances[k - 1]:
+                    continue
+                r = min(n_found, k - 1)
+                while r > 0 and nn_squared_distances[r - 1] > squared_distance:
+                    nn_squared_distances[r] = nn_squared_distances[r - 1]
+                    nn_indexes[r] = nn_indexes[r - 1]
+                    r -= 1
+                nn_squared_distances[r] = squared_distance
+                nn_indexes[r] = window_row * n_cols + window_col
+                n_found = min(n_found + 1, k)
+            if n_found < k:
+                continue
+
+            # gather neighbours, checking they are all close to the reprojected point
+            close = True
+            distances_sum = 0.
+            for r in range(k):
+                pixel = nn_indexes[r]
+                depth, value = 0., 0.
+                position = _pixel_position(pixel, pixel_indexes_i, sparse)
+                if position >= 0:
+                    depth, value = depth_i[position], distances_i[position]
+                uv_nns[r, 0], uv_nns[r, 1], values_nns[r] = uv_i[pixel, 0], uv_i[pixel, 1], value
+                distance = np.sqrt((reprojected[0] - uv_nns[r, 0]) ** 2 +
+                                   (reprojected[1] - uv_nns[r, 1]) ** 2 +
+                                   (reprojected[2] - depth) ** 2)
+                if not distance < threshold:
+                    close = False
+                    break
+                distances_sum += distance
+            if not close:
+                continue
+            nn_distances[point] = distances_sum / k
+
+            if _interpolation_weights(uv_nns, reprojected[:2], method, rcond, design, query, u, v,
+                                      uv_min, extent, weights):
+                prediction = 0.
+                for r in range(k):
+                    prediction += weights[r] * values_nns[r]
+                predictions[point] = prediction
+                interpolated[point] = True
+
+
+def fused_interpolate(view_i, view_j, distance_interpolation_threshold, nn_set_size, method='bilin',
+                      occlusion_tolerance=None):
+    """Interpolate predictions from view_i into all points of view_j in a single
+    pass over points (compiled with numba and parallelised over CPU cores),
+    reprojecting each point, looking up its neighbours in the pixel grid of view_i,
+    checking their distances and interpolating, without intermediate [n, k] arrays.
+    Equivalent to the 'batch' engine with 'grid' neighbour search
+    (up to rounding, and the order of neighbours at exactly equal distances).
+
+    :param view_i: view tuple (as returned by `get_view`) to interpolate from
+    :param view_j: view tuple (as returned by `get_view`) to interpolate into
+    :param distance_interpolation_threshold: max distance from a reprojected
+        point to each of its neighbours for the point to be interpolated
+    :param nn_set_size: number of neighbours to interpolate from
+    :param method: one of `batch_interpolation.INTERPOLATION_METHODS`
+    :param occlusion_tolerance: max difference between depth of a reprojected
+        point and depth of view_i at its nearest pixel for the point
+        to be interpolated; `distance_interpolation_threshold` if None
+
+    :return: tuple of [n, ] predictions for all points of view_j,
+        [n, ] mask of interpolated points and [n, ] mean distances
+        to neighbours of interpolated points
+    """
+    if None is numba:
+        raise ImportError('numba is required for fused interpolation')
+    if method not in INTERPOLATION_METHODS:
+        raise ValueError('unknown interpolation method: {}'.format(method))
+
+    image_i, distances_i, _, pose_i, imaging_i = view_i
+    _, _, points_j, _, _ = view_j
+    if isinstance(image_i, SparseImage):
+        pixel_indexes_i, depth_i = image_i.indexes, image_i.values
+        distances_i = distances_i.values if isinstance(distances_i, SparseImage) \
+            else np.asarray(distances_i).reshape(-1)[pixel_indexes_i]
+    else:
+        pixel_indexes_i, depth_i = np.zeros(0, dtype=np.int64), np.asarray(image_i).reshape(-1)
+        distances_i = np.asarray(distances_i).reshape(-1)
+
+    # same windows as `RaycastingImaging.query_grid`
+    m = int(np.ceil(np.sqrt(nn_set_size) / 2))
+    radius = (2 * m - 1) * np.sqrt(2)
+    n_rows, n_cols = imaging_i.grid_shape
+
+    predictions = np.empty(len(points_j))
+    interpolated = np.empty(len(points_j), dtype=bool)
+    nn_distances = np.empty(len(points_j))
+    if len(points_j) > 0:
+        _fused_kernel(
+            points_j, np.asarray(pose_i.world_to_camera_4x4, dtype=np.float64), imaging_i.rays_origins,
+            n_rows, n_cols, float(imaging_i.resolution_3d),
+            depth_i, distances_i, pixel_indexes_i, isinstance(image_i, SparseImage),
+            nn_set_size, float(radius), float(distance_interpolation_threshold),
+            float(distance_interpolation_threshold if None is occlusion_tolerance else occlusion_tolerance),
+            _METHOD_CODES[method], 1e-8, min(len(points_j), 4 * numba.get_num_threads()),
+            predictions, interpolated, nn_distances)
+
+    return predictions.astype(np.result_type(distances_i.dtype, np.float32), copy=False), interpolated, nn_distances
@@ -0,0 +1,145 @@
+import json
+from typing import List, Tuple
+
+import numpy as np
+
+from gcv_v20211_hw1.fusion.combiners import StreamingCombiner
+from gcv_v20211_hw1.fusion.culling import CullingReport, PairCuller
+from gcv_v20211_hw1.fusion.interpolators import ViewCache, streaming_interpolate_predictions
+from gcv_v20211_hw1.fusion.parallel import pack_views, unpack_views
+from gcv_v20211_hw1.fusion.point_index import PointIndex
+from gcv_v20211_hw1.utils.instrumentation import get_tracer
+
+
+class IncrementalFusion:
+    def __init__(
+            self,
+            resolution_3d: float,
+            reservoir_size: int = 32,
+            seed: int = 0,
+            dtype=np.float64,
+            cull: bool = False,
+            **interpolation_params,
+    ):
+        """Fusion of predictions of views arriving one at a time
+        (e.g. additional scans of the same object), keeping per-point
+        accumulators (see `StreamingCombiner`) between views.
+
+        Adding a view only interpolates the 2V - 1 pairs of views involving it,
+        instead of all V^2 pairs, and only prepares the new view: prepared views,
+        their points' layout and culling bounds are kept between views.
+        Points of the new view are appended to the point cloud,
+        so points are ordered as in a full recompute,
+        and the 'min' aggregation is identical to that of a full recompute
+        (truncated aggregations are too, as long as no reservoir overflows).
+
+        :param resolution_3d: 3D resolution of scans
+        :param reservoir_size: number of predictions per point kept
+            for truncated aggregations
+        :param seed: seed for reservoir sampling
+        :param dtype: floating point type of kept predictions
+        :param cull: if True, skip pairs of views that cannot overlap,
+            counting them in `culling_report`
+        :param interpolation_params: parameters for interpolation procedure
+            (see `streaming_interpolate_predictions`; saved along with the fusion,
+            so these must be plain values)
+        """
+        self.resolution_3d = resolution_3d
+        self.interpolation_params = interpolation_params
+        self.culling_report = CullingReport() if cull else None
+        self.view_cache = ViewCache([], [], [], [], point_index=PointIndex([], []))
+        self.culler = None
+        if cull:
+            self.culler = PairCuller(
+                self.view_cache, 0,
+                margin=interpolation_params.get('distance_interpolation_threshold', 1.0),
+                report=self.culling_report)
+        self.points = np.zeros((0, 3), dtype=np.result_type(dtype, np.float32))
+        self.combiner = StreamingCombiner(0, reservoir_size=reservoir_size, seed=seed, dtype=dtype)
+
+    @property
+    def images(self) -> List:
+        return self.view_cache.images
+
+    @property
+    def distances(self) -> List:
+        return self.view_cache.distances
+
+    @property
+    def extrinsics(self) -> List:
+        return self.view_cache.extrinsics
+
+    @property
+    def n_views(self) -> int:
+        return len(self.images)
+
+    @property
+    def n_points(self) -> int:
+        return self.combiner.n_points
+
+    @property
+    def intrinsics_dict(self) -> List[dict]:
+        return self.view_cache.intrinsics_dict
+
+    def new_pairs(self) -> List[Tuple[int, int]]:
+        """Pairs (i, j) of views involving the most recently added view."""
+        new = self.n_views - 1
+        return [(i, new) for i in range(new + 1)] + [(new, j) for j in range(new)]
+
+    def add_view(self, image, distances, extrinsics):
+        """Add a view, folding in predictions interpolated between it and all views.
+
+        :param image: 2d depth image (dense or `SparseImage`)
+        :param distances: 2d distance-to-feature predictions
+        :param extrinsics: 4x4 camera extrinsic (camera->world) matrix
+        :return: [n, 3] array of points of the new view, appended to `points`
+        """
+        self._append_view(image, distances, extrinsics)
+        pairs = self.new_pairs()
+
+        with get_tracer().span('incremental.add_view', view=self.n_views - 1, n_pairs=len(pairs)):
+            _, _, points_new, _, _ = self.view_cache(self.n_views - 1)
+            self.points = np.concatenate([self.points, points_new])
+            self.combiner.resize(self.view_cache.point_index.n_points)
+            streaming_interpolate_predictions(
+                self.images, self.distances, self.extrinsics, self.intrinsics_dict,
+                self.combiner, pairs=pairs, view_cache=self.view_cache, pair_culler=self.culler,
+                **self.interpolation_params)
+
+        return points_new
+
+    def _append_view(self, image, distances, extrinsics):
+        self.view_cache.append(
+            image, distances, extrinsics, dict(resolution_image=image.shape, resolution_3d=self.resolution_3d))
+
+    def finalize(self, aggregation_method='min') -> np.array:
+        """Compute a single prediction per point (see `StreamingCombiner.finalize`)."""
+        return self.combiner.finalize(aggregation_method)
+
+    def save(self, filename):
+        """Save views and accumulators to an .npz file, see `load`."""
+        arrays = {'points': self.points}
+        if self.n_views > 0:
+            arrays.update({'views.' + name: array for name, array in
+                           pack_views(self.images, self.distances, self.extrinsics).items()})
+        arrays.update({'combiner.' + name: array for name, array in self.combiner.state().items()})
+        params = dict(resolution_3d=self.resolution_3d, cull=None is not self.culling_report,
+                      interpolation_params=self.interpolation_params)
+        np.savez(filename, params=json.dumps(params), **arrays)
+
+    @classmethod
+    def load(cls, filename):
+        """Restore a fusion saved by `save`, to continue adding views to it."""
+        with np.load(filename) as data:
+            params = json.loads(str(data['params']))
+            fusion = cls(params['resolution_3d'], cull=params['cull'], **params['interpolation_params'])
+            fusion.points = data['points']
+            fusion.combiner = StreamingCombiner.from_state(
+                {name[len('combiner.'):]: data[name] for name in data.files if name.startswith('combiner.')})
+            views = {name[len('views.'):]: data[name] for name in data.files if name.startswith('views.')}
+
+        if len(views) > 0:
+            images, distances = unpack_views(views)
+            for image, distances_i, extrinsics in zip(images, distances, views['extrinsics']):
+                fusion._append_view(image, distances_i, extrinsics)
+        return fusion
@@ -1,14 +1,29 @@
+import inspect
 import itertools
-from functools import partial
-from typing import List, Mapping, Tuple
+import warnings
+from collections import OrderedDict
+from typing import Iterator, List, Mapping, Tuple
 
 import numpy as np
-from scipy.spatial import cKDTree
-from scipy import interpolate
-from tqdm import tqdm
 
-from gcv_v20211_hw1.utils.camera_utils.camera_pose import CameraPose
-from gcv_v20211_hw1.utils.camera_utils.imaging import RaycastingImaging
+from gcv_v20211_hw1.fusion.batch_interpolation import BILINEAR_METHODS, interpolate_batch
+from gcv_v20211_hw1.fusion.combiners import StreamingCombiner
+from gcv_v20211_hw1.fusion.culling import CullingReport, PairCuller
+from gcv_v20211_hw1.fusion.pair_cache import PairCache, hash_view
+from gcv_v20211_hw1.fusion.point_index import PointIndex
+from gcv_v20211_hw1.utils.camera_utils.camera_pose import CameraPose, CameraPoseBatch
+from gcv_v20211_hw1.utils.camera_utils.imaging import RaycastingImaging, shared_imaging
+from gcv_v20211_hw1.utils.camera_utils.sparse_image import SparseImage, foreground_indexes, take_pixels
+from gcv_v20211_hw1.utils.instrumentation import get_tracer
+
+
+# Engines accepted by `pairwise_interpolate_predictions`.
+INTERPOLATION_ENGINES = ['batch', 'pointwise', 'numba']
+
+
+def _points_dtype(image):
+    # single precision images produce single precision points
+    return np.result_type(image.dtype, np.float32)
 
 
 def get_view(
@@ -16,94 +31,230 @@ def get_view(
         distances: List[np.array],
         extrinsics: List[np.array],
         intrinsics_dict: List[Mapping],
-        i):
-    """A helper function to conveniently prepare view information."""
+        i,
+        imaging_i: RaycastingImaging = None,
+        pose_i: CameraPose = None,
+        pixel_indexes_i: np.array = None):
+    """A helper function to conveniently prepare view information.
+
+    Depth images may be dense arrays or `SparseImage`s; for a sparse
+    depth image, distances of the view are returned as a `SparseImage`
+    sharing its foreground pixels (distances may be dense or sparse).
+    Points are computed in the floating point type of the depth image.
+
+    :param imaging_i: imaging to reuse for view i
+        (e.g. shared between views of the same resolution);
+        constructed from `intrinsics_dict[i]` if None
+    :param pose_i: precomputed camera pose of view i;
+        constructed from `extrinsics[i]` if None
+    :param pixel_indexes_i: precomputed linear indexes of foreground pixels
+        of view i (see `PointIndex`); found in the depth image if None
+    """
     image_i = images[i]  # [h, w]
     distances_image_i = distances[i]  # [h, w]
-    # Kill background for nicer visuals
-    distances_i = np.zeros_like(distances_image_i)
-    distances_i[np.nonzero(image_i)] = distances_image_i[np.nonzero(image_i)]
+    if isinstance(image_i, SparseImage):
+        distances_i = image_i.like(
+            take_pixels(distances_image_i, image_i.indexes).astype(image_i.values.dtype, copy=False))
+    else:
+        # Kill background for nicer visuals
+        if None is pixel_indexes_i:
+            pixel_indexes_i = foreground_indexes(image_i)
+        distances_i = np.zeros_like(distances_image_i)
+        distances_i.reshape(-1)[pixel_indexes_i] = take_pixels(distances_image_i, pixel_indexes_i)
 
     # TODO: write your code to constrict a world-frame point cloud from a depth image,
     #  using known intrinsic and extrinsic camera parameters.
     #  Hints: use the class `RaycastingImaging` to transform image to  points in camera frame,
     #  use the class `CameraPose` to transform image to points in world frame.
 
-    pose_i = CameraPose(extrinsics[i])
-    imaging_i = RaycastingImaging(intrinsics_dict[i]['resolution_image'], intrinsics_dict[i]['resolution_3d'])
-    points_i = pose_i.camera_to_world(imaging_i.image_to_points(image_i))
+    if None is pose_i:
+        pose_i = CameraPose(extrinsics[i])
+    if None is imaging_i:
+        imaging_i = RaycastingImaging(
+            intrinsics_dict[i]['resolution_image'], intrinsics_dict[i]['resolution_3d'],
+            dtype=_points_dtype(image_i))
+    points_i = pose_i.camera_to_world(imaging_i.image_to_points(image_i, pixel_indexes=pixel_indexes_i))
 
     return image_i, distances_i, points_i, pose_i, imaging_i
 
 
+class ViewCache:
+    def __init__(
+            self,
+            images: List[np.array],
+            distances: List[np.array],
+            extrinsics: List[np.array],
+            intrinsics_dict: List[Mapping],
+            max_bytes: int = 2 ** 30,
+            point_index: PointIndex = None,
+    ):
+        """Per-view cache of derived geometry (camera poses, ray grids,
+        masked distances, world-frame points), so that each view is prepared
+        by `get_view` once instead of for every pair of views it takes part in.
+
+        Ray grids are shared between all views of the same resolution
+        (and with other caches in the process, see `shared_imaging`).
+        Least recently used views are evicted when derived arrays
+        take more than `max_bytes` of memory.
+
+        :param images: list of 2d depth images
+        :param distances: list of 2d distance-to-feature predictions
+        :param extrinsics: list of 4x4 camera extrinsic (camera->world) matrices
+        :param intrinsics_dict: list of imaging parameters for parallel projection
+        :param max_bytes: memory budget for cached views (None for unlimited)
+        :param point_index: foreground pixels of views, so that views
+            are prepared without scanning depth images; found in images if None
+        """
+        self.images = images
+        self.distances = distances
+        self.extrinsics = extrinsics
+        self.intrinsics_dict = intrinsics_dict
+        self.max_bytes = max_bytes
+        self.point_index = point_index
+        self.nbytes = 0
+        self.hits, self.misses = 0, 0
+        self._views = OrderedDict()
+        # invert all extrinsics at once
+        self.poses = CameraPoseBatch(np.stack(extrinsics)) if len(extrinsics) > 0 else None
+
+    def imaging(self, resolution_image, resolution_3d, dtype=np.float64) -> RaycastingImaging:
+        return shared_imaging(resolution_image, resolution_3d, dtype=dtype)
+
+    @staticmethod
+    def _view_nbytes(view):
+        # depth images are owned by the caller, so only count derived arrays
+        _, distances_i, points_i, _, _ = view
+        return distances_i.nbytes + points_i.nbytes
+
+    def __call__(self, i):
+        """Return view tuple (as returned by `get_view`) for view i."""
+        if i in self._views:
+            self.hits += 1
+            self._views.move_to_end(i)
+            return self._views[i]
+
+        self.misses += 1
+        imaging_i = self.imaging(
+            self.intrinsics_dict[i]['resolution_image'],
+            self.intrinsics_dict[i]['resolution_3d'],
+            dtype=_points_dtype(self.images[i]))
+        view = get_view(
+            self.images, self.distances, self.extrinsics, self.intrinsics_dict, i,
+            imaging_i=imaging_i, pose_i=self.poses[i],
+            pixel_indexes_i=None if None is self.point_index else self.point_index.pixel_indexes[i])
+
+        self._views[i] = view
+        self.nbytes += self._view_nbytes(view)
+        # always keep the requested view, even if it alone exceeds the budget
+        while None is not self.max_bytes and self.nbytes > self.max_bytes and len(self._views) > 1:
+            _, evicted_view = self._views.popitem(last=False)
+            self.nbytes -= self._view_nbytes(evicted_view)
+
+        return view
+
+    def append(self, image, distances, extrinsics, intrinsics):
+        """Add a view after all others (e.g. a newly added scan),
+        keeping views prepared so far; indexes its points if `point_index` is set."""
+        self.images.append(image)
+        self.distances.append(distances)
+        self.extrinsics.append(extrinsics)
+        self.intrinsics_dict.append(intrinsics)
+        # inverting 4x4 matrices is cheap compared to preparing views
+        self.poses = CameraPoseBatch(np.stack(self.extrinsics))
+        if None is not self.point_index:
+            self.point_index.append(foreground_indexes(image), image.shape)
+
+    def clear(self):
+        self._views.clear()
+        self.nbytes = 0
+
+
 def interpolate_ground_truth(
         images: List[np.array],
         distances: List[np.array],
         extrinsics: List[np.array],
         intrinsics_dict: List[Mapping],
-):
-    # Partially specify view extraction parameters.
-    get_view_local = partial(get_view, images, distances, extrinsics, intrinsics_dict)
+        workers: int = 1,
+        point_index: PointIndex = None,
+) -> Tuple[np.array, np.array]:
+    """Fuse ground truth distances of views into a single point cloud.
 
-    fused_points_gt = []
-    fused_predictions_gt = []
-    for view_index in range(len(images)):
-        image_i, distances_i, points_i, pose_i, imaging_i = get_view_local(view_index)
-        fused_points_gt.append(points_i)
-        fused_predictions_gt.append(distances_i.ravel()[np.flatnonzero(image_i)])
+    Points of views are laid out as described by `point_index`, in the same order
+    as indexes of points produced by `iterate_pairwise_predictions`.
+    Output arrays are allocated once and filled view by view.
 
-    fused_points_gt = np.concatenate(fused_points_gt)
-    fused_predictions_gt = np.concatenate(fused_predictions_gt)
+    :param images: list of 2d depth images
+    :param distances: list of 2d ground truth distance-to-feature values
+    :param extrinsics: list of 4x4 camera extrinsic (camera->world) matrices
+    :param intrinsics_dict: list of imaging parameters for parallel projection
+    :param workers: number of threads to fill views in
+    :param point_index: layout of points of views (built from images if None;
+        pass the same one to `iterate_pairwise_predictions`)
 
-    return fused_points_gt, fused_predictions_gt
+    :return: tuple of [n, 3] points and [n, ] distances
+    """
+    with get_tracer().span('interpolate_ground_truth', n_views=len(images), workers=workers) as span:
+        # foreground pixels of each view determine where points of the view go
+        if None is point_index:
+            point_index = PointIndex.from_images(images)
+        pixel_indexes = point_index.pixel_indexes
+        n_points = point_index.n_points
+
+        # distances of sparse views are stored in the type of their depth images (see `get_view`)
+        points_dtype = np.result_type(np.float32, *[_points_dtype(image) for image in images])
+        distances_dtype = np.result_type(np.float32, *[
+            image.dtype if isinstance(image, SparseImage) else distances_i.dtype
+            for image, distances_i in zip(images, distances)])
+        fused_points_gt = np.empty((n_points, 3), dtype=points_dtype)
+        fused_distances_gt = np.empty(n_points, dtype=distances_dtype)
+        poses = CameraPoseBatch(np.stack(extrinsics)) if len(extrinsics) > 0 else None
+
+        def fill_view(i):
+            start, stop = point_index.view_range(i)
+            imaging_i = shared_imaging(
+                intrinsics_dict[i]['resolution_image'],
+                intrinsics_dict[i]['resolution_3d'],
+                dtype=_points_dtype(images[i]))
+            # points in camera frame (see `RaycastingImaging.image_to_points`),
+            # then transformed to world frame in place
+            points_i = fused_points_gt[start:stop]
+            points_i[:, :2] = imaging_i.rays_origins[pixel_indexes[i], :2]
+            points_i[:, 2] = take_pixels(images[i], pixel_indexes[i])
+            poses[i].camera_to_world(points_i, out=points_i)
+            fused_distances_gt[start:stop] = take_pixels(distances[i], pixel_indexes[i])
+
+        if workers > 1:
+            # numpy releases the GIL while copying and transforming points
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(workers) as executor:
+                list(executor.map(fill_view, range(len(images))))
+        else:
+            for i in range(len(images)):
+                fill_view(i)
 
+        span.update(n_points=n_points)
 
-def pairwise_interpolate_predictions(
-        view_i,
-        view_j,
-        indexes_j,
-        distance_interpolation_threshold: float = 1.0,
-        nn_set_size: int = 4,
-        method='bilin',
-):
-    # Extract view information from input variables
-    image_i, distances_i, points_i, pose_i, imaging_i = view_i
-    _, distances_j, points_j, _, _ = view_j
+    return fused_points_gt, fused_distances_gt
 
-    # Reproject points from view_j to view_i, to be able to interpolate in view_i.
-    # We are using parallel projection so this explicitly computes
-    # (u, v) coordinates for reprojected points (in image plane of view_i).
-    # TODO: your code here: use functions from CameraPose class
-    #  to transform `points_j` into coordinate frame of `view_i`
-    #pose = CameraPose(pose_i)
-    reprojected_j = pose_i.world_to_camera(points_j)
-    # print(reprojected_j.shape)
-
-    # For each reprojected point, find K nearest points in view_i,
-    # that are source points/pixels to interpolate from.
-    # We do this using imaging_i.rays_origins because these
-    # define (u, v) coordinates of points_i in the pixel grid of view_i.
-    # TODO: your code here: use cKDTree to find k=`nn_set_size` indexes of
-    #  nearest points for each of points from `reprojected_j`
-    uv_i = imaging_i.rays_origins[:, :2]
-    _, nn_indexes_in_i = cKDTree(uv_i).query(reprojected_j[:, :2], k=nn_set_size)
 
-    # Create interpolation mask: True for points which
-    # can be stably interpolated (i.e. they have K neighbours present
-    # within a predefined radius).
-    interp_mask = np.zeros(len(reprojected_j)).astype(bool)
-    # Distances to be produces as output.
-    distances_j_interp = np.zeros(len(points_j), dtype=float)
-
-    point_from_j_nns_all = np.concatenate([uv_i, image_i.reshape(-1, 1)], axis=1)
-    point_from_j_nns = point_from_j_nns_all[np.array(nn_indexes_in_i)]
-
-    distances_to_nearest = np.linalg.norm(reprojected_j[:, None, :] - point_from_j_nns, ord=2, axis=-1)
-    interp_mask = np.all(distances_to_nearest < distance_interpolation_threshold, axis=-1)
+def _interpolate_pointwise(
+        reprojected_j,
+        uv_i,
+        distances_nns_i,
+        nn_indexes_in_i,
+        interp_mask,
+        distances_j_interp,
+        method='bilin',
+):
+    """Reference implementation constructing an interpolator per point;
+    fills `distances_j_interp` and updates `interp_mask` in place.
 
-    distances_i = distances_i.reshape(-1)
+    `distances_nns_i` are [n, k] distances at neighbours `nn_indexes_in_i`.
+    """
+    # scipy is slow to import and only needed by this reference engine
+    from scipy import interpolate
 
-    for idx, point_from_j in tqdm(enumerate(reprojected_j)):
+    for idx, point_from_j in enumerate(reprojected_j):
         point_nn_indexes = nn_indexes_in_i[idx]
         # Build an [n, 3] array of XYZ coordinates for each reprojected point by taking
         # UV values from pixel grid and Z value from depth image.
@@ -127,10 +278,10 @@ def pairwise_interpolate_predictions(
                 #  in `view_i` (i.e. `distances_i`) into the point in `view_j`.
                 #  Use the interpolator to compute an interpolated distance value.
                 if method == 'bilin':
-                    interpolator = interpolate.interp2d(*uv_i[point_nn_indexes].T, distances_i[point_nn_indexes])
+                    interpolator = interpolate.interp2d(*uv_i[point_nn_indexes].T, distances_nns_i[idx])
                     distances_j_interp[idx] = interpolator(*point_from_j[:2])
                 elif method == 'bispline':
-                    tck = interpolate.bisplrep(*uv_i[point_nn_indexes].T, distances_i[point_nn_indexes], kx=1, ky=1)
+                    tck = interpolate.bisplrep(*uv_i[point_nn_indexes].T, distances_nns_i[idx], kx=1, ky=1)
                     distances_j_interp[idx] = interpolate.bisplev(*point_from_j[:2], tck)
 
             except ValueError as e:
@@ -139,74 +290,466 @@ def pairwise_interpolate_predictions(
                     idx=idx, what=str(e)))
                 interp_mask[idx] = False
 
-    points_interp = points_j[interp_mask]
+
+def prediction_weights(nn_distances: np.array, distance_interpolation_threshold: float) -> np.array:
+    """Confidence weights of interpolated predictions, inversely related
+    to the mean distance d from a reprojected point to the neighbours
+    it is interpolated from: 1 / (1 + d / distance_interpolation_threshold),
+    i.e. 1 for predictions of a view in its own points,
+    and between 1/2 and 1 for interpolated ones."""
+    return 1. / (1. + nn_distances / distance_interpolation_threshold)
+
+
+def pairwise_interpolate_predictions(
+        view_i,
+        view_j,
+        indexes_j,
+        distance_interpolation_threshold: float = 1.0,
+        nn_set_size: int = 4,
+        method='bilin',
+        engine='batch',
+        nn_search='grid',
+        chunk_size: int = None,
+        occlusion_tolerance: float = None,
+):
+    """Interpolate predictions from view_i into points of view_j.
+
+    :param view_i: view tuple (as returned by `get_view`) to interpolate from
+    :param view_j: view tuple (as returned by `get_view`) to interpolate into
+    :param indexes_j: indexes of points of view_j into global set of points
+    :param distance_interpolation_threshold: max distance from a reprojected
+        point to each of its neighbours for the point to be interpolated
+    :param nn_set_size: number of neighbours to interpolate from
+    :param method: one of `batch_interpolation.INTERPOLATION_METHODS`
+    :param engine: 'batch' to interpolate all points in one vectorized pass,
+        'pointwise' to construct a scipy interpolator per point
+        (slow, only supports 'bilin' and 'bispline' methods),
+        'numba' to process each point in a single pass of a compiled kernel
+        parallelised over CPU cores (see `fused_interpolate`; only supports
+        'grid' neighbour search, falls back to 'batch' if numba is not installed)
+    :param nn_search: 'grid' to look up neighbours directly in the pixel grid
+        of view_i, 'kdtree' to search them using a cKDTree
+    :param chunk_size: number of points of view_j to process at once,
+        bounding memory used for reprojected points and their neighbours
+        (regardless of image resolution); all points at once if None
+    :param occlusion_tolerance: max difference between depth of a reprojected
+        point and depth of view_i at its nearest pixel for the point
+        to be interpolated, checked before neighbour search;
+        `distance_interpolation_threshold` if None (only skipping points
+        the distance check would reject anyway), smaller values also reject
+        points hidden close behind surfaces seen in view_i (e.g. thin walls)
+
+    :return: tuple of interpolated predictions, their indexes
+        (the subset of `indexes_j` of points that were interpolated)
+        and their confidence weights (see `prediction_weights`)
+    """
+    if engine not in INTERPOLATION_ENGINES:
+        raise ValueError('unknown interpolation engine: {}'.format(engine))
+    if engine == 'pointwise' and method not in BILINEAR_METHODS:
+        raise ValueError('method {} is not supported by pointwise engine'.format(method))
+    if nn_search not in ['grid', 'kdtree']:
+        raise ValueError('unknown neighbour search: {}'.format(nn_search))
+    if engine == 'numba' and nn_search != 'grid':
+        raise ValueError('numba engine only supports grid neighbour search')
+    if None is occlusion_tolerance:
+        occlusion_tolerance = distance_interpolation_threshold
+
+    if engine == 'numba':
+        # numba takes a while to import, so only do it when asked to
+        from gcv_v20211_hw1.fusion.fused_interpolation import fused_interpolate, numba
+        if None is not numba:
+            predictions, interp_mask, nn_distances = fused_interpolate(
+                view_i, view_j, distance_interpolation_threshold, nn_set_size, method=method,
+                occlusion_tolerance=occlusion_tolerance)
+            weights = prediction_weights(nn_distances[interp_mask], distance_interpolation_threshold)
+            return predictions[interp_mask], indexes_j[interp_mask], weights.astype(predictions.dtype, copy=False)
+        warnings.warn('numba is not installed, falling back to batch interpolation engine')
+        engine = 'batch'
+
+    # Extract view information from input variables
+    image_i, distances_i, points_i, pose_i, imaging_i = view_i
+    _, distances_j, points_j, _, _ = view_j
+    n_points_j = len(points_j)
+    chunk_size = max(1, n_points_j if None is chunk_size else min(chunk_size, n_points_j))
+
+    # (u, v) coordinates of points_i in the pixel grid of view_i.
+    uv_i = imaging_i.rays_origins[:, :2]
+    if nn_search == 'kdtree':
+        from scipy.spatial import cKDTree
+        tree_i = cKDTree(uv_i)
+
+    # Outputs are the only arrays proportional to the number of points of view_j;
+    # per-point intermediate results (including k neighbours for each point)
+    # are computed for a chunk of points at a time in reused scratch buffers.
+    points_dtype = np.result_type(points_j.dtype, np.float32)
+    reprojected_buffer = np.empty((chunk_size, 3), dtype=points_dtype)
+    nns_buffer = np.empty((chunk_size, nn_set_size, 3),
+                          dtype=np.result_type(points_dtype, uv_i.dtype, image_i.dtype))
+    distances_to_nearest_buffer = np.empty((chunk_size, nn_set_size), dtype=nns_buffer.dtype)
+    # Create interpolation mask: True for points which
+    # can be stably interpolated (i.e. they have K neighbours present
+    # within a predefined radius).
+    interp_mask = np.zeros(n_points_j, dtype=bool)
+    # Distances to be produces as output.
+    distances_j_interp = np.zeros(n_points_j, dtype=np.result_type(distances_i.dtype, np.float32))
+    # Mean distances to neighbours, defining confidence of predictions.
+    nn_distances_j = np.zeros(n_points_j, dtype=distances_to_nearest_buffer.dtype)
+
+    for start in range(0, n_points_j, chunk_size):
+        stop = min(start + chunk_size, n_points_j)
+        n_chunk = stop - start
+
+        # Reproject points from view_j to view_i, to be able to interpolate in view_i.
+        # We are using parallel projection so this explicitly computes
+        # (u, v) coordinates for reprojected points (in image plane of view_i).
+        reprojected_j = pose_i.world_to_camera(points_j[start:stop], out=reprojected_buffer[:n_chunk])
+
+        # Depth test: with parallel projection, the depth image of view_i is its
+        # z-buffer (holding depth of the surface first hit by each ray), and
+        # the nearest pixel of a reprojected point is one of its neighbours.
+        # Points whose depth is far from that of their nearest pixel (e.g. hidden
+        # behind the surface seen in view_i) would fail the distance check,
+        # so drop them with a single lookup before gathering neighbours.
+        depth_nearest = take_pixels(image_i, imaging_i.nearest_pixel(reprojected_j[:, :2]))
+        visible = np.abs(reprojected_j[:, 2] - depth_nearest) < occlusion_tolerance
+        n_visible = int(np.count_nonzero(visible))
+        if 0 == n_visible:
+            continue
+        # positions of remaining points among points of view_j
+        chunk = slice(start, stop)
+        if n_visible < n_chunk:
+            chunk = start + np.flatnonzero(visible)
+            reprojected_j = reprojected_j[visible]
+
+        # For each reprojected point, find K nearest points in view_i,
+        # that are source points/pixels to interpolate from.
+        # Rays lie on a regular grid, so neighbours can be looked up
+        # directly instead of building a cKDTree per pair of views.
+        if nn_search == 'grid':
+            _, nn_indexes_in_i = imaging_i.query_grid(reprojected_j[:, :2], k=nn_set_size)
+        else:
+            _, nn_indexes_in_i = tree_i.query(reprojected_j[:, :2], k=nn_set_size)
+        nn_indexes_in_i = nn_indexes_in_i.reshape(n_visible, nn_set_size)
+        distances_nns_i = take_pixels(distances_i, nn_indexes_in_i)
+
+        # XYZ coordinates of neighbours: UV values from pixel grid and
+        # Z value from depth image (which may be sparse, so only gather pixels of neighbours)
+        point_from_j_nns = nns_buffer[:n_visible]
+        point_from_j_nns[..., :2] = uv_i[nn_indexes_in_i]
+        point_from_j_nns[..., 2] = take_pixels(image_i, nn_indexes_in_i)
+
+        # Euclidean distances to neighbours, computed in place
+        np.subtract(reprojected_j[:, None, :], point_from_j_nns, out=point_from_j_nns)
+        np.square(point_from_j_nns, out=point_from_j_nns)
+        distances_to_nearest = np.sum(point_from_j_nns, axis=-1, out=distances_to_nearest_buffer[:n_visible])
+        np.sqrt(distances_to_nearest, out=distances_to_nearest)
+        interp_mask_chunk = np.all(distances_to_nearest < distance_interpolation_threshold, axis=-1)
+        nn_distances_j[chunk] = np.mean(distances_to_nearest, axis=-1)
+        predictions_chunk = np.zeros(n_visible, dtype=distances_j_interp.dtype)
+
+        if engine == 'batch':
+            # Interpolate all points of the chunk passing the distance check
+            # in one pass over their neighbourhoods.
+            nn_indexes_masked = nn_indexes_in_i[interp_mask_chunk]
+            predictions_masked, interpolated = interpolate_batch(
+                uv_i[nn_indexes_masked],
+                distances_nns_i[interp_mask_chunk],
+                reprojected_j[interp_mask_chunk, :2],
+                method=method)
+            predictions_chunk[interp_mask_chunk] = predictions_masked
+            interp_mask_chunk[interp_mask_chunk] = interpolated
+        else:
+            _interpolate_pointwise(
+                reprojected_j, uv_i, distances_nns_i, nn_indexes_in_i,
+                interp_mask_chunk, predictions_chunk, method=method)
+
+        interp_mask[chunk] = interp_mask_chunk
+        distances_j_interp[chunk] = predictions_chunk
+
     indexes_interp = indexes_j[interp_mask]
     predictions_interp = distances_j_interp[interp_mask]
+    weights_interp = prediction_weights(
+        nn_distances_j[interp_mask], distance_interpolation_threshold).astype(predictions_interp.dtype, copy=False)
 
-    return predictions_interp, indexes_interp, points_interp
+    return predictions_interp, indexes_interp, weights_interp
 
 
-def multi_view_interpolate_predictions(
+def _pair_cache_params(interpolation_params: Mapping) -> Mapping:
+    # parameters of the interpolation (with defaults filled in)
+    # that affect its results, identifying pairs in a `PairCache`
+    arguments = inspect.signature(pairwise_interpolate_predictions).bind_partial(**interpolation_params)
+    arguments.apply_defaults()
+    return {name: value for name, value in arguments.arguments.items()
+            if name not in ['view_i', 'view_j', 'indexes_j', 'chunk_size']}
+
+
+def interpolate_pair(
+        get_view_local,
+        point_index: PointIndex,
+        i: int,
+        j: int,
+        **interpolation_params,
+) -> Tuple[np.array, np.array]:
+    """Interpolate predictions from view i into points of view j.
+
+    :param get_view_local: callable returning a view tuple given view index
+    :param point_index: layout of points of views in global set of points
+    :param i: index of view to interpolate from
+    :param j: index of view to interpolate into
+    :param interpolation_params: parameters for interpolation procedure
+
+    :return: tuple of interpolated predictions, indexes
+        of interpolated points into global set of points and confidence
+        weights of predictions (see `prediction_weights`)
+    """
+    # Indexes (for currently processed points_j) into global set of points
+    indexes_in_whole = point_index.global_indexes(j)
+
+    # Extract view information: view_i is a tuple
+    view_i, view_j = get_view_local(i), get_view_local(j)
+
+    if i == j:
+        # Simply add predictions from view_i into the result
+        image_i, distances_i, points_i, pose_i, imaging_i = view_i
+        predictions_interp, indexes_interp = \
+            take_pixels(distances_i, point_index.pixel_indexes[i]), indexes_in_whole
+        weights_interp = np.ones_like(predictions_interp)
+
+    else:
+        # Actually run interpolation to label points in view_j
+        # with predictions obtained by interpolating from view_i
+        predictions_interp, indexes_interp, weights_interp = pairwise_interpolate_predictions(
+            view_i,
+            view_j,
+            indexes_in_whole,
+            **interpolation_params)
+
+    return predictions_interp, indexes_interp, weights_interp
+
+
+def iterate_pairwise_predictions(
         images: List[np.array],
         distances: List[np.array],
         extrinsics: List[np.array],
         intrinsics_dict: List[Mapping],
+        workers: int = 1,
+        view_cache_bytes: int = 2 ** 30,
+        culling_report: CullingReport = None,
+        pairs: List[Tuple[int, int]] = None,
+        pair_cache: PairCache = None,
+        point_index: PointIndex = None,
+        view_cache: ViewCache = None,
+        pair_culler: PairCuller = None,
         **interpolation_params,
-) -> Tuple[List, List, List]:
-    """Interpolated predictions between views.
+) -> Iterator[Tuple[int, int, np.array, np.array, np.array]]:
+    """Interpolate predictions between views, yielding results
+    for each pair of views as soon as they are computed.
 
     :param images: list of 2d depth images
     :param distances: list of 2d distance-to-feature predictions
     :param extrinsics: list of 4x4 camera extrinsic (camera->world) matrices
     :param intrinsics_dict: list of imaging parameters for parallel projection
+    :param workers: number of processes to distribute pairs of views across
+        (results are yielded in the same order as with a single process)
+    :param view_cache_bytes: memory budget for caching prepared views
+        (per process, see `ViewCache`)
+    :param culling_report: if given, skip pairs of views that cannot overlap
+        (see `PairCuller`), counting them in the report
+    :param pairs: pairs (i, j) of views to interpolate from i into j
+        (e.g. only those involving a newly added view), all pairs if None
+    :param pair_cache: if given, load results of pairs of views from the cache
+        instead of interpolating them, and store results of the rest in it
+    :param point_index: layout of points of views in global set of points
+        (that of `view_cache` or built from images if None, see `interpolate_ground_truth`)
+    :param view_cache: prepared views of the same images to reuse
+        (e.g. kept between calls as views are added), a new `ViewCache` if None
+    :param pair_culler: culler of the same views to reuse instead of building
+        one for `culling_report` (extended with bounds of new views, see `PairCuller.extend`)
     :param interpolation_params: parameters for interpolation procedure
 
-    :return: tuple of interpolated predictions, indexes, and points
+    :return: iterator over tuples (i, j, predictions, indexes, weights)
+        of predictions interpolated from view i into points of view j,
+        indexes of these points into global set of points
+        (as returned by `interpolate_ground_truth`) and confidence weights
+        of predictions (see `prediction_weights`)
     """
-    # Partially specify view extraction parameters.
-    get_view_local = partial(get_view, images, distances, extrinsics, intrinsics_dict)
-
-    # Prepare output arrays
-    list_predictions = []  # list of 1-d predictions (List[array.shape==[n, ])
-    list_indexes_in_whole = []  # list of indexes into global set of points (List[array.shape==[n, ])
-    list_points = []  # list of 3-d points (List[array.shape==[n, 3])
-
     # 0 to n-1 indexes into global set of points for an object
-    point_indexes = np.cumsum([len(np.flatnonzero(image)) for image in images])
+    if None is point_index and None is not view_cache:
+        point_index = view_cache.point_index
+    if None is point_index:
+        point_index = PointIndex.from_images(images)
 
     # Iterate over each pair of depth images, trying to interpolate
     # from view i into view j
     n_images = len(images)
-    print(f'NUMBER OF IMAGES: {len(images)}')
-
-    for i, j in itertools.product(range(n_images), range(n_images)):
-        print(f'Pair {i} {j}')
-        # Extract view information: view_i is a tuple
-        view_i, view_j = get_view_local(i), get_view_local(j)
+    tracer = get_tracer()
+    if None is pairs:
+        pairs = list(itertools.product(range(n_images), range(n_images)))
+    tracer.event('interpolate_predictions', n_views=n_images, n_pairs=len(pairs), workers=workers)
+
+    # Prepare each view once, reusing it across pairs.
+    get_view_local = view_cache
+    if None is get_view_local:
+        get_view_local = ViewCache(
+            images, distances, extrinsics, intrinsics_dict, max_bytes=view_cache_bytes, point_index=point_index)
+
+    # Skip pairs of views that cannot overlap, checked up front
+    # as it only takes poses and bounding boxes of views
+    culler = pair_culler
+    if None is not culler:
+        culler.extend(n_images)
+    elif None is not culling_report:
+        culler = PairCuller(
+            get_view_local, n_images,
+            margin=interpolation_params.get('distance_interpolation_threshold', 1.0),
+            report=culling_report)
+    culled = set()
+    if None is not culler:
+        culled = {(i, j) for i, j in pairs if i != j and not culler.overlaps(i, j)}
+
+    # Look up pairs of views in the cache (predictions of a view into
+    # itself are simply copied, so are not worth caching)
+    pair_keys, cached = {}, set()
+    if None is not pair_cache:
+        view_keys = [hash_view(*view) for view in zip(images, distances, extrinsics, intrinsics_dict)]
+        key_params = _pair_cache_params(interpolation_params)
+        pair_keys = {(i, j): pair_cache.key(view_keys[i], view_keys[j], key_params)
+                     for i, j in pairs if i != j and (i, j) not in culled}
+        cached = {pair for pair, key in pair_keys.items() if key in pair_cache}
+    tasks = [pair for pair in pairs if pair not in cached and pair not in culled]
+
+    if workers > 1:
+        from gcv_v20211_hw1.fusion.parallel import parallel_interpolate_pairs
+        pairwise_predictions = parallel_interpolate_pairs(
+            images, distances, extrinsics, intrinsics_dict, point_index, tasks,
+            workers=workers, view_cache_bytes=view_cache_bytes, **interpolation_params)
+
+    else:
+        pairwise_predictions = (
+            interpolate_pair(get_view_local, point_index, i, j, **interpolation_params)
+            for i, j in tasks)
+
+    pairwise_predictions = iter(pairwise_predictions)
+    for i, j in pairs:
+        # time spent waiting for results of the pair
+        # (computing them, unless they come from worker processes)
+        with tracer.span('interpolate_pair', i=i, j=j, cached=(i, j) in cached, culled=(i, j) in culled) as span:
+            start_j, stop_j = point_index.view_range(j)
+            n_points_j = stop_j - start_j
+            if (i, j) in culled:
+                predictions_interp, indexes_interp, weights_interp = \
+                    np.zeros(0), point_index.global_indexes(j)[:0], np.zeros(0)
+            elif (i, j) in cached:
+                predictions_interp, indexes_in_j, weights_interp = pair_cache.load(pair_keys[i, j])
+                indexes_interp = start_j + indexes_in_j
+            else:
+                predictions_interp, indexes_interp, weights_interp = next(pairwise_predictions)
+                if (i, j) in pair_keys:
+                    pair_cache.save(pair_keys[i, j], predictions_interp, indexes_interp - start_j, weights_interp)
+            span.update(n_points=n_points_j, n_interpolated=len(indexes_interp))
+        if tracer.enabled:
+            tracer.count('points_processed', n_points_j)
+            tracer.count('points_interpolated', len(indexes_interp))
+        yield i, j, predictions_interp, indexes_interp, weights_interp
+
+    if tracer.enabled:
+        tracer.event('view_cache', hits=get_view_local.hits, misses=get_view_local.misses,
+                     nbytes=get_view_local.nbytes)
+        if None is not pair_cache:
+            tracer.event('pair_cache', hits=len(cached), misses=len(pair_keys) - len(cached))
 
-        # Construct list of indexes (for currently processed points_j)
-        # into global set of points for view_i
-        start_idx, end_idx = (0, point_indexes[j]) if 0 == j \
-            else (point_indexes[j - 1], point_indexes[j])
-        indexes_in_whole = np.arange(start_idx, end_idx)
 
-        if i == j:
-            # Simply add predictions from view_i into the result
-            image_i, distances_i, points_i, pose_i, imaging_i = view_i
-            predictions_interp, indexes_interp, points_interp = \
-                distances_i[image_i != 0.].ravel(), indexes_in_whole, points_i
+def multi_view_interpolate_predictions(
+        images: List[np.array],
+        distances: List[np.array],
+        extrinsics: List[np.array],
+        intrinsics_dict: List[Mapping],
+        workers: int = 1,
+        return_points: bool = True,
+        return_weights: bool = False,
+        **interpolation_params,
+) -> Tuple[List, ...]:
+    """Interpolated predictions between views.
 
-        else:
-            # Actually run interpolation to label points in view_j
-            # with predictions obtained by interpolating from view_i
-            predictions_interp, indexes_interp, points_interp = pairwise_interpolate_predictions(
-                view_i,
-                view_j,
-                indexes_in_whole,
-                **interpolation_params)
+    :param images: list of 2d depth images
+    :param distances: list of 2d distance-to-feature predictions
+    :param extrinsics: list of 4x4 camera extrinsic (camera->world) matrices
+    :param intrinsics_dict: list of imaging parameters for parallel projection
+    :param workers: number of processes to distribute pairs of views across
+    :param return_points: if True, return copies of interpolated points
+        of each pair of views; these are `points[indexes]` for points returned
+        by `interpolate_ground_truth`, so pass False to avoid keeping them
+    :param return_weights: if True, also return confidence weights
+        of predictions (see `prediction_weights`)
+    :param interpolation_params: parameters for interpolation procedure
 
+    :return: tuple of lists of interpolated predictions, indexes
+        of interpolated points into global set of points, interpolated points
+        (None if not `return_points`) and, if `return_weights`,
+        confidence weights of predictions
+    """
+    # Prepare output arrays
+    list_predictions = []  # list of 1-d predictions (List[array.shape==[n, ])
+    list_indexes_in_whole = []  # list of indexes into global set of points (List[array.shape==[n, ])
+    list_points = [] if return_points else None  # list of 3-d points (List[array.shape==[n, 3])
+    list_weights = []  # list of 1-d confidence weights of predictions (List[array.shape==[n, ])
+
+    if return_points:
+        # points are taken from views prepared in this process
+        point_index = interpolation_params.pop('point_index', None)
+        if None is point_index:
+            point_index = PointIndex.from_images(images)
+        view_cache = interpolation_params.pop('view_cache', None)
+        if None is view_cache:
+            view_cache = ViewCache(
+                images, distances, extrinsics, intrinsics_dict,
+                max_bytes=interpolation_params.get('view_cache_bytes', 2 ** 30), point_index=point_index)
+        interpolation_params.update(point_index=point_index, view_cache=view_cache)
+
+    pairwise_predictions = iterate_pairwise_predictions(
+        images, distances, extrinsics, intrinsics_dict, workers=workers, **interpolation_params)
+    for _, j, predictions_interp, indexes_interp, weights_interp in pairwise_predictions:
         list_predictions.append(predictions_interp)
         list_indexes_in_whole.append(indexes_interp)
-        list_points.append(points_interp)
-
+        list_weights.append(weights_interp)
+        if return_points:
+            start_j, _ = point_index.view_range(j)
+            _, _, points_j, _, _ = view_cache(j)
+            list_points.append(points_j[indexes_interp - start_j])
+
+    if return_weights:
+        return list_predictions, list_indexes_in_whole, list_points, list_weights
     return list_predictions, list_indexes_in_whole, list_points
+
+
+def streaming_interpolate_predictions(
+        images: List[np.array],
+        distances: List[np.array],
+        extrinsics: List[np.array],
+        intrinsics_dict: List[Mapping],
+        combiner: StreamingCombiner,
+        workers: int = 1,
+        **interpolation_params,
+) -> StreamingCombiner:
+    """Interpolate predictions between views, folding predictions
+    of each pair of views into running per-point accumulators
+    instead of keeping them all in memory.
+
+    :param images: list of 2d depth images
+    :param distances: list of 2d distance-to-feature predictions
+    :param extrinsics: list of 4x4 camera extrinsic (camera->world) matrices
+    :param intrinsics_dict: list of imaging parameters for parallel projection
+    :param combiner: accumulator to fold predictions into
+    :param workers: number of processes to distribute pairs of views across
+    :param interpolation_params: parameters for interpolation procedure
+
+    :return: the updated combiner
+    """
+    pairwise_predictions = iterate_pairwise_predictions(
+        images, distances, extrinsics, intrinsics_dict, workers=workers, **interpolation_params)
+    tracer = get_tracer()
+    for _, _, predictions_interp, indexes_interp, weights_interp in pairwise_predictions:
+        with tracer.span('combine.update', n_predictions=len(predictions_interp)):
+            combiner.update(predictions_interp, indexes_interp, weights_interp)
+
+    return combiner
@@ -0,0 +1,86 @@
+import hashlib
+import json
+import os
+from typing import Mapping, Tuple
+
+import numpy as np
+
+from gcv_v20211_hw1.utils.camera_utils.sparse_image import SparseImage
+
+# change whenever cached results would differ for the same inputs
+# (e.g. the interpolation procedure or the cache layout changes)
+CACHE_VERSION = 2
+
+
+def hash_view(image, distances, extrinsics, intrinsics: Mapping) -> str:
+    """Content hash of the inputs defining a view.
+
+    :param image: 2d depth image (dense or `SparseImage`)
+    :param distances: 2d distance-to-feature predictions (dense or `SparseImage`)
+    :param extrinsics: 4x4 camera extrinsic (camera->world) matrix
+    :param intrinsics: imaging parameters for parallel projection
+    """
+    digest = hashlib.sha1()
+    for array in [image, distances, extrinsics]:
+        if isinstance(array, SparseImage):
+            digest.update(b'sparse')
+            parts = [np.asarray(array.shape), array.indexes, array.values]
+        else:
+            parts = [array]
+        for part in parts:
+            part = np.ascontiguousarray(part)
+            digest.update('{}{}'.format(part.dtype.str, part.shape).encode())
+            digest.update(part.data)
+    digest.update(json.dumps(intrinsics, sort_keys=True, default=lambda value: np.asarray(value).tolist()).encode())
+    return digest.hexdigest()
+
+
+class PairCache:
+    def __init__(self, directory: str):
+        """On-disk cache of predictions interpolated from view i into view j,
+        addressed by contents of both views and interpolation parameters,
+        so that pairs are reused by runs differing in other parameters
+        (e.g. aggregation) or in other views.
+
+        Each pair is stored in `<directory>/<key[:2]>/<key>.npz` as predictions,
+        indexes of interpolated points into points of view j and confidence
+        weights of predictions.
+
+        :param directory: directory to keep cached pairs in (created if missing)
+        """
+        self.directory = directory
+        self.hits, self.misses = 0, 0
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(view_key_i: str, view_key_j: str, interpolation_params: Mapping) -> str:
+        """Key of a pair of views given their `hash_view`es and all parameters
+        of the interpolation procedure that affect its results."""
+        description = json.dumps(
+            [CACHE_VERSION, view_key_i, view_key_j, interpolation_params],
+            sort_keys=True, default=lambda value: np.asarray(value).tolist())
+        return hashlib.sha1(description.encode()).hexdigest()
+
+    def filename(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key + '.npz')
+
+    def __contains__(self, key: str) -> bool:
+        return os.path.exists(self.filename(key))
+
+    def load(self, key: str) -> Tuple[np.array, np.array, np.array]:
+        """Load predictions, indexes into points of view j and weights of a cached pair."""
+        with np.load(self.filename(key)) as data:
+            self.hits += 1
+            return data['predictions'], data['indexes'], data['weights']
+
+    def save(self, key: str, predictions: np.array, indexes: np.array, weights: np.array):
+        """Store predictions, indexes into points of view j and weights of a pair."""
+        self.misses += 1
+        filename = self.filename(key)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        # write to a temporary file first, so that concurrent runs
+        # and interrupted writes never leave a partial file behind
+        temp_filename = '{}.{}.tmp.npz'.format(filename[:-len('.npz')], os.getpid())
+        indexes = indexes.astype(np.int32) if len(indexes) == 0 or indexes.max() <= np.iinfo(np.int32).max else indexes
+        np.savez(temp_filename, predictions=predictions, indexes=indexes, weights=weights)
+        os.replace(temp_filename, filename)
@@ -0,0 +1,153 @@
+import multiprocessing
+from multiprocessing import shared_memory
+from typing import Iterable, Iterator, List, Mapping, Tuple
+
+import numpy as np
+
+from gcv_v20211_hw1.fusion.interpolators import ViewCache, interpolate_pair
+from gcv_v20211_hw1.fusion.point_index import PointIndex
+from gcv_v20211_hw1.utils.camera_utils.sparse_image import SparseImage
+
+
+class SharedArrays:
+    def __init__(self, arrays: Mapping[str, np.array]):
+        """Copies of numpy arrays placed in shared memory,
+        so that worker processes can access them without pickling.
+
+        :param arrays: mapping from names to arrays to share
+        """
+        self.blocks = {}
+        self.specs = {}
+        for name, array in arrays.items():
+            array = np.ascontiguousarray(array)
+            block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+            self.blocks[name] = block
+            self.specs[name] = (block.name, array.shape, array.dtype.str)
+
+    def close(self):
+        for block in self.blocks.values():
+            block.close()
+            block.unlink()
+        self.blocks = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def attach_shared_arrays(specs: Mapping[str, Tuple]) -> Tuple[Mapping[str, np.array], List]:
+    """Access arrays placed in shared memory by `SharedArrays` from another process.
+
+    :param specs: `SharedArrays.specs` of the arrays
+    :return: tuple of mapping from names to arrays, and the shared memory
+        blocks backing the arrays (these must be kept alive while arrays are used)
+    """
+    arrays, blocks = {}, []
+    for name, (block_name, shape, dtype) in specs.items():
+        block = shared_memory.SharedMemory(name=block_name)
+        arrays[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+        blocks.append(block)
+    return arrays, blocks
+
+
+def pack_views(images, distances, extrinsics) -> Mapping[str, np.array]:
+    """Pack views into a few arrays (e.g. to be placed in shared memory
+    or saved to a file): dense images are stacked, sparse images are concatenated."""
+    if not isinstance(images[0], SparseImage):
+        return {
+            'images': np.stack(images),
+            'distances': np.stack(distances),
+            'extrinsics': np.stack(extrinsics),
+        }
+
+    distances = [SparseImage.from_dense(distances_i, indexes=image_i.indexes, dtype=image_i.values.dtype)
+                 for image_i, distances_i in zip(images, distances)]
+    return {
+        'indexes': np.concatenate([image.indexes for image in images]),
+        'depth': np.concatenate([image.values for image in images]),
+        'distances': np.concatenate([distances_i.values for distances_i in distances]),
+        'offsets': np.cumsum([0] + [len(image) for image in images]),
+        'shapes': np.array([image.shape for image in images]),
+        'extrinsics': np.stack(extrinsics),
+    }
+
+
+def unpack_views(arrays):
+    """Inverse of `pack_views`, returning images and distances
+    viewing the packed arrays (i.e. without copying)."""
+    if 'images' in arrays:
+        return arrays['images'], arrays['distances']
+
+    images, distances = [], []
+    for start, stop, shape in zip(arrays['offsets'][:-1], arrays['offsets'][1:], arrays['shapes']):
+        indexes = arrays['indexes'][start:stop]
+        images.append(SparseImage(shape, indexes, arrays['depth'][start:stop]))
+        distances.append(SparseImage(shape, indexes, arrays['distances'][start:stop]))
+    return images, distances
+
+
+# state of a worker process, set up once by `_init_worker`
+_worker = {}
+
+
+def _init_worker(specs, intrinsics_dict, point_index, view_cache_bytes, interpolation_params):
+    arrays, blocks = attach_shared_arrays(specs)
+    _worker['blocks'] = blocks
+    images, distances = unpack_views(arrays)
+    if len(images) > 0 and isinstance(images[0], SparseImage):
+        # foreground pixels of sparse views are already in shared memory
+        point_index = PointIndex.from_images(images)
+    _worker['get_view'] = ViewCache(
+        images, distances, arrays['extrinsics'], intrinsics_dict,
+        max_bytes=view_cache_bytes, point_index=point_index)
+    _worker['point_index'] = point_index
+    _worker['interpolation_params'] = interpolation_params
+
+
+def _interpolate_pair_in_worker(task):
+    i, j = task
+    return interpolate_pair(
+        _worker['get_view'], _worker['point_index'], i, j,
+        **_worker['interpolation_params'])
+
+
+def parallel_interpolate_pairs(
+        images: List[np.array],
+        distances: List[np.array],
+        extrinsics: List[np.array],
+        intrinsics_dict: List[Mapping],
+        point_index: PointIndex,
+        tasks: Iterable[Tuple[int, int]],
+        workers: int = 2,
+        chunksize: int = 1,
+        view_cache_bytes: int = 2 ** 30,
+        **interpolation_params,
+) -> Iterator[Tuple[np.array, np.array, np.array]]:
+    """Interpolate predictions for pairs of views in a pool of processes.
+
+    Depth images (dense or `SparseImage`s), distances and extrinsics
+    are shared with workers through shared memory; results are yielded in the order of `tasks`,
+    and are identical to those computed by `interpolate_pair` in a single process.
+
+    :param images: list of 2d depth images (dense ones all of the same shape)
+    :param distances: list of 2d distance-to-feature predictions
+    :param extrinsics: list of 4x4 camera extrinsic (camera->world) matrices
+    :param intrinsics_dict: list of imaging parameters for parallel projection
+    :param point_index: layout of points of views in global set of points
+    :param tasks: pairs (i, j) of views to interpolate from i into j
+    :param workers: number of worker processes
+    :param chunksize: number of tasks sent to a worker at once
+    :param view_cache_bytes: memory budget for caching prepared views in each worker
+    :param interpolation_params: parameters for interpolation procedure
+
+    :return: iterator over tuples of interpolated predictions, indexes and weights
+    """
+    arrays = pack_views(images, distances, extrinsics)
+    with SharedArrays(arrays) as shared:
+        del arrays
+        initargs = (shared.specs, intrinsics_dict, point_index, view_cache_bytes, interpolation_params)
+        with multiprocessing.Pool(workers, initializer=_init_worker, initargs=initargs) as pool:
+            yield from pool.imap(_interpolate_pair_in_worker, tasks, chunksize=chunksize)
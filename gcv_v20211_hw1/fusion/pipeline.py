@@ -0,0 +1,255 @@
+import os
+from typing import Mapping
+
+import numpy as np
+
+import gcv_v20211_hw1.utils.sharpf_io as sharpf_io
+from gcv_v20211_hw1.utils.hdf5.dataset import Hdf5File, PreloadTypes
+from gcv_v20211_hw1.fusion.combiners import combine_predictions, weighted_variance, StreamingCombiner
+from gcv_v20211_hw1.fusion.combiners import RESERVOIR_AGGREGATION_METHODS
+from gcv_v20211_hw1.fusion.culling import CullingReport
+from gcv_v20211_hw1.fusion.pair_cache import PairCache
+from gcv_v20211_hw1.fusion.point_index import PointIndex
+import gcv_v20211_hw1.fusion.interpolators as interpolators
+from gcv_v20211_hw1.utils.camera_utils.sparse_image import SparseImage
+from gcv_v20211_hw1.utils.instrumentation import get_tracer
+
+HIGH_RES = 0.02
+MED_RES = 0.05
+LOW_RES = 0.125
+
+PRECISIONS = ['float64', 'float32']
+
+
+def _log(verbose, message):
+    if verbose:
+        print(message)
+
+
+def fuse_model(
+        true_filename: str,
+        pred_filename: str,
+        output_dir: str,
+        resolution_3d: float = HIGH_RES,
+        nn_set_size: int = 4,
+        distance_interp_factor: float = 6.,
+        occlusion_factor: float = None,
+        interpolation_method: str = 'bilin',
+        interpolation_engine: str = 'batch',
+        aggregation: str = 'min',
+        workers: int = 1,
+        cull: bool = False,
+        streaming: bool = False,
+        reservoir_size: int = 32,
+        sparse: bool = False,
+        precision: str = 'float64',
+        chunk_size: int = None,
+        pair_cache_dir: str = None,
+        verbose: bool = True,
+) -> Mapping:
+    """Fuse ground truth and predicted distances of depth images of a model
+    into point clouds, saving them to `output_dir` as
+    `<name>__ground_truth.hdf5` and `<name>__interpolated.hdf5`
+    (the latter with weighted variance of predictions of each point).
+
+    :param true_filename: path to GT file with whole model depth images
+    :param pred_filename: path to file with predicted distances
+    :param output_dir: directory to save fused point clouds to
+    :param resolution_3d: 3D resolution of scans
+    :param nn_set_size: number of neighbours used for interpolation
+    :param distance_interp_factor: distance_interp_factor * resolution_3d
+        is the distance_interpolation_threshold
+    :param occlusion_factor: occlusion_factor * resolution_3d is the occlusion
+        tolerance of the depth test run before neighbour search
+        (see `pairwise_interpolate_predictions`), the distance_interpolation_threshold if None
+    :param interpolation_method: one of `batch_interpolation.INTERPOLATION_METHODS`
+    :param interpolation_engine: one of `interpolators.INTERPOLATION_ENGINES`
+    :param aggregation: one of `combiners.AGGREGATION_METHODS`
+    :param workers: number of processes to distribute pairs of views across
+    :param cull: if True, skip pairs of views that cannot overlap
+    :param streaming: if True, aggregate predictions on the fly
+    :param reservoir_size: number of predictions per point kept
+        for truncated and Huber aggregations in streaming mode
+        (none are kept for other aggregations)
+    :param sparse: if True, keep only foreground pixels of views
+        (see `SparseImage`) once they are loaded
+    :param precision: 'float64' or 'float32', floating point type of depth
+        images, distances, points and predictions (interpolation weights
+        and sums of predictions are computed in double precision regardless)
+    :param chunk_size: number of points of a view to reproject and interpolate
+        at once, bounding memory used per pair of views; all points if None
+    :param pair_cache_dir: if given, directory to cache results of interpolation
+        for pairs of views in (see `PairCache`), so that runs with the same
+        inputs and interpolation parameters skip interpolating them
+    :param verbose: if True, print progress messages
+
+    :return: a mapping with output filenames, number of points,
+        and culling statistics (if `cull` is set)
+    """
+    if precision not in PRECISIONS:
+        raise ValueError('unknown precision: {}'.format(precision))
+    dtype = np.dtype(precision)
+    tracer = get_tracer()
+    # extract a filename from the input pathname to use further
+    name = os.path.splitext(os.path.basename(true_filename))[0]
+
+    # load ground truth images and distances
+    _log(verbose, 'Loading ground truth data...')
+    with tracer.span('phase.load_ground_truth'):
+        gt_dataset = Hdf5File(
+            true_filename,
+            io=sharpf_io.WholeDepthMapIO,
+            preload=PreloadTypes.NEVER,
+            labels='*',
+            persistent=True)
+        # read all views of the labels we need at once
+        gt_views = gt_dataset.load_range(0, len(gt_dataset), labels=['image', 'distances', 'camera_pose'])
+        gt_dataset.close()
+    # depth images captured from a variety of views around the 3D shape
+    gt_images = list(gt_views['image'])
+    # ground-truth distances (multi-view consistent for the global 3D shape)
+    gt_distances = list(gt_views['distances']) if 'distances' in gt_views \
+        else [np.ones_like(image) for image in gt_images]
+    # extrinsic camera matrixes describing the 3D camera poses used to capture depth images
+    gt_extrinsics = list(gt_views['camera_pose'])
+    del gt_views
+    if sparse:
+        gt_images = [SparseImage.from_dense(image, dtype=dtype) for image in gt_images]
+        gt_distances = [SparseImage.from_dense(distances, indexes=image.indexes, dtype=dtype)
+                        for image, distances in zip(gt_images, gt_distances)]
+    else:
+        gt_images = [image.astype(dtype, copy=False) for image in gt_images]
+        gt_distances = [distances.astype(dtype, copy=False) for distances in gt_distances]
+    # intrinsic camera parameters describing how to compute image from points and vice versa
+    gt_intrinsics = [dict(resolution_image=gt_images[0].shape, resolution_3d=resolution_3d) for _ in gt_images]
+    # foreground pixels of views and their place in the fused point cloud,
+    # shared by ground truth fusion and interpolation of predictions
+    point_index = PointIndex.from_images(gt_images)
+
+    # construct the globally consistent 3D point cloud
+    # from a list of individual image-distances pairs
+    _log(verbose, 'Fusing ground truth data...')
+    fused_points_gt, \
+    fused_distances_gt = interpolators.interpolate_ground_truth(
+        gt_images,
+        gt_distances,
+        gt_extrinsics,
+        gt_intrinsics,
+        workers=workers,
+        point_index=point_index)
+    n_points = len(fused_points_gt)
+
+    # save point cloud with ground-truth distance-to-feature values to an output file
+    gt_output_filename = os.path.join(
+        output_dir,
+        '{}__{}.hdf5'.format(name, 'ground_truth'))
+    _log(verbose, 'Saving ground truth to {}'.format(gt_output_filename))
+    sharpf_io.save_full_model_predictions(
+        fused_points_gt,
+        fused_distances_gt,
+        gt_output_filename)
+
+    # load predicted distances
+    _log(verbose, 'Loading predictions...')
+    with tracer.span('phase.load_predictions'):
+        predictions_dataset = Hdf5File(
+            pred_filename,
+            io=sharpf_io.WholeDepthMapIO,
+            preload=PreloadTypes.NEVER,
+            labels='*',
+            persistent=True)
+        # predicted distances (NOT multi-view consistent, as each CNN only had access to a particular view)
+        pred_distances = list(predictions_dataset.load_range(0, len(predictions_dataset), labels=['distances'])['distances'])
+        predictions_dataset.close()
+    if sparse:
+        pred_distances = [SparseImage.from_dense(distances, indexes=image.indexes, dtype=dtype)
+                          for image, distances in zip(gt_images, pred_distances)]
+    else:
+        pred_distances = [distances.astype(dtype, copy=False) for distances in pred_distances]
+
+    # Interpolate predictions from individual views by re-projecting them
+    # from view i to view j for each pair (i, j) of views,
+    # obtaining several predictions for each measured point.
+    _log(verbose, 'Interpolating predictions...')
+    threshold = resolution_3d * distance_interp_factor
+    culling_report = CullingReport() if cull else None
+    interpolation_params = dict(
+        nn_set_size=nn_set_size,
+        distance_interpolation_threshold=threshold,
+        method=interpolation_method,
+        engine=interpolation_engine,
+        chunk_size=chunk_size,
+        occlusion_tolerance=resolution_3d * occlusion_factor if None is not occlusion_factor else None,
+        pair_cache=PairCache(pair_cache_dir) if None is not pair_cache_dir else None,
+        workers=workers,
+        point_index=point_index,
+        culling_report=culling_report)
+
+    if streaming:
+        # Fold predictions of each pair of views into per-point
+        # accumulators right away, keeping memory O(n_points).
+        if aggregation not in RESERVOIR_AGGREGATION_METHODS:
+            reservoir_size = 0
+        with tracer.span('phase.interpolate_predictions'):
+            combiner = interpolators.streaming_interpolate_predictions(
+                gt_images,
+                pred_distances,
+                gt_extrinsics,
+                gt_intrinsics,
+                StreamingCombiner(n_points, reservoir_size=reservoir_size, dtype=dtype),
+                **interpolation_params)
+
+        _log(verbose, 'Fusing predictions...')
+        combined_predictions = combiner.finalize(aggregation)
+        variance = combiner.weighted_variance()
+
+    else:
+        with tracer.span('phase.interpolate_predictions'):
+            list_predictions, \
+            list_indexes_in_whole, \
+            _, \
+            list_weights = interpolators.multi_view_interpolate_predictions(
+                gt_images,
+                pred_distances,
+                gt_extrinsics,
+                gt_intrinsics,
+                return_points=False,
+                return_weights=True,
+                **interpolation_params)
+
+        # Now that we have obtained a set of predictions per each individual point,
+        # we can combine distance-to-feature predictions into a consolidated
+        # point cloud by simply taking min value across all distance-to-feature predictions
+        _log(verbose, 'Fusing predictions...')
+        combined_predictions, \
+        prediction_variants = \
+            combine_predictions(
+                n_points,
+                list_predictions,
+                list_indexes_in_whole,
+                aggregation_method=aggregation,
+                list_weights=list_weights)
+        variance = weighted_variance(prediction_variants)
+
+    if None is not culling_report:
+        _log(verbose, 'Pair culling: {}'.format(culling_report))
+        tracer.event('culling', **culling_report.as_dict())
+
+    # save point cloud with predicted distance-to-feature values to an output file
+    pred_output_filename = os.path.join(
+        output_dir,
+        '{}__{}.hdf5'.format(name, 'interpolated'))
+    _log(verbose, 'Saving predictions to {}'.format(pred_output_filename))
+    sharpf_io.save_full_model_predictions(
+        fused_points_gt,
+        combined_predictions,
+        pred_output_filename,
+        variance=variance)
+
+    return {
+        'gt_output_filename': gt_output_filename,
+        'pred_output_filename': pred_output_filename,
+        'n_views': len(gt_images),
+        'n_points': n_points,
+        'culling': culling_report.as_dict() if None is not culling_report else None,
+    }
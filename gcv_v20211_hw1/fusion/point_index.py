@@ -0,0 +1,88 @@
+from typing import List, Tuple
+
+import numpy as np
+
+from gcv_v20211_hw1.utils.camera_utils.sparse_image import foreground_indexes
+
+
+class PointIndex:
+    def __init__(self, pixel_indexes: List[np.array], shapes: List[Tuple[int, int]]):
+        """Layout of points of all views in the global point cloud:
+        points of view i correspond to its foreground pixels (in row-major order)
+        and go right after points of view i - 1.
+
+        Built once per model and shared by ground truth fusion and interpolation
+        of predictions, so that foreground pixels are found once, and global ids
+        of points are translated to and from pixels of views without scanning images.
+
+        :param pixel_indexes: list of sorted linear indexes of foreground pixels of each view
+        :param shapes: list of (h, w) shapes of images of views
+        """
+        self.pixel_indexes = pixel_indexes
+        self.shapes = [tuple(shape) for shape in shapes]
+        # points of view i are offsets[i]:offsets[i + 1]
+        self.offsets = np.cumsum([0] + [len(pixel_indexes_i) for pixel_indexes_i in pixel_indexes])
+        self._global_indexes = np.arange(self.n_points)
+        self._global_indexes.flags.writeable = False
+        self._lookup_images = {}
+
+    @classmethod
+    def from_images(cls, images: List[np.array]):
+        """Index points of depth images (dense arrays or `SparseImage`s)."""
+        return cls([foreground_indexes(image) for image in images], [image.shape for image in images])
+
+    def append(self, pixel_indexes_i: np.array, shape: Tuple[int, int]):
+        """Index points of a view placed after all others (e.g. a newly
+        added scan); global ids of points of other views do not change."""
+        self.pixel_indexes.append(pixel_indexes_i)
+        self.shapes.append(tuple(shape))
+        self.offsets = np.append(self.offsets, self.offsets[-1] + len(pixel_indexes_i))
+        self._global_indexes = np.arange(self.n_points)
+        self._global_indexes.flags.writeable = False
+
+    @property
+    def n_views(self) -> int:
+        return len(self.pixel_indexes)
+
+    @property
+    def n_points(self) -> int:
+        return int(self.offsets[-1])
+
+    def view_range(self, i) -> Tuple[int, int]:
+        """Start and end of global ids of points of view i."""
+        return int(self.offsets[i]), int(self.offsets[i + 1])
+
+    def global_indexes(self, i) -> np.array:
+        """Global ids of points of view i (a read-only view, not a copy)."""
+        start, stop = self.view_range(i)
+        return self._global_indexes[start:stop]
+
+    def lookup_image(self, i) -> np.array:
+        """[h, w] image of global ids of points of pixels of view i
+        (-1 for background pixels), computed on first use."""
+        if i not in self._lookup_images:
+            dtype = np.int32 if self.n_points <= np.iinfo(np.int32).max else np.int64
+            lookup = np.full(int(np.prod(self.shapes[i])), -1, dtype=dtype)
+            lookup[self.pixel_indexes[i]] = self.global_indexes(i)
+            self._lookup_images[i] = lookup.reshape(self.shapes[i])
+        return self._lookup_images[i]
+
+    def pixels_to_points(self, i, pixel_indexes: np.array) -> np.array:
+        """Global ids of points of pixels of view i given by linear indexes (-1 for background)."""
+        return self.lookup_image(i).reshape(-1)[pixel_indexes]
+
+    def points_to_pixels(self, global_indexes: np.array) -> Tuple[np.array, np.array]:
+        """Views and linear indexes of pixels of points given by global ids."""
+        views = np.searchsorted(self.offsets, global_indexes, side='right') - 1
+        pixel_indexes = np.zeros(np.shape(global_indexes), dtype=np.int64)
+        for i in np.unique(views):
+            in_view = views == i
+            pixel_indexes[in_view] = self.pixel_indexes[i][global_indexes[in_view] - self.offsets[i]]
+        return views, pixel_indexes
+
+    def __getstate__(self):
+        # derived arrays are cheap to rebuild, so do not send them to worker processes
+        return {'pixel_indexes': self.pixel_indexes, 'shapes': self.shapes}
+
+    def __setstate__(self, state):
+        self.__init__(state['pixel_indexes'], state['shapes'])
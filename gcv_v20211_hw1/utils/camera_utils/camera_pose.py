@@ -1,5 +1,4 @@
 import numpy as np
-import trimesh.transformations as tt
 
 
 def rotate_to_world_origin(camera_origin):
@@ -37,11 +36,37 @@ def camera_to_display(image):
     return image[::-1, ::-1].T
 
 
+def transform_points(points, matrix, translate=True, out=None):
+    """Apply 4x4 homogeneous transform(s) to 3d points.
+
+    :param points: n * 3 array of points
+    :param matrix: either a 4x4 matrix, or a stack of [..., 4, 4] matrices
+    :param translate: if True, also translate the points
+    :param out: optional output array of shape [..., n, 3]
+        to write transformed points to instead of allocating a new one
+    :return: [..., n, 3] array of transformed points, computed in
+        the floating point type of `points` (e.g. single precision points
+        stay in single precision, while transforms are stored in double)
+    """
+    matrix = np.asarray(matrix, dtype=np.result_type(points.dtype, np.float32))
+    rotation_t = np.swapaxes(matrix[..., :3, :3], -1, -2)
+    out = np.matmul(points, rotation_t, out=out)
+    if translate:
+        out += matrix[..., None, :3, 3]
+    return out
+
+
 class CameraPose:
-    def __init__(self, transform):
+    def __init__(self, transform, world_to_camera_4x4=None):
+        """Camera pose defined by 4x4 transform from camera to world frame.
+
+        :param transform: 4x4 camera to world transform
+        :param world_to_camera_4x4: inverse of `transform` if already known
+        """
         self._camera_to_world_4x4 = transform
         # always store transform from world to camera frame
-        self._world_to_camera_4x4 = np.linalg.inv(self._camera_to_world_4x4)
+        self._world_to_camera_4x4 = np.linalg.inv(self._camera_to_world_4x4) \
+            if None is world_to_camera_4x4 else world_to_camera_4x4
 
     @classmethod
     def from_camera_to_world(cls, rotation=None, translation=None):
@@ -71,25 +96,27 @@ class CameraPose:
 
         return cls.from_camera_to_world(rotation=R.T, translation=t)
 
-    def world_to_camera(self, points):
+    def world_to_camera(self, points, out=None):
         """Transform points from world to camera coordinates.
         Useful for understanding where the objects are, as seen by the camera.
 
         :param points: either n * 3 array, or a single 3-vector
+        :param out: optional n * 3 array to write the result to
         """
         points = np.atleast_2d(points)
-        return tt.transform_points(points, self._world_to_camera_4x4)
+        return transform_points(points, self._world_to_camera_4x4, out=out)
 
-    def camera_to_world(self, points, translate=True):
+    def camera_to_world(self, points, translate=True, out=None):
         """Transform points from camera to world coordinates.
         Useful for understanding where objects bound to camera
         (e.g., image pixels) are in the world.
 
         :param points: either n * 3 array, or a single 3-vector
         :param translate: if True, also translate the points
+        :param out: optional n * 3 array to write the result to
         """
         points = np.atleast_2d(points)
-        return tt.transform_points(points, self._camera_to_world_4x4, translate=translate)
+        return transform_points(points, self._camera_to_world_4x4, translate=translate, out=out)
 
     @property
     def world_to_camera_4x4(self):
@@ -140,3 +167,86 @@ class CameraPose:
         """
         composed_camera_to_world_4x4 = np.dot(self._camera_to_world_4x4, other_pose.camera_to_world_4x4, )
         return CameraPose(composed_camera_to_world_4x4)
+
+
+class CameraPoseBatch:
+    def __init__(self, transforms):
+        """A stack of camera poses, transforming points
+        for all of the poses at once.
+
+        :param transforms: [V, 4, 4] array of camera to world transforms
+        """
+        self._camera_to_world_4x4 = np.asanyarray(transforms)
+        # all inverses computed in a single batched call
+        self._world_to_camera_4x4 = np.linalg.inv(self._camera_to_world_4x4)
+
+    @classmethod
+    def from_poses(cls, poses):
+        """Stack a list of `CameraPose` objects."""
+        return cls(np.stack([pose.camera_to_world_4x4 for pose in poses]))
+
+    def __len__(self):
+        return len(self._camera_to_world_4x4)
+
+    def __getitem__(self, i):
+        """Return i-th pose as a `CameraPose` (not inverting its transform again)."""
+        return CameraPose(self._camera_to_world_4x4[i], world_to_camera_4x4=self._world_to_camera_4x4[i])
+
+    @property
+    def world_to_camera_4x4(self):
+        return self._world_to_camera_4x4
+
+    @property
+    def camera_to_world_4x4(self):
+        return self._camera_to_world_4x4
+
+    @property
+    def frame_origins(self):
+        """Return [V, 3] camera frame origins in world coordinates."""
+        return self._camera_to_world_4x4[:, :3, 3]
+
+    @property
+    def frame_axes(self):
+        """Return [V, 3, 3] camera axes: for each of the poses, a list of 3D basis
+        vectors (cx, cy, cz) defined in world frame"""
+        return np.swapaxes(self._camera_to_world_4x4[:, :3, :3], -1, -2)
+
+    def world_to_camera(self, points, out=None):
+        """Transform points from world to camera coordinates of each of the poses.
+
+        :param points: n * 3 array of points
+        :param out: optional [V, n, 3] array to write the result to
+        :return: [V, n, 3] array of points in each of the camera frames
+        """
+        points = np.atleast_2d(points)
+        return transform_points(points, self._world_to_camera_4x4, out=out)
+
+    def camera_to_world(self, points, translate=True, out=None):
+        """Transform points from camera coordinates of each of the poses to world coordinates.
+
+        :param points: either n * 3 array (same points in each camera frame),
+            or [V, n, 3] array (separate points for each camera frame)
+        :param translate: if True, also translate the points
+        :param out: optional [V, n, 3] array to write the result to
+        :return: [V, n, 3] array of points in world frame
+        """
+        points = np.atleast_2d(points)
+        return transform_points(points, self._camera_to_world_4x4, translate=translate, out=out)
+
+    def compose_world_to_camera(self, other_poses):
+        """Batched `CameraPose.compose_world_to_camera`."""
+        composed_world_to_camera_4x4 = np.matmul(other_poses.world_to_camera_4x4, self._world_to_camera_4x4)
+        return CameraPoseBatch(np.linalg.inv(composed_world_to_camera_4x4))
+
+    def compose_camera_to_world(self, other_poses):
+        """Batched `CameraPose.compose_camera_to_world`."""
+        composed_camera_to_world_4x4 = np.matmul(self._camera_to_world_4x4, other_poses.camera_to_world_4x4)
+        return CameraPoseBatch(composed_camera_to_world_4x4)
+
+    def camera_to_camera_4x4(self):
+        """Compute transforms between camera frames of all pairs of poses.
+
+        :return: [V, V, 4, 4] array, where element [i, j]
+            transforms points from camera frame j to camera frame i
+        """
+        return np.matmul(self._world_to_camera_4x4[:, None], self._camera_to_world_4x4[None, :])
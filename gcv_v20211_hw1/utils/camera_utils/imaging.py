@@ -1,14 +1,21 @@
+import functools
+
 import numpy as np
 
 from gcv_v20211_hw1.utils.camera_utils.raycasting import generate_rays
+from gcv_v20211_hw1.utils.camera_utils.sparse_image import foreground_indexes, take_pixels
 
 
 class RaycastingImaging:
-    def __init__(self, resolution_image, resolution_3d):
+    def __init__(self, resolution_image, resolution_3d, dtype=np.float64):
         self.resolution_image = resolution_image
         self.resolution_3d = resolution_3d
+        # floating point type of rays and of points computed from images
+        self.dtype = np.dtype(dtype)
         self.rays_screen_coords, self.rays_origins, self.rays_directions = generate_rays(
-            self.resolution_image, self.resolution_3d)
+            self.resolution_image, self.resolution_3d, dtype=self.dtype)
+        # rays are laid out row-major on a regular grid of pixels
+        self.grid_shape = tuple(self.rays_screen_coords.max(axis=0) + 1)
 
     def points_to_image(self, points, ray_indexes, assign_channels=None):
         xy_to_ij = self.rays_screen_coords[ray_indexes]
@@ -22,10 +29,137 @@ class RaycastingImaging:
         image[xy_to_ij[:, 0], xy_to_ij[:, 1]] = points[:, assign_channels]
         return image.squeeze()
 
-    def image_to_points(self, image):
-        i = np.where(image.ravel() != 0)[0]
-        points = np.zeros((len(i), 3))
+    def image_to_points(self, image, pixel_indexes=None):
+        """Points in camera frame of foreground pixels of a depth image
+        (a dense array or a `SparseImage`).
+
+        :param pixel_indexes: precomputed linear indexes of foreground pixels
+            (see `foreground_indexes`), found in the image if None
+        """
+        i = foreground_indexes(image) if None is pixel_indexes else pixel_indexes
+        points = np.zeros((len(i), 3), dtype=self.dtype)
         points[:, 0] = self.rays_origins[i, 0]
         points[:, 1] = self.rays_origins[i, 1]
-        points[:, 2] = image.ravel()[i]
+        points[:, 2] = take_pixels(image, i)
         return points
+
+    def uv_to_pixel(self, uv):
+        """Compute continuous (row, column) pixel coordinates
+        of points given by their (u, v) coordinates in the image plane.
+
+        Inverts the placement of rays done by `generate_rays`.
+        """
+        n_rows, n_cols = self.grid_shape
+        rows = n_rows / 2 - uv[:, 0] / self.resolution_3d
+        cols = n_cols / 2 - uv[:, 1] / self.resolution_3d
+        return rows, cols
+
+    def nearest_pixel(self, uv):
+        """Linear indexes of pixels nearest to points given by their
+        (u, v) coordinates (for points outside the image, the nearest
+        pixel on its border)."""
+        n_rows, n_cols = self.grid_shape
+        rows, cols = self.uv_to_pixel(uv)
+        rows = np.clip(np.rint(rows), 0, n_rows - 1).astype(np.int64)
+        cols = np.clip(np.rint(cols), 0, n_cols - 1).astype(np.int64)
+        return rows * n_cols + cols
+
+    def query_grid(self, uv, k=1):
+        """Find k nearest rays (pixels) for each of the points
+        by direct lookup in the regular pixel grid, a drop-in replacement
+        for `cKDTree(self.rays_origins[:, :2]).query(uv, k=k)`
+        (exact, including for points outside the image).
+
+        :param uv: [n, 2] array of (u, v) coordinates of query points
+        :param k: number of nearest pixels to find
+        :return: tuple of [n, k] distances (sorted ascending) and
+            [n, k] indexes of nearest pixels into `self.rays_origins`
+        """
+        n_rows, n_cols = self.grid_shape
+        rows, cols = self.uv_to_pixel(uv)
+
+        # k nearest pixels lie within a block of (2m)^2 >= k pixels
+        # around the query point, so are all closer than (2m - 1) * sqrt(2)
+        # (the worst case being a query point in a corner of the image);
+        # for a point outside the image, they are closer than that plus
+        # its distance d to the image, and so are as close to the nearest
+        # point of the image (projecting onto the image brings points
+        # no further from pixels); pixels outside a window of half-size h
+        # around the pixel nearest to that point are at least h + 0.5 away.
+        m = int(np.ceil(np.sqrt(k) / 2))
+        radius = (2 * m - 1) * np.sqrt(2)
+        clipped_rows, clipped_cols = np.clip(rows, 0, n_rows - 1), np.clip(cols, 0, n_cols - 1)
+        d = np.hypot(rows - clipped_rows, cols - clipped_cols)
+        # windows larger than the image cover all of it
+        max_half_size = max(n_rows, n_cols)
+        if not np.any(d > 0.):
+            # all points within the image (the common case)
+            h = min(int(np.ceil(radius - 0.5)), max_half_size)
+            return self._query_window(rows, cols, clipped_rows, clipped_cols, k, h)
+        half_sizes = np.minimum(np.ceil(radius + d - 0.5), max_half_size).astype(int)
+
+        distances = np.empty((len(rows), k))
+        indexes = np.empty((len(rows), k), dtype=np.int64)
+        for h in np.unique(half_sizes):
+            points = np.flatnonzero(half_sizes == h)
+            # bound memory taken by windows of points far outside the image
+            chunk_size = max(1, 2 ** 22 // (2 * h + 1) ** 2)
+            for start in range(0, len(points), chunk_size):
+                chunk = points[start:start + chunk_size]
+                distances[chunk], indexes[chunk] = self._query_window(
+                    rows[chunk], cols[chunk], clipped_rows[chunk], clipped_cols[chunk], k, h)
+        return distances, indexes
+
+    def _query_window(self, rows, cols, clipped_rows, clipped_cols, k, h):
+        """k nearest pixels among those in windows of half-size h
+        around pixels nearest to points of the image (see `query_grid`)."""
+        n_rows, n_cols = self.grid_shape
+        offsets = np.arange(-h, h + 1)
+        offsets_rows, offsets_cols = np.meshgrid(offsets, offsets, indexing='ij')
+
+        # shift windows near image borders to stay inside the image
+        window_rows = np.clip(np.rint(clipped_rows).astype(int), h, n_rows - 1 - h)[:, None] + \
+            offsets_rows.ravel()[None, :]
+        window_cols = np.clip(np.rint(clipped_cols).astype(int), h, n_cols - 1 - h)[:, None] + \
+            offsets_cols.ravel()[None, :]
+
+        # windows larger than the image stick out of it
+        inside = (window_rows >= 0) & (window_rows < n_rows) & \
+                 (window_cols >= 0) & (window_cols < n_cols)
+        squared_distances = (window_rows - rows[:, None]) ** 2 + (window_cols - cols[:, None]) ** 2
+        squared_distances[~inside] = np.inf
+        window_indexes = np.clip(window_rows, 0, n_rows - 1) * n_cols + np.clip(window_cols, 0, n_cols - 1)
+
+        if k < squared_distances.shape[1]:
+            selected = np.argpartition(squared_distances, k - 1, axis=1)[:, :k]
+            squared_distances = np.take_along_axis(squared_distances, selected, axis=1)
+            window_indexes = np.take_along_axis(window_indexes, selected, axis=1)
+        order = np.argsort(squared_distances, axis=1, kind='stable')
+        distances = np.sqrt(np.take_along_axis(squared_distances, order, axis=1)) * self.resolution_3d
+        indexes = np.take_along_axis(window_indexes, order, axis=1)
+        return distances, indexes
+
+
+@functools.lru_cache(maxsize=16)
+def _cached_imaging(resolution_image, resolution_3d, dtype):
+    imaging = RaycastingImaging(resolution_image, resolution_3d, dtype=dtype)
+    # shared between callers, so guard against accidental modification
+    for array in [imaging.rays_screen_coords, imaging.rays_origins, imaging.rays_directions]:
+        array.flags.writeable = False
+    return imaging
+
+
+def shared_imaging(resolution_image, resolution_3d, dtype=np.float64) -> RaycastingImaging:
+    """Return a process-wide shared `RaycastingImaging`, so that ray grids
+    are generated once per resolution and reused across views and models.
+    Ray arrays of the returned imaging are read-only.
+
+    :param resolution_image: image resolution in pixels (int or tuple of ints)
+    :param resolution_3d: pixel 3d resolution
+    :param dtype: floating point type of rays
+    """
+    if isinstance(resolution_image, tuple):
+        resolution_image = tuple(int(size) for size in resolution_image)
+    else:
+        resolution_image = int(resolution_image)
+    return _cached_imaging(resolution_image, float(resolution_3d), np.dtype(dtype).str)
@@ -1,7 +1,7 @@
 import numpy as np
 
 
-def generate_rays(image_resolution, resolution_3d, radius=1.0):
+def generate_rays(image_resolution, resolution_3d, radius=1.0, dtype=np.float64):
     """Creates an array of rays and ray directions used for mesh raycasting.
 
     :param image_resolution: image resolution in pixels
@@ -13,6 +13,9 @@ def generate_rays(image_resolution, resolution_3d, radius=1.0):
     :param radius: Z coordinate for the rays origins
     :type resolution_3d: float
 
+    :param dtype: floating point type of rays origins and directions
+    :type dtype: numpy dtype
+
     :return:
         rays_screen_coords:     (W * H, 2): screen coordinates for the rays
         rays_origins:           (W * H, 3): world coordinates for rays origins
@@ -43,6 +46,6 @@ def generate_rays(image_resolution, resolution_3d, radius=1.0):
     ], axis=1)  # [h, w, 3]
 
     # ray directions are always facing towards Z axis
-    ray_directions = np.tile(np.array([0, 0, 1]), (rays_origins.shape[0], 1))
+    ray_directions = np.tile(np.array([0, 0, 1], dtype=dtype), (rays_origins.shape[0], 1))
 
-    return rays_screen_coords, rays_origins, ray_directions
+    return rays_screen_coords, rays_origins.astype(dtype, copy=False), ray_directions
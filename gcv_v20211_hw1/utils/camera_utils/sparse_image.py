@@ -0,0 +1,77 @@
+import numpy as np
+
+
+class SparseImage:
+    def __init__(self, shape, indexes, values):
+        """Compact storage of an image with mostly zero (background) pixels,
+        keeping only the foreground pixels.
+
+        :param shape: (h, w) shape of the image
+        :param indexes: [n, ] sorted row-major linear indexes of foreground pixels
+        :param values: [n, ] values of foreground pixels
+        """
+        self.shape = tuple(shape)
+        self.indexes = indexes
+        self.values = values
+
+    @classmethod
+    def from_dense(cls, image, indexes=None, dtype=np.float32):
+        """Convert a dense image to sparse storage.
+
+        :param image: 2d image (dense array or `SparseImage`)
+        :param indexes: linear indexes of pixels to keep (e.g. shared with
+            a depth image of the same view); nonzero pixels if None
+        :param dtype: type to store values with
+        """
+        if None is indexes:
+            indexes = foreground_indexes(image)
+            # int32 halves the size of indexes for all practical image sizes
+            if np.prod(image.shape) <= np.iinfo(np.int32).max:
+                indexes = indexes.astype(np.int32)
+        values = take_pixels(image, indexes).astype(dtype, copy=False)
+        return cls(image.shape, indexes, values)
+
+    def like(self, values):
+        """Sparse image with the same foreground pixels and given values."""
+        return SparseImage(self.shape, self.indexes, values)
+
+    def take(self, pixel_indexes):
+        """Values of pixels given by their linear indexes (zero for background)."""
+        if pixel_indexes is self.indexes:
+            return self.values
+        pixel_indexes = np.asarray(pixel_indexes)
+        if len(self.indexes) == 0:
+            return np.zeros(pixel_indexes.shape, dtype=self.values.dtype)
+        positions = np.minimum(np.searchsorted(self.indexes, pixel_indexes), len(self.indexes) - 1)
+        found = self.indexes[positions] == pixel_indexes
+        return np.where(found, self.values[positions], 0).astype(self.values.dtype, copy=False)
+
+    def to_dense(self):
+        image = np.zeros(int(np.prod(self.shape)), dtype=self.values.dtype)
+        image[self.indexes] = self.values
+        return image.reshape(self.shape)
+
+    @property
+    def dtype(self):
+        return self.values.dtype
+
+    @property
+    def nbytes(self):
+        return self.indexes.nbytes + self.values.nbytes
+
+    def __len__(self):
+        return len(self.indexes)
+
+
+def foreground_indexes(image):
+    """Row-major linear indexes of foreground (nonzero) pixels of an image."""
+    if isinstance(image, SparseImage):
+        return image.indexes
+    return np.flatnonzero(image)
+
+
+def take_pixels(image, pixel_indexes):
+    """Values of pixels of a dense or sparse image given by their linear indexes."""
+    if isinstance(image, SparseImage):
+        return image.take(pixel_indexes)
+    return np.asarray(image).reshape(-1)[pixel_indexes]
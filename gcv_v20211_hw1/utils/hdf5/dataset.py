@@ -1,9 +1,10 @@
+import functools
 import os
 from enum import Enum
 
 import h5py
-import torch
-from torch.utils.data import Dataset
+
+from gcv_v20211_hw1.utils.instrumentation import get_tracer
 
 
 class PreloadTypes(Enum):
@@ -12,12 +13,18 @@ class PreloadTypes(Enum):
     NEVER = 'never'
 
 
-class Hdf5File(Dataset):
+class Hdf5File:
 
     def __init__(self, filename, io, data_label=None, target_label=None, labels=None, preload=PreloadTypes.ALWAYS,
-                 transform=None):
+                 transform=None, persistent=False):
         """Represents HDF5 dataset contained in a single HDF5 file.
 
+        Usable as a map-style dataset with torch's `DataLoader`;
+        torch is only imported when items with data or target labels are
+        converted to tensors, so reading arrays does not require it.
+        Datasets are concatenated with `+` like torch's `Dataset`s;
+        use `to_torch` where an instance of torch's `Dataset` is required.
+
         :param filename: name of the file
         :param io: HDF5IO object serving as a I/O interface to the HDF5 data files
         :param data_label: string label in HDF5 dataset corresponding to data to train from
@@ -28,6 +35,8 @@ class Hdf5File(Dataset):
             'lazy': entire data is loaded on first access
             'never': entire data never loaded, only the requested data portions are read off disk in getitem
         :param transform: callable implementing data + target transform (e.g., adding noise)
+        :param persistent: if True, keep the file open between reads (one handle per process,
+            so that each data loading worker opens its own) instead of opening it for every read
         """
         self.filename = os.path.normpath(os.path.realpath(filename))
         assert not all([value is None for value in [data_label, target_label, labels]]), \
@@ -40,6 +49,9 @@ class Hdf5File(Dataset):
         self.io = io
         assert preload in PreloadTypes, 'unknown preload type: {}'.format(preload)
         self.preload = preload
+        self.persistent = persistent
+        self._handle = None
+        self._handle_pid = None
 
         with h5py.File(self.filename, 'r') as f:
             self.num_items = self._get_length(f)
@@ -69,8 +81,22 @@ class Hdf5File(Dataset):
     def __len__(self):
         return self.num_items
 
+    def __add__(self, other):
+        from torch.utils.data import ConcatDataset
+        return ConcatDataset([self, other])
+
+    def to_torch(self):
+        """Return this dataset as an instance of torch's `Dataset`
+        (see `TorchHdf5File`), sharing its items but not its open file handle."""
+        dataset = _torch_hdf5_file_class().__new__(_torch_hdf5_file_class())
+        dataset.__dict__.update(self.__getstate__())
+        return dataset
+
     def __getitem__(self, index):
         item = self._get_item(index)
+        if None is not self.data_label or None is not self.target_label:
+            # only needed to convert data and targets to tensors
+            import torch
 
         data = None
         if None is not self.data_label:
@@ -98,12 +124,65 @@ class Hdf5File(Dataset):
             self.items = {label: self.io.read(f, label)
                           for label in self.labels}
 
+    def _open(self):
+        """Return file handle kept open for the current process."""
+        if None is self._handle or self._handle_pid != os.getpid():
+            self._handle = h5py.File(self.filename, 'r')
+            self._handle_pid = os.getpid()
+        return self._handle
+
+    def close(self):
+        if None is not self._handle and self._handle_pid == os.getpid():
+            self._handle.close()
+        self._handle = None
+        self._handle_pid = None
+
+    def __getstate__(self):
+        # file handles cannot be pickled (e.g. when sent to data loading workers)
+        state = self.__dict__.copy()
+        state['_handle'], state['_handle_pid'] = None, None
+        return state
+
     def load_one(self, index):
+        if self.persistent:
+            f = self._open()
+            return {label: self.io.read_one(f, label, index)
+                    for label in self.labels}
+
         with h5py.File(self.filename, 'r') as f:
             self.num_items = self._get_length(f)
             return {label: self.io.read_one(f, label, index)
                     for label in self.labels}
 
+    def load_range(self, start, stop, labels=None):
+        """Read items [start, stop) off disk, reading each label
+        in a single hyperslab selection.
+
+        :param start: index of the first item
+        :param stop: index past the last item
+        :param labels: subset of `self.labels` to read (all of them if None);
+            labels not present in `self.labels` are skipped
+        :return: a mapping from labels to arrays of items
+        """
+        labels = self.labels if None is labels else [label for label in labels if label in self.labels]
+        with get_tracer().span('hdf5.load_range', filename=self.filename, n_items=stop - start) as span:
+            if self.persistent:
+                f = self._open()
+                items = {label: self.io.read_range(f, label, start, stop)
+                         for label in labels}
+            else:
+                with h5py.File(self.filename, 'r') as f:
+                    items = {label: self.io.read_range(f, label, start, stop)
+                             for label in labels}
+            span.update(nbytes=sum(getattr(item, 'nbytes', 0) for item in items.values()))
+        return items
+
+    def load_mmap(self, label):
+        """Return a zero-copy read-only memory map of all items of a label,
+        or None if the dataset layout does not allow it (e.g. it is compressed)."""
+        with h5py.File(self.filename, 'r') as f:
+            return self.io.read_mmap(f, label)
+
     def is_loaded(self):
         return None is not self.items
 
@@ -121,3 +200,22 @@ class Hdf5File(Dataset):
             item = self.load_one(index)
 
         return item
+
+
+@functools.lru_cache(maxsize=None)
+def _torch_hdf5_file_class():
+    from torch.utils.data import Dataset
+
+    class TorchHdf5File(Hdf5File, Dataset):
+        """`Hdf5File` subclassing torch's `Dataset`, see `Hdf5File.to_torch`."""
+
+    # importable as `TorchHdf5File` from this module (e.g. when sent to data loading workers)
+    TorchHdf5File.__qualname__ = 'TorchHdf5File'
+    return TorchHdf5File
+
+
+def __getattr__(name):
+    # resolved on first use, so that importing this module does not import torch
+    if name == 'TorchHdf5File':
+        return _torch_hdf5_file_class()
+    raise AttributeError('module {} has no attribute {}'.format(__name__, name))
@@ -2,9 +2,6 @@ import collections
 
 import h5py
 import numpy as np
-# pytorch==1.2.0
-import torch
-from torch.utils.data._utils.collate import default_collate
 
 
 class HDF5Dataset:
@@ -19,12 +16,34 @@ class HDF5Dataset:
     def set(self, hdf5_file, data, compression=None):
         hdf5_file.create_dataset(self.name, data=data, dtype=self.dtype, compression=compression)
 
+    def _cast(self, data):
+        # only copy when stored type differs from the requested one
+        return np.asarray(data).astype(self.dtype, copy=False)
+
     def get(self, hdf5_file):
-        return np.array(hdf5_file[self.name]).astype(self.dtype)
+        return self._cast(hdf5_file[self.name][()])
 
     def get_one(self, hdf5_file, index):
         return hdf5_file[self.name][index]
 
+    def get_range(self, hdf5_file, start, stop):
+        """Read items [start, stop) in a single hyperslab selection."""
+        return self._cast(hdf5_file[self.name][start:stop])
+
+    def get_mmap(self, hdf5_file):
+        """Return a read-only memory map of the whole dataset if its layout
+        allows zero-copy access (contiguous, uncompressed, and stored
+        with the requested type), None otherwise."""
+        dataset = hdf5_file[self.name]
+        if dataset.chunks is not None or dataset.compression is not None \
+                or dataset.dtype != self.dtype or dataset.dtype.hasobject:
+            return None
+        offset = dataset.id.get_offset()
+        if None is offset:  # storage not allocated yet
+            return None
+        return np.memmap(hdf5_file.filename, mode='r', dtype=dataset.dtype,
+                         shape=dataset.shape, offset=offset)
+
 
 class Float64(HDF5Dataset):
     def __init__(self, name):
@@ -98,11 +117,22 @@ class HDF5IO:
         dataset = self.datasets[label]
         return dataset.get_one(hdf5_file, index)
 
+    def read_range(self, hdf5_file, label, start, stop):
+        dataset = self.datasets[label]
+        return dataset.get_range(hdf5_file, start, stop)
+
+    def read_mmap(self, hdf5_file, label):
+        dataset = self.datasets[label]
+        return dataset.get_mmap(hdf5_file)
+
     def length(self, hdf5_file):
         return len(hdf5_file[self.len_label])
 
 
 def collate_mapping_with_io(batch_mapping, io):
+    # pytorch==1.2.0; imported here to keep reading and writing data torch-free
+    from torch.utils.data._utils.collate import default_collate
+
     assert isinstance(batch_mapping[0], collections.abc.Mapping)
 
     def _batch_keys_subset(batch_mapping, keys):
@@ -130,6 +160,8 @@ def collate_varlen_to_list(batch):
 def select_items_by_predicates(batch, true_keys=None, false_keys=None):
     """Selects sub-batch where item[key] == True for each key in true_keys
     and item[key] == False for each key in false_keys"""
+    import torch
+
     any_key = next(iter(batch.keys()))
     batch_size = len(batch[any_key])
 
@@ -0,0 +1,197 @@
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Mapping
+
+
+def peak_rss_bytes() -> int:
+    """Peak resident set size of the current process, in bytes."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class Span:
+    def __init__(self, name: str, args: Mapping):
+        """A timed region of code; fields may be added to `args`
+        while the region runs (e.g. numbers of processed points)."""
+        self.name = name
+        self.args = dict(args)
+        self.start = None
+        self.duration = None
+
+    def update(self, **args):
+        self.args.update(args)
+
+
+class _NullSpan:
+    def update(self, **args):
+        pass
+
+
+class NullTracer:
+    """Tracer that records nothing, used unless tracing is enabled."""
+    enabled = False
+
+    @contextmanager
+    def span(self, name, **args):
+        yield _NullSpan()
+
+    def count(self, name, value=1):
+        pass
+
+    def event(self, name, **args):
+        pass
+
+
+class Tracer:
+    enabled = True
+
+    def __init__(self, record_rss=True):
+        """Records timed spans, instant events and counters
+        of the fusion pipeline, to be written as a trace file.
+
+        :param record_rss: if True, record peak RSS of the process
+            at the end of each span
+        """
+        self.record_rss = record_rss
+        self.records = []
+        self.counters = {}
+        self._origin = time.perf_counter()
+
+    def _now(self):
+        return time.perf_counter() - self._origin
+
+    @contextmanager
+    def span(self, name, **args):
+        """Time the enclosed code.
+
+        :param name: name of the span, e.g. 'interpolate.pair'
+        :param args: fields to attach to the span
+        """
+        span = Span(name, args)
+        span.start = self._now()
+        try:
+            yield span
+        finally:
+            span.duration = self._now() - span.start
+            if self.record_rss:
+                span.args['peak_rss_bytes'] = peak_rss_bytes()
+            self.records.append({
+                'type': 'span',
+                'name': span.name,
+                'start': span.start,
+                'duration': span.duration,
+                'pid': os.getpid(),
+                'tid': threading.get_ident(),
+                'args': span.args,
+            })
+
+    def count(self, name, value=1):
+        """Add `value` to a counter."""
+        self.counters[name] = self.counters.get(name, 0) + value
+        self.records.append({
+            'type': 'counter',
+            'name': name,
+            'start': self._now(),
+            'pid': os.getpid(),
+            'tid': threading.get_ident(),
+            'args': {name: self.counters[name]},
+        })
+
+    def event(self, name, **args):
+        """Record an instant event."""
+        self.records.append({
+            'type': 'event',
+            'name': name,
+            'start': self._now(),
+            'pid': os.getpid(),
+            'tid': threading.get_ident(),
+            'args': args,
+        })
+
+    def totals(self) -> Mapping[str, Mapping]:
+        """Number of calls and total time of spans, grouped by name."""
+        totals = {}
+        for record in self.records:
+            if record['type'] == 'span':
+                total = totals.setdefault(record['name'], {'calls': 0, 'duration': 0.})
+                total['calls'] += 1
+                total['duration'] += record['duration']
+        return totals
+
+    def write_jsonl(self, filename):
+        """Write one JSON record per line, times in seconds."""
+        with open(filename, 'w') as f:
+            for record in self.records:
+                f.write(json.dumps(record, default=_to_builtin) + '\n')
+            f.write(json.dumps({'type': 'summary', 'counters': self.counters,
+                                'spans': self.totals(), 'peak_rss_bytes': peak_rss_bytes()},
+                               default=_to_builtin) + '\n')
+
+    def write_chrome_trace(self, filename):
+        """Write a trace viewable in chrome://tracing or Perfetto."""
+        phases = {'span': 'X', 'counter': 'C', 'event': 'i'}
+        events = []
+        for record in self.records:
+            event = {
+                'name': record['name'],
+                'ph': phases[record['type']],
+                'ts': record['start'] * 1e6,
+                'pid': record['pid'],
+                'tid': record['tid'],
+                'args': record['args'],
+            }
+            if record['type'] == 'span':
+                event['dur'] = record['duration'] * 1e6
+            elif record['type'] == 'event':
+                event['s'] = 't'
+            events.append(event)
+        with open(filename, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f, default=_to_builtin)
+
+    def write(self, filename):
+        """Write the trace as JSON lines if `filename` ends with '.jsonl',
+        or in Chrome trace format otherwise."""
+        if filename.endswith('.jsonl'):
+            self.write_jsonl(filename)
+        else:
+            self.write_chrome_trace(filename)
+
+
+def _to_builtin(value):
+    # numpy scalars
+    if hasattr(value, 'item'):
+        return value.item()
+    raise TypeError('{} is not JSON serializable'.format(type(value).__name__))
+
+
+_tracer = NullTracer()
+
+
+def get_tracer():
+    """Tracer instrumented code records to (a `NullTracer` by default)."""
+    return _tracer
+
+
+def set_tracer(tracer):
+    """Make instrumented code record to `tracer`;
+    None disables tracing. Returns the previous tracer."""
+    global _tracer
+    previous, _tracer = _tracer, tracer if None is not tracer else NullTracer()
+    return previous
+
+
+@contextmanager
+def tracing(tracer):
+    """Record to `tracer` (None to disable tracing) within the enclosed code,
+    yielding the tracer in effect."""
+    previous = set_tracer(tracer)
+    try:
+        yield get_tracer()
+    finally:
+        set_tracer(previous)
@@ -4,6 +4,7 @@ import h5py
 import numpy as np
 
 import gcv_v20211_hw1.utils.hdf5.io_struct as io
+from gcv_v20211_hw1.utils.instrumentation import get_tracer
 
 
 WholeDepthMapIO = io.HDF5IO({
@@ -60,13 +61,19 @@ def save_whole_images(patches, filename):
 
 PointPatchPredictionsIO = io.HDF5IO({
     'points': io.Float64('points'),
-    'distances': io.Float64('distances')
+    'distances': io.Float64('distances'),
+    'variance': io.Float64('variance'),
 },
     len_label='distances',
     compression='lzf')
 
 
-def save_full_model_predictions(points, predictions, filename):
-    with h5py.File(filename, 'w') as f:
+def save_full_model_predictions(points, predictions, filename, **extra_datasets):
+    """Save fused points and predictions, along with per-point
+    `extra_datasets` (e.g. variance=...) of `PointPatchPredictionsIO`."""
+    with get_tracer().span('hdf5.save', filename=filename, n_points=len(points)), \
+            h5py.File(filename, 'w') as f:
         PointPatchPredictionsIO.write(f, 'points', [points])
         PointPatchPredictionsIO.write(f, 'distances', [predictions])
+        for label, values in extra_datasets.items():
+            PointPatchPredictionsIO.write(f, label, [values])
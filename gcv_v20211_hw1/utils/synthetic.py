@@ -0,0 +1,156 @@
+import numpy as np
+
+from gcv_v20211_hw1.utils.camera_utils.camera_pose import CameraPose, rotate_to_world_origin
+from gcv_v20211_hw1.utils.camera_utils.raycasting import generate_rays
+
+
+def _intersect_sphere(origins, direction, radius=0.5):
+    b = origins.dot(direction)
+    c = np.sum(origins ** 2, axis=1) - radius ** 2
+    discriminant = b ** 2 - c
+    hit = discriminant >= 0
+    t = -b - np.sqrt(np.maximum(discriminant, 0.))
+    return np.where(hit & (t > 0), t, np.inf)
+
+
+def _sphere_distances(points, radius=0.5):
+    # a sphere has no sharp features
+    return np.full(len(points), np.inf)
+
+
+def _intersect_cube(origins, direction, half_size=0.4):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t_lo = (-half_size - origins) / direction
+        t_hi = (half_size - origins) / direction
+    t_near = np.max(np.minimum(t_lo, t_hi), axis=1)
+    t_far = np.min(np.maximum(t_lo, t_hi), axis=1)
+    return np.where((t_near <= t_far) & (t_near > 0), t_near, np.inf)
+
+
+def _cube_distances(points, half_size=0.4):
+    # distance along the face to the closest edge of the face
+    abs_sorted = np.sort(np.abs(points), axis=1)
+    return half_size - abs_sorted[:, 1]
+
+
+def _intersect_cylinder(origins, direction, radius=0.4, half_height=0.4):
+    t = np.full(len(origins), np.inf)
+
+    # side surface
+    a = direction[0] ** 2 + direction[1] ** 2
+    if a > 0:
+        b = origins[:, :2].dot(direction[:2])
+        c = np.sum(origins[:, :2] ** 2, axis=1) - radius ** 2
+        discriminant = b ** 2 - a * c
+        t_side = (-b - np.sqrt(np.maximum(discriminant, 0.))) / a
+        z_side = origins[:, 2] + t_side * direction[2]
+        side_hit = (discriminant >= 0) & (t_side > 0) & (np.abs(z_side) <= half_height)
+        t[side_hit] = t_side[side_hit]
+
+    # caps
+    if direction[2] != 0:
+        for z_cap in [-half_height, half_height]:
+            t_cap = (z_cap - origins[:, 2]) / direction[2]
+            xy_cap = origins[:, :2] + t_cap[:, None] * direction[:2]
+            cap_hit = (t_cap > 0) & (np.sum(xy_cap ** 2, axis=1) <= radius ** 2)
+            t[cap_hit] = np.minimum(t[cap_hit], t_cap[cap_hit])
+    return t
+
+
+def _cylinder_distances(points, radius=0.4, half_height=0.4):
+    # distance to the closest of the two rims
+    to_rim_along_side = half_height - np.abs(points[:, 2])
+    to_rim_along_cap = radius - np.linalg.norm(points[:, :2], axis=1)
+    on_cap = to_rim_along_side < to_rim_along_cap
+    return np.where(on_cap, to_rim_along_cap, to_rim_along_side)
+
+
+SHAPES = {
+    'sphere': (_intersect_sphere, _sphere_distances),
+    'cube': (_intersect_cube, _cube_distances),
+    'cylinder': (_intersect_cylinder, _cylinder_distances),
+}
+
+# half sizes of axis-aligned bounding boxes of shapes (centered at world origin)
+_BOUNDING_BOXES = {
+    'sphere': np.array([0.5, 0.5, 0.5]),
+    'cube': np.array([0.4, 0.4, 0.4]),
+    'cylinder': np.array([0.4, 0.4, 0.4]),
+}
+
+
+def fibonacci_sphere(n_points):
+    """Place n points nearly uniformly on a unit sphere."""
+    index = np.arange(n_points) + 0.5
+    phi = np.arccos(1 - 2 * index / n_points)
+    theta = np.pi * (1 + 5 ** 0.5) * index
+    return np.stack([np.cos(theta) * np.sin(phi), np.sin(theta) * np.sin(phi), np.cos(phi)], axis=1)
+
+
+def render_scene(
+        shape='sphere',
+        n_views=8,
+        resolution_3d=0.05,
+        image_size=None,
+        camera_distance=3.0,
+        max_distance=1.0,
+        prediction_noise=0.02,
+        seed=0,
+):
+    """Synthesize depth images of an analytic shape captured from views
+    around it using parallel projection, along with ground-truth and
+    noisy predicted distance-to-feature images.
+
+    :param shape: one of `SHAPES`
+    :param n_views: number of views (cameras placed on a sphere around the shape)
+    :param resolution_3d: pixel 3d resolution
+    :param image_size: image resolution in pixels (defaults to covering
+        the projection of the bounding box of the shape in all views)
+    :param camera_distance: distance from cameras to world origin
+    :param max_distance: distances to features are clipped to this value
+    :param prediction_noise: std of Gaussian noise added to predicted distances
+    :param seed: seed for prediction noise
+
+    :return: tuple of lists of depth images, ground-truth distances,
+        predicted distances, 4x4 extrinsics, and intrinsics dicts
+    """
+    if shape not in SHAPES:
+        raise ValueError('unknown shape: {}'.format(shape))
+    intersect, distances_to_features = SHAPES[shape]
+
+    poses = [CameraPose.from_camera_axes(R=rotate_to_world_origin(camera_origin), t=camera_origin)
+             for camera_origin in camera_distance * fibonacci_sphere(n_views)]
+
+    if None is image_size:
+        # cameras look at world origin, so projections are centered in images
+        corners = _BOUNDING_BOXES[shape] * np.array(np.meshgrid([-1, 1], [-1, 1], [-1, 1])).reshape(3, -1).T
+        projected_extent = max(np.abs(corners.dot(pose.frame_axes[:2].T)).max() for pose in poses)
+        image_size = int(np.ceil(2 * projected_extent / resolution_3d)) + 2
+    _, rays_origins, _ = generate_rays((image_size, image_size), resolution_3d)
+
+    rng = np.random.RandomState(seed)
+    images, distances, predictions, extrinsics = [], [], [], []
+    for pose in poses:
+        origins = pose.camera_to_world(rays_origins)
+        direction = pose.frame_axes[2]
+
+        depth = intersect(origins, direction)
+        hit = np.isfinite(depth)
+        depth[~hit] = 0.
+
+        points = origins[hit] + depth[hit, None] * direction
+        distances_hit = np.clip(distances_to_features(points), 0., max_distance)
+        predictions_hit = np.clip(
+            distances_hit + prediction_noise * rng.randn(len(distances_hit)), 0., max_distance)
+
+        image_distances, image_predictions = np.zeros(len(depth)), np.zeros(len(depth))
+        image_distances[hit], image_predictions[hit] = distances_hit, predictions_hit
+
+        images.append(depth.reshape(image_size, image_size))
+        distances.append(image_distances.reshape(image_size, image_size))
+        predictions.append(image_predictions.reshape(image_size, image_size))
+        extrinsics.append(pose.camera_to_world_4x4)
+
+    intrinsics = [dict(resolution_image=(image_size, image_size), resolution_3d=resolution_3d)
+                  for _ in images]
+    return images, distances, predictions, extrinsics, intrinsics
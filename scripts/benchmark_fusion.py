@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+
+# Usage:
+#   python benchmark_fusion.py -o report.json
+#   python benchmark_fusion.py -s cube -r low med -v 4 8 -o report.json
+#   python benchmark_fusion.py --precision float32 --check-precision -o report.json
+#   python benchmark_fusion.py -r high --chunk-size 4096 -o report.json
+#   python benchmark_fusion.py -e numba -o report.json
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+__dir__ = os.path.normpath(
+    os.path.join(
+        os.path.dirname(os.path.realpath(__file__)), '..'))
+sys.path[1:1] = [__dir__]
+
+from gcv_v20211_hw1.fusion.batch_interpolation import INTERPOLATION_METHODS
+from gcv_v20211_hw1.fusion.combiners import AGGREGATION_METHODS, combine_predictions
+import gcv_v20211_hw1.fusion.interpolators as interpolators
+from gcv_v20211_hw1.fusion.interpolators import INTERPOLATION_ENGINES
+from gcv_v20211_hw1.fusion.pipeline import HIGH_RES, LOW_RES, MED_RES, PRECISIONS
+from gcv_v20211_hw1.utils.synthetic import SHAPES, render_scene
+
+RESOLUTIONS = {
+    'high': HIGH_RES,
+    'med': MED_RES,
+    'low': LOW_RES,
+}
+
+
+def measure(func, repeat=1):
+    """Run `func` `repeat` times measuring wall time, then once more
+    measuring peak memory allocated by Python and numpy (via tracemalloc).
+
+    :return: tuple of the result of the last call and a dict of measurements
+    """
+    times = []
+    for _ in range(repeat):
+        # silence progress output of the measured functions
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            result = func()
+            times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    with contextlib.redirect_stdout(io.StringIO()):
+        func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return result, {
+        'time_s_min': min(times),
+        'time_s_median': float(np.median(times)),
+        'peak_memory_bytes': peak,
+    }
+
+
+def fuse_scene(images, distances, predictions, extrinsics, intrinsics, aggregation, dtype, **interpolation_params):
+    """Run the whole fusion pipeline on a scene in a given floating point type."""
+    images = [image.astype(dtype) for image in images]
+    distances = [distances_i.astype(dtype) for distances_i in distances]
+    predictions = [predictions_i.astype(dtype) for predictions_i in predictions]
+    points_gt, distances_gt = interpolators.interpolate_ground_truth(images, distances, extrinsics, intrinsics)
+    list_predictions, list_indexes_in_whole, _, list_weights = interpolators.multi_view_interpolate_predictions(
+        images, predictions, extrinsics, intrinsics, return_points=False, return_weights=True,
+        **interpolation_params)
+    fused_predictions, _ = combine_predictions(
+        len(points_gt), list_predictions, list_indexes_in_whole,
+        aggregation_method=aggregation, list_weights=list_weights)
+    return points_gt, distances_gt, fused_predictions
+
+
+def check_precision(scene, options, **interpolation_params):
+    """Compare outputs of the pipeline run in `options.precision` to those
+    computed in double precision.
+
+    Single precision may break exact ties between neighbours differently,
+    so a small fraction of points may legitimately differ by more than
+    `options.tolerance`; the check fails if this fraction exceeds `options.max_outliers`.
+    """
+    reference = fuse_scene(*scene, options.aggregation, np.float64, **interpolation_params)
+    result = fuse_scene(*scene, options.aggregation, np.dtype(options.precision), **interpolation_params)
+
+    errors = {}
+    for name, expected, actual in zip(['points', 'distances_gt', 'predictions'], reference, result):
+        both = np.isfinite(expected) & np.isfinite(actual)
+        error = np.abs(expected - actual.astype(np.float64))
+        error[~both] = np.where(np.isfinite(expected) == np.isfinite(actual), 0., np.inf)[~both]
+        error = error.reshape(len(error), -1).max(axis=1)
+        errors[name] = {
+            'max_abs_error': float(error.max()) if len(error) > 0 else 0.,
+            'outliers': float(np.mean(error > options.tolerance)) if len(error) > 0 else 0.,
+        }
+    passed = all(error['outliers'] <= options.max_outliers for error in errors.values())
+    return dict(errors, passed=passed)
+
+
+def benchmark_scene(shape, resolution_3d, n_views, options):
+    scene = render_scene(
+        shape=shape,
+        n_views=n_views,
+        resolution_3d=resolution_3d,
+        image_size=options.image_size,
+        seed=options.seed)
+    images, distances, predictions, extrinsics, intrinsics = scene
+    # camera poses are kept in double precision
+    images, distances, predictions = [
+        [array.astype(options.precision) for array in arrays]
+        for arrays in [images, distances, predictions]]
+    interpolation_params = dict(
+        nn_set_size=options.nn_set_size,
+        distance_interpolation_threshold=resolution_3d * options.distance_interp_factor,
+        method=options.interpolation_method,
+        engine=options.interpolation_engine,
+        chunk_size=options.chunk_size,
+        occlusion_tolerance=resolution_3d * options.occlusion_factor if None is not options.occlusion_factor else None)
+
+    stages = {}
+    (points_gt, _), stages['interpolate_ground_truth'] = measure(
+        lambda: interpolators.interpolate_ground_truth(images, distances, extrinsics, intrinsics),
+        repeat=options.repeat)
+
+    # a single pair of neighbouring views
+    view_i = interpolators.get_view(images, predictions, extrinsics, intrinsics, 0)
+    view_j = interpolators.get_view(images, predictions, extrinsics, intrinsics, 1 % n_views)
+    indexes_j = np.arange(len(view_j[2]))
+    _, stages['pairwise_interpolate_predictions'] = measure(
+        lambda: interpolators.pairwise_interpolate_predictions(
+            view_i, view_j, indexes_j, **interpolation_params),
+        repeat=options.repeat)
+
+    (list_predictions, list_indexes_in_whole, _, list_weights), stages['multi_view_interpolate_predictions'] = measure(
+        lambda: interpolators.multi_view_interpolate_predictions(
+            images, predictions, extrinsics, intrinsics, return_points=False, return_weights=True,
+            **interpolation_params),
+        repeat=options.repeat)
+
+    _, stages['combine_predictions'] = measure(
+        lambda: combine_predictions(
+            len(points_gt), list_predictions, list_indexes_in_whole,
+            aggregation_method=options.aggregation, list_weights=list_weights),
+        repeat=options.repeat)
+
+    case = {
+        'shape': shape,
+        'resolution_3d': resolution_3d,
+        'n_views': n_views,
+        'image_size': images[0].shape[0],
+        'n_points': len(points_gt),
+        'n_predictions': int(sum(len(predictions) for predictions in list_predictions)),
+        'stages': stages,
+    }
+    if options.check_precision:
+        case['precision_check'] = check_precision(scene, options, **interpolation_params)
+    return case
+
+
+def main(options):
+    report = {
+        'environment': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+        },
+        'parameters': vars(options),
+        'cases': [],
+    }
+    for shape in options.shapes:
+        for resolution in options.resolutions:
+            for n_views in options.views:
+                print('Benchmarking {} at {} resolution with {} views...'.format(shape, resolution, n_views))
+                case = benchmark_scene(shape, RESOLUTIONS[resolution], n_views, options)
+                for stage, measurements in case['stages'].items():
+                    print('  {:40s} {:10.4f} s {:12.1f} MiB'.format(
+                        stage, measurements['time_s_min'], measurements['peak_memory_bytes'] / 2 ** 20))
+                if 'precision_check' in case:
+                    check = case['precision_check']
+                    print('  {} vs float64: max abs error of predictions {:.3g} ({:.3%} outliers){}'.format(
+                        options.precision, check['predictions']['max_abs_error'],
+                        check['predictions']['outliers'], '' if check['passed'] else '  FAILED'))
+                report['cases'].append(dict(resolution=resolution, **case))
+
+    with open(options.output_filename, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print('Saved report to {}'.format(options.output_filename))
+    return all(case['precision_check']['passed'] for case in report['cases'] if 'precision_check' in case)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-o', '--output', dest='output_filename', required=True,
+                        help='Path to output JSON report.')
+    parser.add_argument('-s', '--shapes', dest='shapes', nargs='+', default=sorted(SHAPES),
+                        choices=sorted(SHAPES), help='Synthetic shapes to benchmark on.')
+    parser.add_argument('-r', '--resolutions', dest='resolutions', nargs='+', default=['low', 'med'],
+                        choices=list(RESOLUTIONS), help='3D resolutions of scans.')
+    parser.add_argument('-v', '--views', dest='views', nargs='+', type=int, default=[4, 8],
+                        help='Numbers of views to benchmark with.')
+    parser.add_argument('--image-size', dest='image_size', type=int, default=None,
+                        help='Image resolution in pixels (by default, images cover the shape at given resolution).')
+    parser.add_argument('-n', '--repeat', dest='repeat', type=int, default=3,
+                        help='Number of timed runs per stage.')
+    parser.add_argument('--seed', dest='seed', type=int, default=0,
+                        help='Seed for noise in synthetic predictions.')
+    parser.add_argument('-k', '--nn_set_size', dest='nn_set_size', required=False, default=4, type=int,
+                        help='Number of neighbors used for interpolation.')
+    parser.add_argument('-f', '--distance_interp_factor', dest='distance_interp_factor', required=False, type=float, default=6.,
+                        help='distance_interp_factor * resolution_3d is the distance_interpolation_threshold')
+    parser.add_argument('-i', '--interpolation-method', dest='interpolation_method', required=False, type=str, default='bilin',
+                        choices=INTERPOLATION_METHODS, help='Method used to interpolate predictions between views.')
+    parser.add_argument('-e', '--interpolation-engine', dest='interpolation_engine', required=False, type=str, default='batch',
+                        choices=INTERPOLATION_ENGINES, help='Engine used to interpolate predictions between views.')
+    parser.add_argument('-a', '--aggregation', dest='aggregation', type=str,
+                        choices=AGGREGATION_METHODS, default='min')
+    parser.add_argument('--occlusion-factor', dest='occlusion_factor', type=float, default=None,
+                        help='occlusion_factor * resolution_3d is the max difference between depth of a reprojected point '
+                             'and depth of the view at its nearest pixel (distance_interpolation_threshold by default).')
+    parser.add_argument('--chunk-size', dest='chunk_size', type=int, default=None,
+                        help='Number of points of a view to interpolate at once, bounding memory per pair of views.')
+    parser.add_argument('--precision', dest='precision', type=str, default='float64',
+                        choices=PRECISIONS, help='Floating point type of images, points and predictions.')
+    parser.add_argument('--check-precision', dest='check_precision', action='store_true', default=False,
+                        help='Compare fused outputs computed in given precision to those computed in float64.')
+    parser.add_argument('--tolerance', dest='tolerance', type=float, default=1e-4,
+                        help='Maximum absolute error of fused outputs for the precision check.')
+    parser.add_argument('--max-outliers', dest='max_outliers', type=float, default=1e-3,
+                        help='Maximum fraction of points exceeding the tolerance for the precision check.')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    options = parse_args()
+    sys.exit(0 if main(options) else 1)
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+# Usage:
+#   python benchmark_startup.py
+#   python benchmark_startup.py --budget 0.5 -n 10
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+__dir__ = os.path.normpath(
+    os.path.join(
+        os.path.dirname(os.path.realpath(__file__)), '..'))
+
+SCRIPTS = ['fuse_images.py', 'fuse_batch.py']
+# modules the fusion CLI does not need to start up
+HEAVY_MODULES = ['torch', 'trimesh', 'scipy', 'k3d', 'numba']
+
+
+def time_startup(script, repeat):
+    """Minimum wall time of running `script --help` in a fresh interpreter."""
+    command = [sys.executable, os.path.join(__dir__, 'scripts', script), '--help']
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def imported_heavy_modules(script):
+    """Heavy modules imported by `script` at startup (i.e. before arguments are parsed)."""
+    code = (
+        'import runpy, sys, json\n'
+        'sys.argv = [{script!r}, "--help"]\n'
+        'try:\n'
+        '    runpy.run_path({script!r}, run_name="__main__")\n'
+        'except SystemExit:\n'
+        '    pass\n'
+        'print(json.dumps(sorted(m for m in {modules!r} if m in sys.modules)), file=sys.stderr)\n'
+    ).format(script=os.path.join(__dir__, 'scripts', script), modules=HEAVY_MODULES)
+    result = subprocess.run([sys.executable, '-c', code], check=True,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    return json.loads(result.stderr.strip().splitlines()[-1])
+
+
+def main(options):
+    failed = False
+    for script in SCRIPTS:
+        startup = time_startup(script, options.repeat)
+        heavy = imported_heavy_modules(script)
+        within_budget = startup <= options.budget
+        print('{:20s} {:8.3f} s (budget {:.3f} s){}{}'.format(
+            script, startup, options.budget,
+            '' if within_budget else '  OVER BUDGET',
+            '' if not heavy else '  imports {}'.format(', '.join(heavy))))
+        failed = failed or not within_budget or len(heavy) > 0
+    return failed
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--budget', dest='budget', type=float, default=1.0,
+                        help='Maximum startup time of each script, in seconds.')
+    parser.add_argument('-n', '--repeat', dest='repeat', type=int, default=5,
+                        help='Number of timed runs per script.')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    options = parse_args()
+    sys.exit(1 if main(options) else 0)
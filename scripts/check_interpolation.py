@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+
+# Usage:
+#   python check_interpolation.py
+#
+# Regression checks of interpolation engines against reference implementations;
+# exits with a non-zero status if any of the checks fails.
+
+import argparse
+import os
+import sys
+import warnings
+
+import numpy as np
+
+__dir__ = os.path.normpath(
+    os.path.join(
+        os.path.dirname(os.path.realpath(__file__)), '..'))
+sys.path[1:1] = [__dir__]
+
+from gcv_v20211_hw1.fusion.batch_interpolation import interpolate_batch
+from gcv_v20211_hw1.fusion.combiners import combine_predictions
+import gcv_v20211_hw1.fusion.interpolators as interpolators
+from gcv_v20211_hw1.utils.camera_utils.imaging import RaycastingImaging
+from gcv_v20211_hw1.utils.synthetic import render_scene
+
+
+def check_off_grid_bilinear(options):
+    """Bilinear fits of the batch engine match `bisplrep`/`bisplev`
+    for query points outside the bounding box of their neighbours
+    (e.g. reprojected just outside the pixel grid of a view)."""
+    from scipy import interpolate
+
+    rng = np.random.default_rng(options.seed)
+    corners = np.array([[0., 0.], [1., 0.], [0., 1.], [1., 1.]])
+    errors = []
+    for _ in range(options.n_queries):
+        uv_nns = rng.integers(0, 8, 2) + corners
+        values = rng.random(len(uv_nns))
+        uv_query = uv_nns[0] + rng.uniform(-1.5, 2.5, 2)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            tck = interpolate.bisplrep(*uv_nns.T, values, kx=1, ky=1)
+        expected = interpolate.bisplev(*uv_query, tck)
+        actual, _ = interpolate_batch(uv_nns[None], values[None], uv_query[None], method='bispline')
+        errors.append(abs(actual[0] - expected))
+    return max(errors) < options.tolerance, 'max abs error {:.2e}'.format(max(errors))
+
+
+def check_grid_neighbours(options):
+    """Nearest pixels found by `RaycastingImaging.query_grid` match
+    `cKDTree` for points in and around the image, including points
+    several pixels outside its border."""
+    from scipy.spatial import cKDTree
+
+    rng = np.random.default_rng(options.seed)
+    imaging = RaycastingImaging((24, 32), 0.05)
+    tree = cKDTree(imaging.rays_origins[:, :2])
+    margin = 8 * imaging.resolution_3d
+    uv = rng.uniform(imaging.rays_origins[:, :2].min(axis=0) - margin,
+                     imaging.rays_origins[:, :2].max(axis=0) + margin,
+                     (100 * options.n_queries, 2))
+    errors = []
+    for k in [1, 4, 9, 16]:
+        expected, _ = tree.query(uv, k=k)
+        actual, _ = imaging.query_grid(uv, k=k)
+        # compare distances only, as equidistant pixels may come in any order
+        errors.append(np.abs(actual - expected.reshape(actual.shape)).max())
+    return max(errors) < options.tolerance, 'max abs error {:.2e}'.format(max(errors))
+
+
+def check_pointwise_engine(options):
+    """Batch and pointwise engines agree on a scene where points
+    of a view reproject outside the pixel grid of other views."""
+    images, distances, predictions, extrinsics, intrinsics = render_scene(
+        'cube', 4, 0.04, seed=options.seed, image_size=24)
+    interpolation_params = dict(distance_interpolation_threshold=0.24, method='bispline')
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        results = [
+            interpolators.multi_view_interpolate_predictions(
+                images, predictions, extrinsics, intrinsics, engine=engine, return_points=False,
+                **interpolation_params)
+            for engine in ['batch', 'pointwise']]
+
+    (batch_predictions, batch_indexes, _), (pointwise_predictions, pointwise_indexes, _) = results
+    same_points = all(np.array_equal(a, b) for a, b in zip(batch_indexes, pointwise_indexes))
+    if not same_points:
+        return False, 'interpolated points differ'
+    error = max((np.abs(a - b).max() for a, b in zip(batch_predictions, pointwise_predictions) if len(a) > 0),
+                default=0.)
+    return error < options.tolerance, 'max abs error {:.2e}'.format(error)
+
+
+def check_numba_engine(options):
+    """Numba and batch engines agree for all interpolation methods,
+    with default and tight occlusion tolerance."""
+    try:
+        import numba  # noqa: F401
+    except ImportError:
+        return True, 'skipped (numba is not installed)'
+
+    images, distances, predictions, extrinsics, intrinsics = render_scene(
+        'cube', 6, 0.04, seed=options.seed)
+    errors = []
+    for method in ['bilin', 'barycentric', 'idw']:
+        for occlusion_tolerance in [None, 0.04]:
+            interpolation_params = dict(distance_interpolation_threshold=0.24, method=method,
+                                        occlusion_tolerance=occlusion_tolerance)
+            (batch_predictions, batch_indexes, _, batch_weights), (numba_predictions, numba_indexes, _, numba_weights) = [
+                interpolators.multi_view_interpolate_predictions(
+                    images, predictions, extrinsics, intrinsics, engine=engine,
+                    return_points=False, return_weights=True, **interpolation_params)
+                for engine in ['batch', 'numba']]
+            if not all(np.array_equal(a, b) for a, b in zip(batch_indexes, numba_indexes)):
+                return False, 'interpolated points differ for {}, occlusion_tolerance={}'.format(
+                    method, occlusion_tolerance)
+            errors.extend(np.abs(a - b).max()
+                          for a, b in zip(batch_predictions + batch_weights, numba_predictions + numba_weights)
+                          if len(a) > 0)
+    error = max(errors, default=0.)
+    return error < options.tolerance, 'max abs error {:.2e}'.format(error)
+
+
+def check_float32_precision(options):
+    """Fused outputs computed in single precision match those computed
+    in double precision, up to `options.precision_tolerance`; single precision
+    may break exact ties between neighbours differently, so a fraction
+    of points up to `options.max_outliers` may differ by more."""
+    scene = render_scene('sphere', 6, 0.05, seed=options.seed)
+    images, distances, predictions, extrinsics, intrinsics = scene
+    interpolation_params = dict(distance_interpolation_threshold=0.3, method='bilin')
+
+    outputs = []
+    for dtype in [np.float64, np.float32]:
+        # camera poses are kept in double precision
+        images_, distances_, predictions_ = [
+            [array.astype(dtype) for array in arrays] for arrays in [images, distances, predictions]]
+        points_gt, distances_gt = interpolators.interpolate_ground_truth(images_, distances_, extrinsics, intrinsics)
+        list_predictions, list_indexes_in_whole, _, list_weights = \
+            interpolators.multi_view_interpolate_predictions(
+                images_, predictions_, extrinsics, intrinsics, return_points=False, return_weights=True,
+                **interpolation_params)
+        fused_predictions, _ = combine_predictions(
+            len(points_gt), list_predictions, list_indexes_in_whole,
+            aggregation_method='min', list_weights=list_weights)
+        outputs.append((points_gt, distances_gt, fused_predictions))
+
+    errors, outliers = [0.], [0.]
+    for expected, actual in zip(*outputs):
+        if expected.shape != actual.shape:
+            return False, 'numbers of points differ'
+        error = np.abs(expected - actual.astype(np.float64))
+        # points not interpolated in either precision are not compared
+        both = np.isfinite(expected) & np.isfinite(actual)
+        error[~both] = np.where(np.isfinite(expected) == np.isfinite(actual), 0., np.inf)[~both]
+        error = error.reshape(len(error), -1).max(axis=1)
+        errors.append(error[np.isfinite(error)].max(initial=0.))
+        outliers.append(np.mean(error > options.precision_tolerance) if len(error) > 0 else 0.)
+    return max(outliers) <= options.max_outliers, 'max abs error {:.2e} ({:.3%} outliers)'.format(
+        max(errors), max(outliers))
+
+
+CHECKS = [
+    check_off_grid_bilinear,
+    check_grid_neighbours,
+    check_pointwise_engine,
+    check_numba_engine,
+    check_float32_precision,
+]
+
+
+def main(options):
+    passed = True
+    for check in CHECKS:
+        ok, message = check(options)
+        print('{:32s} {:6s} {}'.format(check.__name__, 'ok' if ok else 'FAILED', message))
+        passed &= ok
+    return passed
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--seed', dest='seed', type=int, default=0,
+                        help='Seed for random queries and noise in synthetic predictions.')
+    parser.add_argument('--n-queries', dest='n_queries', type=int, default=200,
+                        help='Number of random off-grid queries.')
+    parser.add_argument('--tolerance', dest='tolerance', type=float, default=1e-9,
+                        help='Maximum absolute difference between engines.')
+    parser.add_argument('--precision-tolerance', dest='precision_tolerance', type=float, default=1e-4,
+                        help='Maximum absolute difference between outputs computed in float32 and float64.')
+    parser.add_argument('--max-outliers', dest='max_outliers', type=float, default=1e-3,
+                        help='Maximum fraction of points exceeding the precision tolerance.')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    options = parse_args()
+    sys.exit(0 if main(options) else 1)
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+
+# Usage:
+#   python fuse_batch.py -m manifest.json -o output_dir/ -w 4
+#
+# The manifest is a JSON list of models to fuse:
+#   [
+#     {"true_filename": "validation/med_res/abc_0050_00500348_fae0ecd8b3dc068d39f0d09c_000.hdf5",
+#      "pred_filename": "validation/med_res/abc_0050_00500348_fae0ecd8b3dc068d39f0d09c_000__predictions.hdf5",
+#      "resolution_3d": 0.05},
+#     ...
+#   ]
+# Each entry may also set "output_dir" (defaults to the --output-dir option).
+
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+
+__dir__ = os.path.normpath(
+    os.path.join(
+        os.path.dirname(os.path.realpath(__file__)), '..'))
+sys.path[1:1] = [__dir__]
+
+from gcv_v20211_hw1.fusion.batch_interpolation import INTERPOLATION_METHODS
+from gcv_v20211_hw1.fusion.interpolators import INTERPOLATION_ENGINES
+from gcv_v20211_hw1.fusion.combiners import AGGREGATION_METHODS
+from gcv_v20211_hw1.fusion.pipeline import HIGH_RES, PRECISIONS, fuse_model
+from gcv_v20211_hw1.utils.instrumentation import Tracer, peak_rss_bytes, tracing
+
+
+def load_manifest(filename, output_dir, default_resolution_3d):
+    with open(filename) as f:
+        entries = json.load(f)
+    models = []
+    for entry in entries:
+        models.append({
+            'true_filename': entry['true_filename'],
+            'pred_filename': entry['pred_filename'],
+            'resolution_3d': float(entry.get('resolution_3d', default_resolution_3d)),
+            'output_dir': entry.get('output_dir', output_dir),
+        })
+    return models
+
+
+def fuse_one(args):
+    """Fuse a single model, returning its timing summary
+    (failures are reported in the summary instead of raised)."""
+    model, fusion_params = args
+    summary = dict(model, pid=os.getpid())
+    start = time.perf_counter()
+    with tracing(Tracer(record_rss=False)) as tracer:
+        try:
+            os.makedirs(model['output_dir'], exist_ok=True)
+            summary.update(fuse_model(
+                model['true_filename'],
+                model['pred_filename'],
+                model['output_dir'],
+                resolution_3d=model['resolution_3d'],
+                verbose=False,
+                **fusion_params))
+            summary['status'] = 'ok'
+        except Exception as e:
+            summary['status'] = 'failed'
+            summary['error'] = '{}: {}'.format(type(e).__name__, e)
+            summary['traceback'] = traceback.format_exc()
+
+    summary['wall_time'] = time.perf_counter() - start
+    summary['phases'] = {name: total['duration'] for name, total in tracer.totals().items()}
+    summary['peak_rss_bytes'] = peak_rss_bytes()
+    return summary
+
+
+def main(options):
+    models = load_manifest(options.manifest_filename, options.output_dir, options.resolution_3d)
+    # Models of the same resolution go next to each other, so that
+    # a worker tends to reuse ray grids cached for the previous model.
+    models.sort(key=lambda model: model['resolution_3d'])
+
+    fusion_params = dict(
+        nn_set_size=options.nn_set_size,
+        distance_interp_factor=options.distance_interp_factor,
+        occlusion_factor=options.occlusion_factor,
+        interpolation_method=options.interpolation_method,
+        interpolation_engine=options.interpolation_engine,
+        aggregation=options.aggregation,
+        cull=options.cull,
+        streaming=options.streaming,
+        reservoir_size=options.reservoir_size,
+        sparse=options.sparse,
+        precision=options.precision,
+        chunk_size=options.chunk_size,
+        pair_cache_dir=options.pair_cache_dir)
+    tasks = [(model, fusion_params) for model in models]
+
+    start = time.perf_counter()
+    summaries = []
+    if options.workers > 1:
+        with multiprocessing.Pool(options.workers) as pool:
+            for summary in pool.imap_unordered(fuse_one, tasks):
+                summaries.append(summary)
+                print_summary(summary, len(summaries), len(models))
+    else:
+        for task in tasks:
+            summary = fuse_one(task)
+            summaries.append(summary)
+            print_summary(summary, len(summaries), len(models))
+    wall_time = time.perf_counter() - start
+
+    n_failed = sum(summary['status'] != 'ok' for summary in summaries)
+    print('Fused {} of {} models in {:.2f} s'.format(len(models) - n_failed, len(models), wall_time))
+
+    summary_filename = options.summary_filename or os.path.join(options.output_dir, 'summary.json')
+    os.makedirs(os.path.dirname(os.path.abspath(summary_filename)), exist_ok=True)
+    with open(summary_filename, 'w') as f:
+        json.dump({
+            'wall_time': wall_time,
+            'workers': options.workers,
+            'parameters': fusion_params,
+            'models': sorted(summaries, key=lambda summary: summary['true_filename']),
+        }, f, indent=2)
+    print('Saved summary to {}'.format(summary_filename))
+    return n_failed
+
+
+def print_summary(summary, index, n_models):
+    name = os.path.basename(summary['true_filename'])
+    if summary['status'] != 'ok':
+        print('[{}/{}] {} FAILED: {}'.format(index, n_models, name, summary['error']))
+        return
+    phases = ', '.join(
+        '{} {:.2f} s'.format(phase[len('phase.'):], duration)
+        for phase, duration in summary['phases'].items() if phase.startswith('phase.'))
+    print('[{}/{}] {} ({} points): {:.2f} s ({})'.format(
+        index, n_models, name, summary['n_points'], summary['wall_time'], phases))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-m', '--manifest', dest='manifest_filename', required=True,
+                        help='Path to JSON list of models to fuse.')
+    parser.add_argument('-o', '--output-dir', dest='output_dir', required=True,
+                        help='Path to output for models not specifying their own output directory.')
+    parser.add_argument('-s', '--summary', dest='summary_filename', required=False, default=None,
+                        help='Path to JSON timing summary (defaults to summary.json in output directory).')
+    parser.add_argument('-w', '--workers', dest='workers', type=int, default=1,
+                        help='Number of processes to distribute models across.')
+    parser.add_argument('-k', '--nn_set_size', dest='nn_set_size', required=False, default=4, type=int,
+                        help='Number of neighbors used for interpolation.')
+    parser.add_argument('-r', '--resolution_3d', dest='resolution_3d', required=False, default=HIGH_RES, type=float,
+                        help='3D resolution of scans not specifying their own resolution.')
+    parser.add_argument('-f', '--distance_interp_factor', dest='distance_interp_factor', required=False, type=float, default=6.,
+                        help='distance_interp_factor * resolution_3d is the distance_interpolation_threshold')
+    parser.add_argument('-i', '--interpolation-method', dest='interpolation_method', required=False, type=str, default='bilin',
+                        choices=INTERPOLATION_METHODS, help='Method used to interpolate predictions between views.')
+    parser.add_argument('-e', '--interpolation-engine', dest='interpolation_engine', required=False, type=str, default='batch',
+                        choices=INTERPOLATION_ENGINES, help='Interpolate all points at once, construct an interpolator per point, '
+                                                            'or run a compiled per-point kernel (requires numba).')
+    parser.add_argument('-a', '--aggregation', dest='aggregation', type=str,
+                        choices=AGGREGATION_METHODS, default='min')
+    parser.add_argument('--cull', dest='cull', action='store_true', default=False,
+                        help='Skip pairs of views that cannot overlap before interpolation.')
+    parser.add_argument('--streaming', dest='streaming', action='store_true', default=False,
+                        help='Aggregate predictions on the fly, keeping memory independent of the number of views.')
+    parser.add_argument('--sparse', dest='sparse', action='store_true', default=False,
+                        help='Keep only foreground pixels of views, saving memory.')
+    parser.add_argument('--precision', dest='precision', type=str, default='float64',
+                        choices=PRECISIONS, help='Floating point type of images, points and predictions.')
+    parser.add_argument('--occlusion-factor', dest='occlusion_factor', type=float, default=None,
+                        help='occlusion_factor * resolution_3d is the max difference between depth of a reprojected point '
+                             'and depth of the view at its nearest pixel (distance_interpolation_threshold by default).')
+    parser.add_argument('--chunk-size', dest='chunk_size', type=int, default=None,
+                        help='Number of points of a view to interpolate at once, bounding memory per pair of views.')
+    parser.add_argument('--pair-cache', dest='pair_cache_dir', type=str, default=None,
+                        help='Directory to cache interpolated predictions of pairs of views in, '
+                             'reused by runs with the same inputs and interpolation parameters.')
+    parser.add_argument('--reservoir-size', dest='reservoir_size', type=int, default=32,
+                        help='Number of predictions per point kept for truncated aggregations in streaming mode.')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    options = parse_args()
+    sys.exit(1 if main(options) > 0 else 0)
@@ -7,111 +7,38 @@ import argparse
 import os
 import sys
 
-import numpy as np
-
 __dir__ = os.path.normpath(
     os.path.join(
         os.path.dirname(os.path.realpath(__file__)), '..'))
 sys.path[1:1] = [__dir__]
 
-import gcv_v20211_hw1.utils.sharpf_io as sharpf_io
-from gcv_v20211_hw1.utils.hdf5.dataset import Hdf5File, PreloadTypes
-from gcv_v20211_hw1.fusion.combiners import combine_predictions
-import gcv_v20211_hw1.fusion.interpolators as interpolators
+from gcv_v20211_hw1.fusion.batch_interpolation import INTERPOLATION_METHODS
+from gcv_v20211_hw1.fusion.combiners import AGGREGATION_METHODS
+from gcv_v20211_hw1.fusion.interpolators import INTERPOLATION_ENGINES
+from gcv_v20211_hw1.fusion.pipeline import HIGH_RES, PRECISIONS, fuse_model
+from gcv_v20211_hw1.utils.instrumentation import Tracer, tracing
 
-HIGH_RES = 0.02
-MED_RES = 0.05
-LOW_RES = 0.125
 
 def main(options):
-    # extract a filename from the input pathname to use further
-    name = os.path.splitext(os.path.basename(options.true_filename))[0]
-
-    # load ground truth images and distances
-    print('Loading ground truth data...')
-    gt_dataset = Hdf5File(
+    fuse_model(
         options.true_filename,
-        io=sharpf_io.WholeDepthMapIO,
-        preload=PreloadTypes.LAZY,
-        labels='*')
-    # depth images captured from a variety of views around the 3D shape
-    gt_images = [view['image'] for view in gt_dataset]
-    # ground-truth distances (multi-view consistent for the global 3D shape)
-    gt_distances = [view.get('distances', np.ones_like(view['image'])) for view in gt_dataset]
-    # extrinsic camera matrixes describing the 3D camera poses used to capture depth images
-    gt_extrinsics = [view['camera_pose'] for view in gt_dataset]
-    # intrinsic camera parameters describing how to compute image from points and vice versa
-    gt_intrinsics = [dict(resolution_image=gt_images[0].shape, resolution_3d=options.resolution_3d) for view in gt_dataset]
-
-    # construct the globally consistent 3D point cloud
-    # from a list of individual image-distances pairs
-    print('Fusing ground truth data...')
-    fused_points_gt, \
-    fused_distances_gt = interpolators.interpolate_ground_truth(
-        gt_images,
-        gt_distances,
-        gt_extrinsics,
-        gt_intrinsics)
-    n_points = len(fused_points_gt)
-
-    # save point cloud with ground-truth distance-to-feature values to an output file
-    gt_output_filename = os.path.join(
-        options.output_dir,
-        '{}__{}.hdf5'.format(name, 'ground_truth'))
-    print('Saving ground truth to {}'.format(gt_output_filename))
-    sharpf_io.save_full_model_predictions(
-        fused_points_gt,
-        fused_distances_gt,
-        gt_output_filename)
-
-    # load predicted distances
-    print('Loading predictions...')
-    predictions_dataset = Hdf5File(
         options.pred_filename,
-        io=sharpf_io.WholeDepthMapIO,
-        preload=PreloadTypes.LAZY,
-        labels='*')
-    # predicted distances (NOT multi-view consistent, as each CNN only had access to a particular view)
-    pred_distances = [view['distances'] for view in predictions_dataset]
-
-    # Interpolate predictions from individual views by re-projecting them
-    # from view i to view j for each pair (i, j) of views,
-    # obtaining several predictions for each measured point.
-    print('Interpolating predictions...')
-    threshold = options.resolution_3d * options.distance_interp_factor
-    list_predictions, \
-    list_indexes_in_whole, \
-    list_points = interpolators.multi_view_interpolate_predictions(
-        gt_images,
-        pred_distances,
-        gt_extrinsics,
-        gt_intrinsics,
-        nn_set_size=options.nn_set_size,
-        distance_interpolation_threshold=threshold,
-        method=options.interpolation_method)
-
-    # Now that we have obtained a set of predictions per each individual point,
-    # we can combine distance-to-feature predictions into a consolidated
-    # point cloud by simply taking min value across all distance-to-feature predictions
-    print('Fusing predictions...')
-    combined_predictions, \
-    prediction_variants = \
-        combine_predictions(
-            n_points,
-            list_predictions,
-            list_indexes_in_whole,
-            list_points,
-            aggregation_method=options.aggregation)
-
-    # save point cloud with predicted distance-to-feature values to an output file
-    pred_output_filename = os.path.join(
         options.output_dir,
-        '{}__{}.hdf5'.format(name, 'interpolated'))
-    print('Saving predictions to {}'.format(pred_output_filename))
-    sharpf_io.save_full_model_predictions(
-        fused_points_gt,
-        combined_predictions,
-        pred_output_filename)
+        resolution_3d=options.resolution_3d,
+        nn_set_size=options.nn_set_size,
+        distance_interp_factor=options.distance_interp_factor,
+        occlusion_factor=options.occlusion_factor,
+        interpolation_method=options.interpolation_method,
+        interpolation_engine=options.interpolation_engine,
+        aggregation=options.aggregation,
+        workers=options.workers,
+        cull=options.cull,
+        streaming=options.streaming,
+        reservoir_size=options.reservoir_size,
+        sparse=options.sparse,
+        precision=options.precision,
+        chunk_size=options.chunk_size,
+        pair_cache_dir=options.pair_cache_dir)
 
 
 def parse_args():
@@ -129,13 +56,43 @@ def parse_args():
     parser.add_argument('-f', '--distance_interp_factor', dest='distance_interp_factor', required=False, type=float, default=6.,
                         help='distance_interp_factor * resolution_3d is the distance_interpolation_threshold')
     parser.add_argument('-i', '--interpolation-method', dest='interpolation_method', required=False, type=str, default='bilin',
-                        choices=['bilin', 'bispline'], help='distance_interp_factor * resolution_3d is the distance_interpolation_threshold')
+                        choices=INTERPOLATION_METHODS, help='Method used to interpolate predictions between views.')
+    parser.add_argument('-e', '--interpolation-engine', dest='interpolation_engine', required=False, type=str, default='batch',
+                        choices=INTERPOLATION_ENGINES, help='Interpolate all points at once, construct an interpolator per point, '
+                                                            'or run a compiled per-point kernel (requires numba).')
     parser.add_argument('-a', '--aggregation', dest='aggregation', type=str, 
-                        choices=['min', 'truncated_min', 'trancated_mean', 'truncated_median',], default='min')
+                        choices=AGGREGATION_METHODS, default='min')
+    parser.add_argument('-w', '--workers', dest='workers', type=int, default=1,
+                        help='Number of processes to distribute pairs of views across.')
+    parser.add_argument('--cull', dest='cull', action='store_true', default=False,
+                        help='Skip pairs of views that cannot overlap before interpolation.')
+    parser.add_argument('--streaming', dest='streaming', action='store_true', default=False,
+                        help='Aggregate predictions on the fly, keeping memory independent of the number of views.')
+    parser.add_argument('--trace', dest='trace_filename', type=str, default=None,
+                        help='Path to write a timing trace to (JSON lines if it ends with .jsonl, '
+                             'Chrome trace format otherwise).')
+    parser.add_argument('--sparse', dest='sparse', action='store_true', default=False,
+                        help='Keep only foreground pixels of views, saving memory.')
+    parser.add_argument('--precision', dest='precision', type=str, default='float64',
+                        choices=PRECISIONS, help='Floating point type of images, points and predictions.')
+    parser.add_argument('--occlusion-factor', dest='occlusion_factor', type=float, default=None,
+                        help='occlusion_factor * resolution_3d is the max difference between depth of a reprojected point '
+                             'and depth of the view at its nearest pixel (distance_interpolation_threshold by default).')
+    parser.add_argument('--chunk-size', dest='chunk_size', type=int, default=None,
+                        help='Number of points of a view to interpolate at once, bounding memory per pair of views.')
+    parser.add_argument('--pair-cache', dest='pair_cache_dir', type=str, default=None,
+                        help='Directory to cache interpolated predictions of pairs of views in, '
+                             'reused by runs with the same inputs and interpolation parameters.')
+    parser.add_argument('--reservoir-size', dest='reservoir_size', type=int, default=32,
+                        help='Number of predictions per point kept for truncated aggregations in streaming mode.')
     #parser.add_argument('--resolution-type', type=str, choices=['med', 'high'], default='high')
     return parser.parse_args()
 
 
 if __name__ == '__main__':
     options = parse_args()
-    main(options)
+    with tracing(Tracer() if None is not options.trace_filename else None) as tracer:
+        main(options)
+    if None is not options.trace_filename:
+        tracer.write(options.trace_filename)
+        print('Saved trace to {}'.format(options.trace_filename))
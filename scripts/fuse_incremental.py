@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+
+# Usage:
+#   python fuse_incremental.py -t input_gt.hdf5 -p input_pred.hdf5 -s state.npz -o output_dir/
+#
+# Views of the input files not yet in the state file (i.e. scans appended
+# to the files since the previous run) are fused into the saved state,
+# which is created on the first run.
+
+import argparse
+import os
+import sys
+
+import numpy as np
+
+__dir__ = os.path.normpath(
+    os.path.join(
+        os.path.dirname(os.path.realpath(__file__)), '..'))
+sys.path[1:1] = [__dir__]
+
+from gcv_v20211_hw1.fusion.batch_interpolation import INTERPOLATION_METHODS
+from gcv_v20211_hw1.fusion.combiners import AGGREGATION_METHODS
+from gcv_v20211_hw1.fusion.incremental import IncrementalFusion
+from gcv_v20211_hw1.fusion.pipeline import HIGH_RES, PRECISIONS
+import gcv_v20211_hw1.utils.sharpf_io as sharpf_io
+from gcv_v20211_hw1.utils.hdf5.dataset import Hdf5File, PreloadTypes
+
+
+def load_views(filename, start, labels):
+    dataset = Hdf5File(
+        filename,
+        io=sharpf_io.WholeDepthMapIO,
+        preload=PreloadTypes.NEVER,
+        labels='*',
+        persistent=True)
+    views = dataset.load_range(start, len(dataset), labels=labels) if start < len(dataset) else None
+    dataset.close()
+    return views
+
+
+def main(options):
+    if os.path.exists(options.state_filename):
+        fusion = IncrementalFusion.load(options.state_filename)
+        print('Loaded {} views ({} points) from {}'.format(fusion.n_views, fusion.n_points, options.state_filename))
+    else:
+        fusion = IncrementalFusion(
+            options.resolution_3d,
+            reservoir_size=options.reservoir_size,
+            dtype=np.dtype(options.precision),
+            nn_set_size=options.nn_set_size,
+            distance_interpolation_threshold=options.resolution_3d * options.distance_interp_factor,
+            method=options.interpolation_method,
+            chunk_size=options.chunk_size,
+            occlusion_tolerance=options.resolution_3d * options.occlusion_factor
+            if None is not options.occlusion_factor else None)
+
+    gt_views = load_views(options.true_filename, fusion.n_views, labels=['image', 'camera_pose'])
+    pred_views = load_views(options.pred_filename, fusion.n_views, labels=['distances'])
+    if None is gt_views:
+        print('No new views')
+    else:
+        dtype = fusion.combiner.min.dtype
+        for image, distances, extrinsics in zip(gt_views['image'], pred_views['distances'], gt_views['camera_pose']):
+            print('Adding view {}...'.format(fusion.n_views))
+            fusion.add_view(image.astype(dtype, copy=False), distances.astype(dtype, copy=False), extrinsics)
+        fusion.save(options.state_filename)
+        print('Saved {} views ({} points) to {}'.format(fusion.n_views, fusion.n_points, options.state_filename))
+
+    name = os.path.splitext(os.path.basename(options.true_filename))[0]
+    pred_output_filename = os.path.join(
+        options.output_dir,
+        '{}__{}.hdf5'.format(name, 'interpolated'))
+    print('Saving predictions to {}'.format(pred_output_filename))
+    sharpf_io.save_full_model_predictions(
+        fusion.points,
+        fusion.finalize(options.aggregation),
+        pred_output_filename,
+        variance=fusion.combiner.weighted_variance())
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-t', '--true-filename', dest='true_filename', required=True,
+                        help='Path to GT file with whole model depth images.')
+    parser.add_argument('-p', '--pred-filename', dest='pred_filename', required=True,
+                        help='Path to file with predicted distances.')
+    parser.add_argument('-s', '--state', dest='state_filename', required=True,
+                        help='Path to .npz file with fusion state (created if missing).')
+    parser.add_argument('-o', '--output-dir', dest='output_dir', required=True,
+                        help='Path to output (suffixes indicating various methods will be added).')
+    parser.add_argument('-k', '--nn_set_size', dest='nn_set_size', required=False, default=4, type=int,
+                        help='Number of neighbors used for interpolation (for a new state).')
+    parser.add_argument('-r', '--resolution_3d', dest='resolution_3d', required=False, default=HIGH_RES, type=float,
+                        help='3D resolution of scans (for a new state).')
+    parser.add_argument('-f', '--distance_interp_factor', dest='distance_interp_factor', required=False, type=float, default=6.,
+                        help='distance_interp_factor * resolution_3d is the distance_interpolation_threshold (for a new state).')
+    parser.add_argument('-i', '--interpolation-method', dest='interpolation_method', required=False, type=str, default='bilin',
+                        choices=INTERPOLATION_METHODS, help='Method used to interpolate predictions between views (for a new state).')
+    parser.add_argument('-a', '--aggregation', dest='aggregation', type=str,
+                        choices=AGGREGATION_METHODS, default='min')
+    parser.add_argument('--precision', dest='precision', type=str, default='float64',
+                        choices=PRECISIONS, help='Floating point type of images, points and predictions (for a new state).')
+    parser.add_argument('--occlusion-factor', dest='occlusion_factor', type=float, default=None,
+                        help='occlusion_factor * resolution_3d is the max difference between depth of a reprojected point '
+                             'and depth of the view at its nearest pixel (distance_interpolation_threshold by default) (for a new state).')
+    parser.add_argument('--chunk-size', dest='chunk_size', type=int, default=None,
+                        help='Number of points of a view to interpolate at once, bounding memory per pair of views (for a new state).')
+    parser.add_argument('--reservoir-size', dest='reservoir_size', type=int, default=32,
+                        help='Number of predictions per point kept for truncated aggregations, '
+                             '0 if only min and weighted_mean are needed (for a new state).')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    options = parse_args()
+    main(options)